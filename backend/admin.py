@@ -10,6 +10,8 @@ from .models import Contact
 from .models import Order
 from .models import OrderItem
 from .models import ConfirmEmailToken
+from .models import ImportJob
+from .models import ImportRun
 
 
 admin.site.register(User)
@@ -23,5 +25,7 @@ admin.site.register(Contact)
 admin.site.register(Order)
 admin.site.register(OrderItem)
 admin.site.register(ConfirmEmailToken)
+admin.site.register(ImportJob)
+admin.site.register(ImportRun)
 
 
@@ -0,0 +1,243 @@
+"""
+Карточки товаров каталога (ProductCard) — готовый к выдаче JSON товара.
+
+Карточка строится тем же ProductSerializer, что и прежний ответ каталога,
+пачками по CARD_BATCH_SIZE товаров: предложения, магазины и параметры
+пачки загружаются фиксированным числом запросов, а карточки записываются
+одним INSERT ... ON CONFLICT DO UPDATE. Каталог читает только таблицу
+карточек и не собирает ответ из пяти таблиц на каждый запрос.
+
+Карточки обновляются при записи: импорт пересобирает карточки товаров
+каждой записанной пачки, а изменения Product, ProductInfo, ProductParameter
+и Shop через ORM пересобирают карточки затронутых товаров после фиксации
+транзакции (сигналы в models.py). Полная пересборка —
+команда rebuild_product_cards.
+
+На PostgreSQL вместе с карточкой пересчитывается её поисковый вектор
+(tsvector со словарём russian): название — вес A, бренд — B, модель — C,
+описание — D. По вектору построен GIN-индекс, поэтому поиск ?q= не
+просматривает таблицу целиком.
+
+Тот же проход обновляет индекс фасетов (ProductFacet) — значения параметров
+активных предложений товара — и счётчики товаров по значениям в категории
+(FacetCount). Изменяются только различающиеся строки индекса, а счётчики
+получают приращения одним INSERT ... ON CONFLICT DO UPDATE, поэтому ответ
+с фасетами категории не просматривает ProductParameter. Каждая пачка
+пересобирается в своей транзакции под блокировкой строк товаров и их
+фасетов (SELECT ... FOR UPDATE), поэтому параллельные пересборки одного
+товара не применяют одну разницу к счётчикам дважды.
+"""
+from collections import Counter
+from contextlib import contextmanager
+from itertools import islice
+
+from cacheops import invalidate_model
+from django.db import connection, transaction
+from django.db.models import Count
+
+from .filters import SEARCH_CONFIG
+from .models import FacetCount, Product, ProductCard, ProductFacet
+from .serializers import ProductSerializer
+from .versions import bump_catalog_version
+
+CARD_BATCH_SIZE = 500
+# Строк счётчиков в одном запросе: по 4 параметра на строку, в пределах лимита параметров SQLite
+FACET_DELTA_BATCH_SIZE = 1000
+
+
+def build_cards(products):
+    """Строит (не сохраняя) карточки для товаров, загруженных с ProductSerializer.setup_eager_loading"""
+    products = list(products)
+    payloads = ProductSerializer(products, many=True).data
+    return [
+        ProductCard(
+            product_id=product.pk,
+            category_id=product.category_id,
+            name=product.name,
+            price=payload['offers_summary']['min_price'],
+            quantity=sum(offer.quantity for offer in product.infos.all() if offer.is_active),
+            payload=payload,
+        ) for product, payload in zip(products, payloads)
+    ]
+
+
+def refresh_product_cards(product_ids, batch_size=CARD_BATCH_SIZE):
+    """
+    Пересобирает карточки и фасеты товаров product_ids пачками по batch_size.
+    Карточки удалённых к этому моменту товаров удаляются каскадом, а их фасеты — здесь.
+    После фиксации транзакции увеличивается версия каталога (ETag ответов API), даже если
+    ни одной карточки не записано: удалённый товар тоже меняет ответ каталога.
+    product_ids может быть потоком (iterator()): id читаются по пачке и сортируются в её пределах.
+    Возвращает количество записанных карточек.
+    """
+    product_ids = iter(product_ids)
+    written, refreshed = 0, False
+    while True:
+        chunk = sorted(set(islice(product_ids, batch_size)))
+        if not chunk:
+            if refreshed:
+                bump_catalog_version()
+            return written
+        refreshed = True
+        with transaction.atomic():
+            # Параллельные пересборки одних товаров выполняются по очереди: иначе обе вычислят одну
+            # разницу фасетов и дважды применят её к счётчикам (или вставят одну строку индекса дважды).
+            # Строки блокируются по возрастанию pk, чтобы пересборки не ждали друг друга по кругу
+            list(Product.objects.filter(pk__in=chunk).order_by('pk').select_for_update().values_list('pk'))
+            products = list(ProductSerializer.setup_eager_loading(Product.objects.filter(pk__in=chunk)))
+            cards = build_cards(products)
+            ProductCard.objects.bulk_create(
+                cards,
+                update_conflicts=True,
+                unique_fields=['product'],
+                update_fields=['category', 'name', 'price', 'quantity', 'payload', 'updated_at'],
+            )
+            if connection.vendor == 'postgresql':
+                update_search_vectors(chunk)
+            update_facets(chunk, products)
+        written += len(cards)
+
+
+def update_search_vectors(product_ids):
+    """Пересчитывает поисковые векторы карточек одним UPDATE ... FROM по таблице товаров"""
+    quote_name = connection.ops.quote_name
+    card_table = quote_name(ProductCard._meta.db_table)
+    product_table = quote_name(Product._meta.db_table)
+    weighted = ' || '.join(
+        f"setweight(to_tsvector(%s::regconfig, p.{quote_name(column)}), '{weight}')"
+        for column, weight in (('name', 'A'), ('brand', 'B'), ('model', 'C'), ('description', 'D'))
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'UPDATE {card_table} SET search_vector = {weighted} FROM {product_table} p '
+            f'WHERE p.id = {card_table}.product_id AND {card_table}.product_id = ANY(%s)',
+            [SEARCH_CONFIG] * 4 + [list(product_ids)]
+        )
+
+
+def product_facets(product):
+    """Строки индекса фасетов товара: (товар, категория, параметр, значение) по активным предложениям"""
+    return {
+        (product.pk, product.category_id, product_param.parameter_id, product_param.value)
+        for product_info in product.infos.all() if product_info.is_active
+        for product_param in product_info.product_parameters.all()
+    }
+
+
+def update_facets(product_ids, products):
+    """
+    Приводит индекс фасетов товаров product_ids к значениям, вычисленным по products
+    (загруженным с предложениями и параметрами), и применяет разницу к счётчикам.
+    Вызывается в транзакции: строки индекса блокируются до её фиксации, поэтому разница
+    для удалённого товара применяется к счётчикам один раз.
+    """
+    facets = ProductFacet.objects.filter(product_id__in=product_ids).order_by('pk').select_for_update()
+    current = {
+        row[1:]: row[0] for row in facets.values_list('pk', 'product_id', 'category_id', 'parameter_id', 'value')
+    }
+    expected = set().union(*(product_facets(product) for product in products))
+    removed = current.keys() - expected
+    added = expected - current.keys()
+    if removed:
+        ProductFacet.objects.filter(pk__in=[current[key] for key in removed]).delete()
+    if added:
+        ProductFacet.objects.bulk_create([
+            ProductFacet(product_id=product_id, category_id=category_id, parameter_id=parameter_id, value=value)
+            for product_id, category_id, parameter_id, value in added
+        ])
+    deltas = Counter()
+    for _, *key in added:
+        deltas[tuple(key)] += 1
+    for _, *key in removed:
+        deltas[tuple(key)] -= 1
+    apply_facet_deltas({key: delta for key, delta in deltas.items() if delta})
+
+
+def apply_facet_deltas(deltas):
+    """Прибавляет {(категория, параметр, значение): приращение} к счётчикам и удаляет обнулившиеся"""
+    if not deltas:
+        return
+    quote_name = connection.ops.quote_name
+    table = quote_name(FacetCount._meta.db_table)
+    # Строки сортируются, чтобы параллельные импорты блокировали счётчики в одном порядке
+    rows = iter(sorted(deltas.items()))
+    with connection.cursor() as cursor:
+        while chunk := list(islice(rows, FACET_DELTA_BATCH_SIZE)):
+            cursor.execute(
+                f'INSERT INTO {table} (category_id, parameter_id, value, products) '
+                f"VALUES {', '.join(['(%s, %s, %s, %s)'] * len(chunk))} "
+                f'ON CONFLICT (category_id, parameter_id, value) '
+                f'DO UPDATE SET products = {table}.products + EXCLUDED.products',
+                [param for key, delta in chunk for param in (*key, delta)]
+            )
+    FacetCount.objects.filter(
+        category_id__in={key[0] for key in deltas}, parameter_id__in={key[1] for key in deltas}, products__lte=0
+    ).delete()
+
+
+def recount_facets():
+    """
+    Удаляет строки индекса фасетов без товара и пересчитывает все счётчики
+    по индексу ProductFacet (для полной пересборки)
+    """
+    with transaction.atomic():
+        ProductFacet.objects.exclude(product_id__in=Product.objects.values('pk')).delete()
+        FacetCount.objects.all().delete()
+        FacetCount.objects.bulk_create([
+            FacetCount(**row) for row in ProductFacet.objects.values('category_id', 'parameter_id', 'value').annotate(
+                products=Count('product_id')
+            ).order_by()
+        ], batch_size=FACET_DELTA_BATCH_SIZE)
+
+
+def facet_counts(category_id):
+    """Счётчики фасетов категории: {имя параметра: {значение: число товаров}}"""
+    facets = {}
+    for name, value, products in FacetCount.objects.filter(category_id=category_id, products__gt=0).order_by(
+        'parameter__name', 'value'
+    ).values_list('parameter__name', 'value', 'products'):
+        values = facets.setdefault(name, {})
+        values[value] = values.get(value, 0) + products
+    return facets
+
+
+@contextmanager
+def card_signals_disconnected():
+    """
+    Отключает пересборку карточек по сигналам моделей (models.py) на время массового удаления:
+    иначе ORM выбирает каждую удаляемую строку и откладывает для неё пересборку.
+    Карточки затронутых товаров пересобирает вызывающий код.
+    """
+    from django.db.models.signals import post_delete, post_save
+    from . import models
+
+    receivers = [
+        (signal, receiver, sender)
+        for receiver, sender in (
+            (models.refresh_product_card, Product),
+            (models.refresh_offer_product_card, models.ProductInfo),
+            (models.refresh_parameter_product_card, models.ProductParameter),
+        )
+        for signal in (post_save, post_delete)
+    ] + [(post_save, models.refresh_shop_product_cards, models.Shop)]
+    for signal, receiver, sender in receivers:
+        signal.disconnect(receiver, sender=sender)
+    try:
+        yield
+    finally:
+        for signal, receiver, sender in receivers:
+            signal.connect(receiver, sender=sender)
+
+
+def schedule_card_refresh(resolve_product_ids):
+    """
+    Откладывает пересборку карточек до фиксации текущей транзакции.
+    resolve_product_ids вызывается уже после фиксации и возвращает id товаров,
+    поэтому удалённые в той же транзакции строки не мешают пересборке.
+    """
+    def refresh():
+        refresh_product_cards(resolve_product_ids())
+        for model in (ProductCard, ProductFacet, FacetCount):
+            invalidate_model(model)
+
+    transaction.on_commit(refresh)
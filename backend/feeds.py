@@ -0,0 +1,243 @@
+"""
+Потоковое чтение прайс-листов магазинов в форматах YAML, CSV и JSON Lines.
+
+Все читатели предоставляют одинаковый интерфейс: свойства shop и
+categories и итерацию по товарам в виде словарей той же структуры, что и
+в YAML-прайсе (id, category, model, name, price, price_rrc, quantity,
+parameters), поэтому проверка и запись товаров общие для всех форматов.
+
+YAML-прайс разбирается по событиям парсера PyYAML, поэтому в памяти
+одновременно находится только один товар из раздела goods, а не весь
+документ. Если PyYAML собран с libyaml, используется C-загрузчик.
+"""
+import csv
+import io
+import json
+import os
+
+import yaml
+
+try:
+    from yaml import CSafeLoader as FeedLoader
+except ImportError:
+    from yaml import SafeLoader as FeedLoader
+
+
+class YamlFeedReader:
+    """
+    Читает заголовок прайса (shop, categories) при создании и отдаёт товары
+    раздела goods по одному при итерации. Разделы shop и categories должны
+    располагаться в файле до раздела goods.
+    """
+
+    def __init__(self, stream):
+        self.loader = FeedLoader(stream)
+        self.header = {}
+        self._anchors = {}
+        self._goods_pending = False
+        self._goods_read = False
+        self._read_header()
+
+    @property
+    def shop(self):
+        return self.header.get('shop')
+
+    @property
+    def categories(self):
+        return self.header.get('categories') or []
+
+    def __iter__(self):
+        if self._goods_pending:
+            self._goods_pending = False
+            while not self.loader.check_event(yaml.SequenceEndEvent):
+                yield self._construct(self._compose())
+            self.loader.get_event()
+            self._read_mapping_items()
+        self.close()
+
+    def close(self):
+        self.loader.dispose()
+
+    def _read_header(self):
+        self._expect(yaml.StreamStartEvent)
+        if self.loader.check_event(yaml.StreamEndEvent):
+            return
+        self._expect(yaml.DocumentStartEvent)
+        if not self.loader.check_event(yaml.MappingStartEvent):
+            raise ValueError('Прайс-лист должен быть словарём с разделами shop, categories и goods')
+        self.loader.get_event()
+        self._read_mapping_items()
+
+    def _read_mapping_items(self):
+        """Читает пары верхнего уровня до раздела goods или до конца документа"""
+        while not self.loader.check_event(yaml.MappingEndEvent):
+            key = self._construct(self._compose())
+            if key in ('shop', 'categories') and self._goods_read:
+                raise ValueError(f'Раздел {key} должен располагаться в прайс-листе до раздела goods')
+            if key == 'goods' and self.loader.check_event(yaml.SequenceStartEvent):
+                if self.shop is None:
+                    raise ValueError('Раздел shop должен располагаться в прайс-листе до раздела goods')
+                self.loader.get_event()
+                self._goods_pending = True
+                self._goods_read = True
+                return
+            self.header[key] = self._construct(self._compose())
+
+    def _expect(self, event_class):
+        event = self.loader.get_event()
+        if not isinstance(event, event_class):
+            raise ValueError(f'Некорректный YAML: ожидалось {event_class.__name__}, получено {event}')
+        return event
+
+    def _compose(self):
+        """Собирает узел из событий парсера (аналог Composer.compose_node, доступный и для C-загрузчика)"""
+        event = self.loader.get_event()
+        if isinstance(event, yaml.AliasEvent):
+            if event.anchor not in self._anchors:
+                raise ValueError(f'Некорректный YAML: неизвестный якорь {event.anchor}')
+            return self._anchors[event.anchor]
+
+        tag = event.tag
+        if isinstance(event, yaml.ScalarEvent):
+            if tag is None or tag == '!':
+                tag = self.loader.resolve(yaml.ScalarNode, event.value, event.implicit)
+            node = yaml.ScalarNode(tag, event.value, event.start_mark, event.end_mark, style=event.style)
+        elif isinstance(event, yaml.SequenceStartEvent):
+            if tag is None or tag == '!':
+                tag = self.loader.resolve(yaml.SequenceNode, None, event.implicit)
+            node = yaml.SequenceNode(tag, [], event.start_mark, None, flow_style=event.flow_style)
+            while not self.loader.check_event(yaml.SequenceEndEvent):
+                node.value.append(self._compose())
+            node.end_mark = self.loader.get_event().end_mark
+        elif isinstance(event, yaml.MappingStartEvent):
+            if tag is None or tag == '!':
+                tag = self.loader.resolve(yaml.MappingNode, None, event.implicit)
+            node = yaml.MappingNode(tag, [], event.start_mark, None, flow_style=event.flow_style)
+            while not self.loader.check_event(yaml.MappingEndEvent):
+                node.value.append((self._compose(), self._compose()))
+            node.end_mark = self.loader.get_event().end_mark
+        else:
+            raise ValueError(f'Некорректный YAML: неожиданное событие {event}')
+
+        if event.anchor is not None:
+            self._anchors[event.anchor] = node
+        return node
+
+    def _construct(self, node):
+        data = self.loader.construct_object(node, deep=True)
+        # Конструктор запоминает все построенные объекты — сбрасываем, чтобы память не росла
+        self.loader.constructed_objects = {}
+        self.loader.recursive_objects = {}
+        return data
+
+
+class CsvFeedReader:
+    """
+    Читает CSV-прайс с заголовком. Поля товара берутся из одноимённых
+    колонок, колонка shop содержит название магазина, а все прочие колонки
+    считаются параметрами товара (пустые значения пропускаются).
+    Раздела категорий нет: категория создаётся при импорте по колонкам
+    category и category_name.
+    """
+    GOOD_FIELDS = (
+        'id', 'category', 'category_name', 'model', 'name', 'brand', 'description', 'price', 'price_rrc', 'quantity'
+    )
+
+    def __init__(self, stream):
+        self.reader = csv.DictReader(stream)
+        if not self.reader.fieldnames or 'shop' not in self.reader.fieldnames:
+            raise ValueError('CSV-прайс должен содержать строку заголовка с колонкой shop')
+        self.parameter_columns = [
+            name for name in self.reader.fieldnames if name != 'shop' and name not in self.GOOD_FIELDS
+        ]
+        # Название магазина берётся из первой строки, сама строка отдаётся при итерации
+        self._first_row = self._next_row()
+        self.shop = self._first_row['shop'] if self._first_row else None
+        if not self.shop:
+            raise ValueError('В CSV-прайсе не указан магазин')
+        self.categories = []
+
+    def __iter__(self):
+        if self._first_row is not None:
+            row, self._first_row = self._first_row, None
+            yield self._good(row)
+        while (row := self._next_row()) is not None:
+            yield self._good(row)
+
+    def _next_row(self):
+        try:
+            return next(self.reader, None)
+        except csv.Error as e:
+            raise ValueError(f'Некорректный CSV в строке {self.reader.line_num}: {e}')
+
+    def _good(self, row):
+        good = {field: row[field] for field in self.GOOD_FIELDS if row.get(field) not in (None, '')}
+        good['parameters'] = {name: row[name] for name in self.parameter_columns if row.get(name)}
+        return good
+
+
+class JsonLinesFeedReader:
+    """
+    Читает прайс в формате JSON Lines: первая строка — заголовок
+    {"shop": ..., "categories": [...]}, каждая следующая — один товар,
+    параметры которого передаются вложенным объектом parameters.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.line_number = 0
+        header = self._next_object()
+        if not isinstance(header, dict) or not header.get('shop'):
+            raise ValueError('Первая строка JSONL-прайса должна быть объектом с полем shop')
+        self.shop = header['shop']
+        self.categories = header.get('categories') or []
+
+    def __iter__(self):
+        while True:
+            good = self._next_object()
+            if good is None:
+                return
+            if not isinstance(good, dict):
+                raise ValueError(f'Строка {self.line_number} JSONL-прайса должна быть объектом')
+            yield good
+
+    def _next_object(self):
+        for line in self.stream:
+            self.line_number += 1
+            if line.strip():
+                try:
+                    return json.loads(line)
+                except ValueError as e:
+                    raise ValueError(f'Некорректный JSON в строке {self.line_number}: {e}')
+        return None
+
+
+FEED_READERS = {
+    'yaml': YamlFeedReader,
+    'csv': CsvFeedReader,
+    'jsonl': JsonLinesFeedReader,
+}
+
+FEED_FORMATS = tuple(FEED_READERS)
+
+FEED_EXTENSIONS = {
+    '.yaml': 'yaml',
+    '.yml': 'yaml',
+    '.csv': 'csv',
+    '.jsonl': 'jsonl',
+    '.ndjson': 'jsonl',
+}
+
+
+def detect_feed_format(file_path):
+    """Определяет формат прайса по расширению файла, по умолчанию YAML"""
+    return FEED_EXTENSIONS.get(os.path.splitext(file_path)[1].lower(), 'yaml')
+
+
+def open_feed(stream, feed_format='yaml'):
+    """Создаёт читателя прайса заданного формата; двоичный поток для CSV и JSONL декодируется как UTF-8"""
+    if feed_format not in FEED_READERS:
+        raise ValueError(f'Неизвестный формат прайса {feed_format}')
+    if feed_format != 'yaml' and isinstance(stream.read(0), bytes):
+        stream = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    return FEED_READERS[feed_format](stream)
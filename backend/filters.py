@@ -0,0 +1,118 @@
+import re
+
+import django_filters
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import connection
+from django.db.models import F, FloatField, Q, Value
+from django.db.models.functions import Cast
+from rest_framework import filters
+
+from .models import ProductCard, ProductFacet
+
+SEARCH_CONFIG = 'russian'
+FACET_PARAM = re.compile(r'^param\[(?P<name>.+)\]$')
+
+
+class ProductFullTextSearchFilter(filters.BaseFilterBackend):
+    """
+    Полнотекстовый поиск по карточкам товаров: ?q=<запрос>.
+    На PostgreSQL запрос разбирается в формате websearch_to_tsquery со словарём russian
+    и ищется по индексированному search_vector карточки (GIN), найденные карточки
+    получают релевантность rank. На других СУБД — поиск подстрок в названии и описании.
+    """
+    search_param = 'q'
+
+    def get_search_query(self, request):
+        return request.query_params.get(self.search_param, '').strip()
+
+    def filter_queryset(self, request, queryset, view):
+        text = self.get_search_query(request)
+        if not text:
+            return queryset
+        if connection.vendor == 'postgresql':
+            query = SearchQuery(text, config=SEARCH_CONFIG, search_type='websearch')
+            # ts_rank возвращает real; приведение к double precision сохраняет точное значение в позиции курсора
+            rank = Cast(SearchRank(F('search_vector'), query), FloatField())
+            return queryset.filter(search_vector=query).annotate(rank=rank)
+
+        condition = Q()
+        for term in text.split():
+            condition &= Q(name__icontains=term) | Q(product__description__icontains=term)
+        return queryset.filter(condition).annotate(rank=Value(0.0, output_field=FloatField()))
+
+    def get_schema_operation_parameters(self, view):
+        return [{
+            'name': self.search_param,
+            'required': False,
+            'in': 'query',
+            'description': 'Полнотекстовый поиск по названию, бренду, модели и описанию; результаты по релевантности',
+            'schema': {'type': 'string'},
+        }]
+
+
+class ProductOrderingFilter(filters.OrderingFilter):
+    """
+    Без явного ?ordering= результаты полнотекстового поиска сортируются по релевантности.
+    При сортировке по цене товары без активных предложений (цена не задана) не выводятся:
+    курсорная пагинация не может продолжить страницу от пустого значения.
+    """
+
+    def get_default_ordering(self, view):
+        if ProductFullTextSearchFilter().get_search_query(view.request):
+            return ('-rank',)
+        return super().get_default_ordering(view)
+
+    def filter_queryset(self, request, queryset, view):
+        ordering = self.get_ordering(request, queryset, view)
+        if ordering and any(field.lstrip('-') == 'price' for field in ordering):
+            queryset = queryset.exclude(price=None)
+        return super().filter_queryset(request, queryset, view)
+
+
+class ProductCardFilter(django_filters.FilterSet):
+    """Фильтры каталога по колонкам карточки: минимальная цена активных предложений и доступное количество"""
+    price_min = django_filters.NumberFilter(field_name='price', lookup_expr='gte', label='Минимальная цена от')
+    price_max = django_filters.NumberFilter(field_name='price', lookup_expr='lte', label='Минимальная цена до')
+    in_stock = django_filters.BooleanFilter(method='filter_in_stock', label='В наличии')
+
+    class Meta:
+        model = ProductCard
+        fields = ['category', 'quantity']
+
+    def filter_in_stock(self, queryset, name, value):
+        return queryset.filter(quantity__gt=0) if value else queryset.filter(quantity=0)
+
+
+class ProductFacetFilter(filters.BaseFilterBackend):
+    """
+    Фильтр по значениям параметров товара: ?param[Цвет]=черный&param[Встроенная память (Гб)]=128,256.
+    Значения одного параметра объединяются через «или», разные параметры — через «и».
+    Товары выбираются по индексу фасетов (ProductFacet), а не по ProductParameter.
+    """
+
+    @staticmethod
+    def get_facet_filters(request):
+        facets = {}
+        for key, values in request.query_params.lists():
+            match = FACET_PARAM.match(key)
+            if match:
+                facets[match['name']] = {value for item in values for value in item.split(',') if value}
+        return facets
+
+    def filter_queryset(self, request, queryset, view):
+        for name, values in self.get_facet_filters(request).items():
+            queryset = queryset.filter(pk__in=ProductFacet.objects.filter(
+                parameter__name=name, value__in=values
+            ).values('product_id'))
+        return queryset
+
+    def get_schema_operation_parameters(self, view):
+        return [{
+            'name': 'param',
+            'required': False,
+            'in': 'query',
+            'style': 'deepObject',
+            'explode': True,
+            'description': 'Значения параметров товара: param[<название параметра>]=<значение>[,<значение>...]',
+            'schema': {'type': 'object', 'additionalProperties': {'type': 'string'}},
+        }]
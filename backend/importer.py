@@ -0,0 +1,936 @@
+"""
+Пакетный импорт товаров из прайс-листов магазинов.
+
+Вместо get_or_create на каждую строку товары обрабатываются пачками:
+существующие строки пачки выбираются одним запросом на модель, новые и
+изменённые записываются одним INSERT ... ON CONFLICT DO UPDATE
+(bulk_create с update_conflicts), неизменённые строки не трогаются.
+Каждая пачка пишется в отдельной транзакции.
+
+Для каждого предложения магазина хранится хэш его содержимого в прайсе
+(ProductInfo.feed_hash): товары, не изменившиеся с прошлого импорта,
+отсекаются до обращения к Product, ProductInfo и ProductParameter.
+
+В поэтапном режиме (staged) предложения, поля их продуктов и параметры
+пишутся в промежуточные таблицы и публикуются одной транзакцией (см.
+staging.py); до публикации живые Product, ProductInfo и ProductParameter
+не меняются.
+
+Предложения магазина, отсутствующие в прайсе, можно снять с продажи или
+архивировать одним UPDATE по множеству id из прайса; большие множества
+передаются в базу через временную таблицу.
+
+Прайсы в форматах YAML, CSV и JSON Lines (см. feeds.py) приводятся к
+одной структуре товара и проходят одинаковые проверку и запись. Категории
+CSV-прайса создаются по мере появления в товарах.
+
+После каждой записанной пачки в той же транзакции сохраняется контрольная
+точка (SHA-256 файла и число записанных товаров прайса), поэтому прерванный
+импорт можно возобновить с неё, не повторяя записанные пачки.
+
+Самая большая таблица импорта, ProductParameter, на PostgreSQL может
+загружаться командой COPY через временную таблицу (параметр copy).
+
+Карточки каталога (ProductCard, см. catalog.py) пересобираются для товаров
+каждой записанной пачки в её транзакции; в поэтапном режиме — после публикации.
+
+Время этапов и сгруппированные ошибки накапливаются в ImportStats, а
+каждый запуск с отчётом сохраняется в истории импортов (ImportRun).
+
+Несколько прайсов импортируются параллельно в пуле процессов, у каждого
+процесса своё подключение к базе. Прайсы одного магазина не выполняются
+одновременно благодаря advisory-блокировке PostgreSQL по имени магазина.
+"""
+import hashlib
+import json
+import multiprocessing
+import time
+import uuid
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from itertools import islice
+
+from cacheops import invalidate_model
+from django.db import DatabaseError, connection, connections, transaction
+from django.utils import timezone
+
+from .catalog import refresh_product_cards
+from .feeds import detect_feed_format, open_feed
+from .models import (
+    PRICE_HISTORY_FIELDS, Category, FacetCount, ImportCheckpoint, ImportJob, ImportRun, Parameter, PriceHistory,
+    Product, ProductCard, ProductFacet, ProductInfo, ProductInfoStage, ProductParameter, ProductParameterStage, Shop
+)
+from .pgcopy import copy_rows, copy_supported, copy_upsert
+from .staging import discard_stage, discard_stale_stage, price_history_params, publish_stage, validate_stage
+
+# Словарь перевода параметров на русский язык
+PARAMETER_TRANSLATIONS = {
+    "Screen Size (inches)": "Диагональ (дюйм)",
+    "Resolution (pixels)": "Разрешение (пикс)",
+    "Internal Memory (GB)": "Встроенная память (Гб)",
+    "Color": "Цвет",
+    "Capacity (GB)": "Объем памяти (Гб)",
+    "Smart TV": "Смарт-ТВ"
+}
+
+DEFAULT_BATCH_SIZE = 1000
+
+# Поля Product из строки прайса (атрибуты модели); в поэтапном режиме хранятся в ProductInfoStage
+PRODUCT_FIELDS = ('external_id', 'category_id', 'name', 'model', 'description', 'brand', 'quantity')
+
+# Что делать с предложениями магазина, которых нет в прайсе
+MISSING_OFFER_ACTIONS = ('keep', 'out-of-stock', 'archive')
+
+# Начиная с этого числа id в прайсе отсутствующие предложения ищутся через временную таблицу
+SEEN_IDS_TEMP_TABLE_THRESHOLD = 10000
+
+# Первый ключ advisory-блокировок импорта, отделяет их от прочих блокировок в базе
+SHOP_LOCK_NAMESPACE = 0x494d50
+
+
+class ImportStats:
+    """
+    Счётчики результатов импорта по моделям: добавлено, обновлено, без изменений, удалено.
+    Также накапливает время этапов импорта и группирует ошибки по видам с примерами строк.
+    """
+    OUTCOMES = ('inserted', 'updated', 'unchanged', 'deleted')
+    # Примеров строк на один вид ошибок и видов ошибок в отчёте
+    ERROR_SAMPLES = 3
+    TOP_ERRORS = 10
+
+    def __init__(self):
+        self.models = {}
+        self.rows = 0
+        self.resumed = 0
+        self.skipped = 0
+        self.deactivated = 0
+        self.errors = []
+        self.error_groups = {}
+        self.timings = {}
+
+    def add(self, model_name, outcome, count=1):
+        counters = self.models.setdefault(model_name, dict.fromkeys(self.OUTCOMES, 0))
+        counters[outcome] += count
+
+    def error(self, message, kind='other', sample=None):
+        self.errors.append(message)
+        group = self.error_groups.setdefault(kind, {'count': 0, 'message': message, 'samples': []})
+        group['count'] += 1
+        if sample is not None and len(group['samples']) < self.ERROR_SAMPLES:
+            # Строка прайса может содержать даты и прочие значения, которые не сериализуются в JSON
+            group['samples'].append(json.loads(json.dumps(sample, ensure_ascii=False, default=str)))
+
+    @contextmanager
+    def timer(self, stage):
+        """Добавляет время выполнения блока к этапу stage"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] = self.timings.get(stage, 0) + time.perf_counter() - started
+
+    def merge(self, other):
+        for model_name, counters in other.models.items():
+            for outcome, count in counters.items():
+                self.add(model_name, outcome, count)
+        self.rows += other.rows
+        self.resumed += other.resumed
+        self.skipped += other.skipped
+        self.deactivated += other.deactivated
+        self.errors.extend(other.errors)
+        for kind, other_group in other.error_groups.items():
+            group = self.error_groups.setdefault(kind, {'count': 0, 'message': other_group['message'], 'samples': []})
+            group['count'] += other_group['count']
+            group['samples'] = (group['samples'] + other_group['samples'])[:self.ERROR_SAMPLES]
+        for stage, seconds in other.timings.items():
+            self.timings[stage] = self.timings.get(stage, 0) + seconds
+
+    @property
+    def changed(self):
+        """Были ли вставлены или обновлены какие-либо строки"""
+        return self.deactivated > 0 or any(
+            c['inserted'] or c['updated'] or c['deleted'] for c in self.models.values()
+        )
+
+    def as_dict(self):
+        return {
+            'models': self.models,
+            'rows': self.rows,
+            'resumed': self.resumed,
+            'skipped': self.skipped,
+            'deactivated': self.deactivated,
+            'timings': self.timings,
+            'error_groups': self.error_groups,
+            'errors': self.errors,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        for model_name, counters in data.get('models', {}).items():
+            for outcome, count in counters.items():
+                stats.add(model_name, outcome, count)
+        stats.rows = data.get('rows', 0)
+        stats.resumed = data.get('resumed', 0)
+        stats.skipped = data.get('skipped', 0)
+        stats.deactivated = data.get('deactivated', 0)
+        stats.timings = dict(data.get('timings', {}))
+        stats.error_groups = {kind: dict(group) for kind, group in data.get('error_groups', {}).items()}
+        stats.errors = list(data.get('errors', []))
+        return stats
+
+    def report(self):
+        """Отчёт о запуске для вывода в JSON и истории импортов: счётчики, время этапов и основные ошибки"""
+        top_errors = sorted(self.error_groups.items(), key=lambda item: item[1]['count'], reverse=True)
+        return {
+            'rows': self.rows,
+            'resumed': self.resumed,
+            'models': self.models,
+            'skipped': self.skipped,
+            'deactivated': self.deactivated,
+            'timings': {stage: round(seconds, 3) for stage, seconds in self.timings.items()},
+            'errors_total': len(self.errors),
+            'top_errors': [{'kind': kind, **group} for kind, group in top_errors[:self.TOP_ERRORS]],
+        }
+
+
+def normalize_good(data):
+    """
+    Приводит запись товара из прайса к словарю с полями моделей.
+    Выбрасывает ValueError, если обязательные поля отсутствуют или некорректны.
+    """
+    try:
+        record = {
+            'external_id': str(data.get('id') or uuid.uuid4()),
+            'category_id': int(data['category']),
+            'name': str(data['name']),
+            'model': str(data.get('model') or ''),
+            'brand': str(data.get('brand') or ''),
+            'description': str(data.get('description') or ''),
+            'price': int(data['price']),
+            'price_rrc': int(data['price_rrc']),
+            'quantity': int(data.get('quantity') or 0),
+        }
+    except KeyError as e:
+        raise ValueError(f'отсутствует поле {e}')
+    except (TypeError, ValueError) as e:
+        raise ValueError(f'некорректное значение: {e}')
+
+    if min(record['price'], record['price_rrc'], record['quantity']) < 0:
+        raise ValueError('цена и количество не могут быть отрицательными')
+    for model, field in ((Product, 'name'), (Product, 'model'), (Product, 'brand')):
+        max_length = model._meta.get_field(field).max_length
+        if len(record[field]) > max_length:
+            raise ValueError(f'поле {field} длиннее {max_length} символов')
+
+    parameters = {}
+    name_length = Parameter._meta.get_field('name').max_length
+    value_length = ProductParameter._meta.get_field('value').max_length
+    for param_name, param_value in (data.get('parameters') or {}).items():
+        if param_value in (None, ''):  # Пропуск пустых значений параметров
+            continue
+        param_name = PARAMETER_TRANSLATIONS.get(param_name, str(param_name))
+        param_value = str(param_value)
+        if len(param_name) > name_length:
+            raise ValueError(f'название параметра {param_name!r} длиннее {name_length} символов')
+        if len(param_value) > value_length:
+            raise ValueError(f'значение параметра {param_name!r} длиннее {value_length} символов')
+        parameters[param_name] = param_value
+    record['parameters'] = parameters
+    return record
+
+
+def invalidate_catalog():
+    """Сброс кэша каталога одним вызовом на модель вместо invalidate_obj на каждую строку"""
+    for model in (Category, Product, ProductInfo, ProductParameter, ProductCard, ProductFacet, FacetCount):
+        invalidate_model(model)
+
+
+def content_hash(record):
+    """
+    Стабильный хэш содержимого товара из прайса: цены, количество, модель,
+    параметры и поля продукта. Не зависит от порядка ключей и параметров в файле.
+    """
+    payload = json.dumps(record, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class GoodsImporter:
+    """
+    Импорт прайс-листа одного магазина пачками по batch_size товаров.
+    Магазин передаётся объектом Shop или именем (создаётся при отсутствии).
+    При full=True товары записываются даже при совпадении хэша содержимого.
+    При staged=True предложения и параметры публикуются одной транзакцией после проверки.
+    missing задаёт действие с предложениями магазина, которых нет в прайсе (MISSING_OFFER_ACTIONS).
+    Каждый вызов run сохраняется в истории импортов (ImportRun) с источником source.
+    При copy=True на PostgreSQL параметры товаров загружаются командой COPY (см. pgcopy.py).
+    Если передан feed_hash (SHA-256 файла прайса), после каждой записанной пачки сохраняется
+    контрольная точка, а при resume=True товары до неё пропускаются без обращения к базе.
+    """
+
+    def __init__(self, shop, batch_size=DEFAULT_BATCH_SIZE, full=False, staged=False, missing='keep', source='',
+                 feed_hash='', resume=False, copy=False):
+        if isinstance(shop, Shop):
+            self.shop, self.shop_created = shop, False
+        else:
+            self.shop, self.shop_created = Shop.objects.get_or_create(name=shop)
+        self.batch_size = batch_size
+        self.full = full
+        self.staged = staged
+        self.missing = missing
+        self.source = source
+        self.feed_hash = feed_hash
+        self.resume = resume
+        self.copy = copy and copy_supported()
+        self.checkpoint = None
+        self.run_id = uuid.uuid4()
+        self.failed_batches = 0
+        self.stats = ImportStats()
+        self.category_ids = set()
+        self.parameter_ids = {}
+        self.seen_external_ids = set()
+        # Продукты опубликованных предложений: их карточки пересобираются после публикации
+        self.staged_product_ids = set()
+        # Категории, впервые встреченные в товарах прайса без раздела categories (CSV)
+        self.pending_categories = {}
+
+    def run(self, categories, goods):
+        """Импортирует категории и товары, после чего сбрасывает кэш каталога и сохраняет запуск в истории"""
+        # Фоновая задача импорта пишет части прайса без блокировки магазина, поэтому занятость проверяется по её статусу
+        if ImportJob.objects.filter(shop=self.shop, state='running').exists():
+            raise ValueError(f'Прайс магазина {self.shop.name} импортируется фоновой задачей, повторите импорт позже')
+        started_at = timezone.now()
+        try:
+            if self.staged:
+                discard_stale_stage(self.shop)
+            elif self.feed_hash:
+                # Поэтапный импорт публикуется целиком, поэтому контрольные точки в нём не ведутся
+                self.load_checkpoint()
+            self.import_categories(categories)
+            self.import_goods(goods)
+            published = True
+            if self.staged:
+                published = self.publish()
+                self.refresh_cards(self.staged_product_ids)
+            # Отменённая публикация не должна менять живые предложения, в том числе отсутствующие в прайсе
+            if self.missing != 'keep' and published:
+                self.deactivate_missing()
+            if self.checkpoint is not None and not self.failed_batches:
+                self.checkpoint.delete()
+            self.invalidate()
+        except Exception as e:
+            self.stats.error(f'Импорт прерван: {e}', kind='aborted')
+            self.save_run(started_at, success=False)
+            raise
+        self.save_run(started_at)
+        return self.stats
+
+    def save_run(self, started_at, success=True):
+        return save_import_run(self.shop, self.stats, started_at, source=self.source, success=success, options={
+            'batch_size': self.batch_size,
+            'full': self.full,
+            'staged': self.staged,
+            'missing': self.missing,
+            'resume': self.resume,
+            'copy': self.copy,
+        })
+
+    def load_checkpoint(self):
+        """Загружает контрольную точку прайса; без resume начинает импорт с начала файла"""
+        self.checkpoint, created = ImportCheckpoint.objects.get_or_create(shop=self.shop, feed_hash=self.feed_hash)
+        if not self.resume and self.checkpoint.offset:
+            self.checkpoint.offset = 0
+            self.checkpoint.save(update_fields=['offset', 'updated_at'])
+
+    def save_checkpoint(self, count):
+        """
+        Сдвигает контрольную точку на count товаров прайса. Вызывается в транзакции пачки,
+        поэтому точка фиксируется вместе с данными. После неудачной пачки точка больше
+        не сдвигается, и возобновлённый импорт начнётся с неё.
+        """
+        if self.checkpoint is None or self.failed_batches:
+            return
+        self.checkpoint.offset += count
+        ImportCheckpoint.objects.filter(pk=self.checkpoint.pk).update(
+            offset=self.checkpoint.offset, updated_at=timezone.now()
+        )
+
+    def publish(self):
+        """
+        Проверяет загруженные в промежуточные таблицы данные и публикует их одной транзакцией.
+        Возвращает False, если публикация отменена.
+        """
+        with self.stats.timer('publish'):
+            problems = validate_stage(self.run_id)
+            if self.failed_batches:
+                problems.append(f'не записано пачек товаров: {self.failed_batches}')
+            if problems:
+                discard_stage(self.run_id)
+                self.stats.error(
+                    'Публикация отменена, предложения магазина не изменены: ' + '; '.join(problems), kind='publish'
+                )
+                return False
+
+            with transaction.atomic():
+                self.staged_product_ids = self._publish_products()
+                counts = publish_stage(self.shop, self.run_id)
+        self.stats.add('ProductInfo', 'inserted', counts['offers_inserted'])
+        self.stats.add('ProductInfo', 'updated', counts['offers_updated'])
+        self.stats.add('ProductParameter', 'inserted', counts['params_inserted'])
+        self.stats.add('ProductParameter', 'updated', counts['params_updated'])
+        self.stats.add('ProductParameter', 'deleted', counts['params_deleted'])
+        return True
+
+    def deactivate_missing(self):
+        """
+        Снимает с продажи (quantity = 0) или архивирует (is_active = False) предложения
+        магазина, external_id которых не встретился в прайсе, одним UPDATE.
+        """
+        if self.failed_batches:
+            self.stats.error(
+                'Отсутствующие в прайсе предложения не изменены: часть пачек товаров не записана.', kind='deactivation'
+            )
+            return
+
+        if self.missing == 'archive':
+            changes = {'is_active': False}
+        else:
+            changes = {'quantity': 0}
+        # Сброс хэша, чтобы вернувшийся в прайс товар не был пропущен как неизменный
+        changes['feed_hash'] = ''
+
+        with self.stats.timer('deactivation'), transaction.atomic():
+            if len(self.seen_external_ids) < SEEN_IDS_TEMP_TABLE_THRESHOLD:
+                offers = ProductInfo.objects.filter(shop=self.shop).exclude(external_id__in=self.seen_external_ids)
+                offers = offers.exclude(**{field: value for field, value in changes.items() if field != 'feed_hash'})
+                if 'quantity' in changes:
+                    now = timezone.now()
+                    PriceHistory.objects.bulk_create([
+                        PriceHistory(**PriceHistory.row(pk, price, price_rrc, 0, now))
+                        for pk, price, price_rrc in offers.values_list('pk', 'price', 'price_rrc')
+                    ], batch_size=self.batch_size)
+                product_ids = list(offers.values_list('product_id', flat=True))
+                self.stats.deactivated += offers.update(**changes)
+            else:
+                product_ids = self._deactivate_via_temp_table(changes)
+                self.stats.deactivated += len(product_ids)
+            self.refresh_cards(product_ids)
+
+    def _deactivate_via_temp_table(self, changes):
+        """
+        Тот же UPDATE, но множество id из прайса передаётся через временную таблицу.
+        Возвращает id товаров изменённых предложений.
+        """
+        quote_name = connection.ops.quote_name
+        info_table = quote_name(ProductInfo._meta.db_table)
+        temp_table = quote_name('import_seen_external_ids')
+        assignments = ', '.join(f'{quote_name(field)} = %s' for field in changes)
+        # Вызывается внутри транзакции: при ошибке откат удалит и временную таблицу
+        with connection.cursor() as cursor:
+            cursor.execute(f'CREATE TEMPORARY TABLE {temp_table} (external_id varchar(255) PRIMARY KEY)')
+            seen = iter(self.seen_external_ids)
+            while True:
+                chunk = list(islice(seen, self.batch_size))
+                if not chunk:
+                    break
+                placeholders = ', '.join(['(%s)'] * len(chunk))
+                cursor.execute(f'INSERT INTO {temp_table} (external_id) VALUES {placeholders}', chunk)
+
+            field, value = next((f, v) for f, v in changes.items() if f != 'feed_hash')
+            missing_condition = (
+                f'shop_id = %s AND {quote_name(field)} <> %s AND NOT EXISTS ('
+                f'SELECT 1 FROM {temp_table} t WHERE t.external_id = {info_table}.external_id)'
+            )
+            if field == 'quantity':
+                cursor.execute(
+                    f'INSERT INTO {quote_name(PriceHistory._meta.db_table)} '
+                    f'(product_info_id, price, price_rrc, quantity, changed_at, month) '
+                    f'SELECT id, price, price_rrc, 0, %s, %s FROM {info_table} WHERE {missing_condition}',
+                    [*price_history_params(), self.shop.pk, value]
+                )
+            cursor.execute(
+                f'UPDATE {info_table} SET {assignments} WHERE {missing_condition} RETURNING product_id',
+                [*changes.values(), self.shop.pk, value]
+            )
+            product_ids = [row[0] for row in cursor.fetchall()]
+            cursor.execute(f'DROP TABLE {temp_table}')
+        return product_ids
+
+    def import_categories(self, categories):
+        rows = [{'id': int(c['id']), 'name': str(c['name'])} for c in categories]
+        stats = ImportStats()
+        with stats.timer('categories'), transaction.atomic():
+            self._upsert(Category, rows, ['id'], ['name'], stats)
+            Category.shops.through.objects.bulk_create(
+                [Category.shops.through(category_id=row['id'], shop_id=self.shop.pk) for row in rows],
+                ignore_conflicts=True
+            )
+        self.stats.merge(stats)
+        self.category_ids.update(row['id'] for row in rows)
+
+    def import_goods(self, goods):
+        goods = iter(goods)
+        if self.checkpoint is not None and self.checkpoint.offset:
+            self._skip_committed(goods, self.checkpoint.offset)
+        while True:
+            # Прайс читается лениво, поэтому время получения пачки — это время разбора файла
+            with self.stats.timer('parse'):
+                batch = list(islice(goods, self.batch_size))
+            if not batch:
+                break
+            self.import_batch(batch)
+
+    def _skip_committed(self, goods, count):
+        """Пропускает товары, записанные до контрольной точки; их id нужны для поиска дубликатов и --missing"""
+        with self.stats.timer('resume'):
+            for data in islice(goods, count):
+                self.stats.resumed += 1
+                if isinstance(data, dict) and data.get('id'):
+                    self.seen_external_ids.add(str(data['id']))
+
+    def import_batch(self, goods):
+        """Проверяет и записывает одну пачку товаров в отдельной транзакции"""
+        self.stats.rows += len(goods)
+        records = []
+        with self.stats.timer('validation'):
+            for data in goods:
+                record = self._prepare(data)
+                if record is not None:
+                    records.append(record)
+        if self.pending_categories:
+            self.import_categories(
+                [{'id': category_id, 'name': name} for category_id, name in self.pending_categories.items()]
+            )
+            self.pending_categories = {}
+        stats = ImportStats()
+        if not self.full:
+            with self.stats.timer('hash_check'):
+                records = self._skip_unchanged(records, stats)
+        if not records:
+            self.stats.merge(stats)
+            self.save_checkpoint(len(goods))
+            return
+
+        try:
+            with transaction.atomic():
+                self._write_batch(records, stats)
+                self.save_checkpoint(len(goods))
+        except DatabaseError as e:
+            self.failed_batches += 1
+            self.stats.skipped += len(records)
+            self.stats.error(
+                f"Ошибка записи пачки товаров {records[0]['external_id']}..{records[-1]['external_id']}: {e}",
+                kind='batch',
+                sample={'first': records[0]['external_id'], 'last': records[-1]['external_id']}
+            )
+        else:
+            self.stats.merge(stats)
+
+    def _skip_unchanged(self, records, stats):
+        """Отбрасывает товары, хэш которых совпадает с сохранённым при прошлом импорте"""
+        stored = dict(
+            ProductInfo.objects.filter(
+                shop=self.shop, external_id__in=[r['external_id'] for r in records]
+            ).values_list('external_id', 'feed_hash')
+        )
+        changed = []
+        for record in records:
+            if stored.get(record['external_id']) == record['hash']:
+                stats.add('Product', 'unchanged')
+                stats.add('ProductInfo', 'unchanged')
+                stats.add('ProductParameter', 'unchanged', len(record['parameters']))
+            else:
+                changed.append(record)
+        return changed
+
+    def refresh_cards(self, product_ids):
+        with self.stats.timer('cards'):
+            refresh_product_cards(product_ids, batch_size=self.batch_size)
+
+    def invalidate(self):
+        if self.stats.changed:
+            with self.stats.timer('invalidation'):
+                invalidate_catalog()
+
+    def _prepare(self, data):
+        try:
+            record = normalize_good(data)
+        except ValueError as e:
+            self.stats.skipped += 1
+            self.stats.error(f"Товар {data.get('id')} пропущен: {e}", kind='invalid', sample=data)
+            return None
+
+        external_id = record['external_id']
+        if external_id in self.seen_external_ids:
+            self.stats.skipped += 1
+            self.stats.error(
+                f'Дубликат external_id {external_id} найден в файле. Пропускаем этот товар.', kind='duplicate', sample=data
+            )
+            return None
+        self.seen_external_ids.add(external_id)
+
+        if record['category_id'] not in self.category_ids and data.get('category_name'):
+            self.pending_categories[record['category_id']] = str(data['category_name'])
+        elif record['category_id'] not in self.category_ids:
+            self.stats.skipped += 1
+            self.stats.error(
+                f"Категория с ID {record['category_id']} не найдена, товар {external_id} пропущен.",
+                kind='category', sample=data
+            )
+            return None
+        record['hash'] = content_hash(record)
+        return record
+
+    def _write_batch(self, records, stats):
+        offer_fields = ['product', 'model', 'quantity', 'price', 'price_rrc', 'feed_hash', 'is_active']
+        with self.stats.timer('offers'):
+            # Предложения пачки ищутся одним запросом по индексу (shop, external_id)
+            offers = self._fetch_existing(
+                ProductInfo,
+                ['shop_id', 'external_id'],
+                [ProductInfo._meta.get_field(name).attname for name in offer_fields],
+                [(self.shop.pk, r['external_id']) for r in records]
+            )
+        if self.staged:
+            # Продукты записываются только при публикации, чтобы отменённый импорт их не затронул
+            with self.stats.timer('parameters'):
+                parameter_ids = self._resolve_parameters({name for r in records for name in r['parameters']}, stats)
+            with self.stats.timer('staging'):
+                self._stage_batch(records, offers, parameter_ids)
+            return
+
+        with self.stats.timer('products'):
+            product_ids = self._write_products(records, offers, stats)
+        with self.stats.timer('parameters'):
+            parameter_ids = self._resolve_parameters(
+                {name for r in records for name in r['parameters']}, stats
+            )
+        with self.stats.timer('offers'):
+            offer_changes = []
+            info_ids = self._upsert(ProductInfo, [
+                {
+                    'product_id': product_ids[r['external_id']],
+                    'shop_id': self.shop.pk,
+                    'model': r['model'],
+                    'external_id': r['external_id'],
+                    'quantity': r['quantity'],
+                    'price': r['price'],
+                    'price_rrc': r['price_rrc'],
+                    'feed_hash': r['hash'],
+                    'is_active': True,
+                } for r in records
+            ], ['shop', 'external_id'], offer_fields, stats, changes=offer_changes, existing=offers)
+        with self.stats.timer('history'):
+            self._record_price_history(info_ids, offer_changes)
+        with self.stats.timer('parameters'):
+            rows = [
+                {
+                    'product_info_id': info_ids[(self.shop.pk, r['external_id'])],
+                    'parameter_id': parameter_ids[name],
+                    'value': value,
+                } for r in records for name, value in r['parameters'].items()
+            ]
+            if self.copy:
+                inserted, updated = copy_upsert(ProductParameter, rows, ['product_info_id', 'parameter_id'], ['value'])
+                stats.add('ProductParameter', 'inserted', inserted)
+                stats.add('ProductParameter', 'updated', updated)
+                stats.add('ProductParameter', 'unchanged', len(rows) - inserted - updated)
+            else:
+                self._upsert(ProductParameter, rows, ['product_info', 'parameter'], ['value'], stats)
+            self._delete_missing_parameters(info_ids.values(), rows, stats)
+        self.refresh_cards(product_ids.values())
+
+    @staticmethod
+    def _delete_missing_parameters(info_ids, rows, stats):
+        """
+        Удаляет параметры предложений пачки, которых больше нет в прайсе, как publish_stage
+        при поэтапном импорте. Сигналы не отправляются: карточки пачки пересобираются после записи.
+        """
+        kept = {(row['product_info_id'], row['parameter_id']) for row in rows}
+        stale = [
+            pk for pk, info_id, parameter_id in ProductParameter.objects.filter(
+                product_info_id__in=set(info_ids)
+            ).values_list('pk', 'product_info_id', 'parameter_id')
+            if (info_id, parameter_id) not in kept
+        ]
+        if stale:
+            ProductParameter.objects.filter(pk__in=stale)._raw_delete(ProductParameter.objects.db)
+            stats.add('ProductParameter', 'deleted', len(stale))
+
+    def _write_products(self, records, offers, stats):
+        """
+        Обновляет продукты, на которые уже ссылаются предложения магазина, и создаёт
+        продукты для новых предложений. Артикулы разных магазинов не пересекаются,
+        поэтому продукт определяется через предложение, а не по external_id.
+        Возвращает {external_id: pk продукта}.
+        """
+        rows = {r['external_id']: {field: r[field] for field in PRODUCT_FIELDS} for r in records}
+        product_ids = {
+            external_id: offers[(self.shop.pk, external_id)]['product_id']
+            for external_id in rows if (self.shop.pk, external_id) in offers
+        }
+        return self._save_products(rows, product_ids, stats)
+
+    def _save_products(self, rows, product_ids, stats):
+        """
+        Обновляет продукты из product_ids ({external_id: pk}) и создаёт продукты для остальных
+        строк rows ({external_id: поля продукта}). Возвращает {external_id: pk продукта}.
+        """
+        # external_id не входит в обновляемые поля: продукт может принадлежать предложениям нескольких магазинов
+        self._upsert(Product, [dict(rows[external_id], id=pk) for external_id, pk in product_ids.items()], ['id'], [
+            'category', 'name', 'model', 'description', 'brand', 'quantity'
+        ], stats)
+
+        new_products = [Product(**row) for external_id, row in rows.items() if external_id not in product_ids]
+        if new_products:
+            # bulk_create проставляет pk через RETURNING (PostgreSQL, SQLite)
+            Product.objects.bulk_create(new_products, batch_size=self.batch_size)
+            stats.add('Product', 'inserted', len(new_products))
+            product_ids.update({product.external_id: product.pk for product in new_products})
+        return product_ids
+
+    def _publish_products(self):
+        """
+        Записывает продукты предложений запуска из промежуточной таблицы пачками по batch_size
+        и проставляет созданные продукты новым предложениям. Возвращает pk продуктов.
+        """
+        stage = ProductInfoStage.objects.filter(run=self.run_id).order_by('pk')
+        published, last_pk = set(), 0
+        rows = stage.values('pk', 'product_id', *PRODUCT_FIELDS)
+        while batch := list(rows.filter(pk__gt=last_pk)[:self.batch_size]):
+            last_pk = batch[-1]['pk']
+            product_ids = self._save_products(
+                {row['external_id']: {field: row[field] for field in PRODUCT_FIELDS} for row in batch},
+                {row['external_id']: row['product_id'] for row in batch if row['product_id'] is not None},
+                self.stats
+            )
+            ProductInfoStage.objects.bulk_update([
+                ProductInfoStage(pk=row['pk'], product_id=product_ids[row['external_id']])
+                for row in batch if row['product_id'] is None
+            ], ['product'])
+            published.update(product_ids.values())
+        return published
+
+    def _record_price_history(self, info_ids, changes):
+        """Добавляет в историю цен новые предложения и предложения с изменённой ценой или количеством"""
+        now = timezone.now()
+        history = [
+            PriceHistory(**PriceHistory.row(info_ids[key], *(row[field] for field in PRICE_HISTORY_FIELDS), now))
+            for key, row, current in changes
+            if current is None or any(current[field] != row[field] for field in PRICE_HISTORY_FIELDS)
+        ]
+        if history:
+            PriceHistory.objects.bulk_create(history, batch_size=self.batch_size)
+
+    def _stage_batch(self, records, offers, parameter_ids):
+        """Записывает предложения с полями их продуктов и параметры пачки в промежуточные таблицы"""
+        ProductInfoStage.objects.bulk_create([
+            ProductInfoStage(
+                run=self.run_id,
+                shop=self.shop,
+                product_id=offers.get((self.shop.pk, r['external_id']), {}).get('product_id'),
+                category_id=r['category_id'],
+                name=r['name'],
+                brand=r['brand'],
+                description=r['description'],
+                model=r['model'],
+                external_id=r['external_id'],
+                quantity=r['quantity'],
+                price=r['price'],
+                price_rrc=r['price_rrc'],
+                feed_hash=r['hash'],
+            ) for r in records
+        ])
+        rows = [
+            {
+                'run': self.run_id,
+                'external_id': r['external_id'],
+                'parameter_id': parameter_ids[name],
+                'value': value,
+            } for r in records for name, value in r['parameters'].items()
+        ]
+        if self.copy:
+            copy_rows(ProductParameterStage, rows, ['run', 'external_id', 'parameter_id', 'value'])
+        else:
+            ProductParameterStage.objects.bulk_create([ProductParameterStage(**row) for row in rows])
+
+    def _resolve_parameters(self, names, stats):
+        """Возвращает id параметров по именам, создавая недостающие одним bulk_create"""
+        missing = names - self.parameter_ids.keys()
+        if missing:
+            if connection.vendor == 'postgresql':
+                # Имя параметра не уникально в базе, поэтому параллельные импорты создают параметры по очереди
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT pg_advisory_xact_lock(%s, 0)', [SHOP_LOCK_NAMESPACE])
+            found = {}
+            for pk, name in Parameter.objects.filter(name__in=missing).order_by('pk').values_list('pk', 'name'):
+                found.setdefault(name, pk)
+            stats.add('Parameter', 'unchanged', len(found))
+            new = Parameter.objects.bulk_create([Parameter(name=name) for name in sorted(missing - found.keys())])
+            stats.add('Parameter', 'inserted', len(new))
+            created = {param.name: param.pk for param in new}
+            self.parameter_ids.update(found)
+            # Созданные параметры попадают в кэш только после фиксации пачки: после отката их id недействительны
+            transaction.on_commit(lambda: self.parameter_ids.update(created))
+            ids = {**self.parameter_ids, **created}
+            return {name: ids[name] for name in names}
+        return {name: self.parameter_ids[name] for name in names}
+
+    def _upsert(self, model, rows, unique_fields, update_fields, stats, changes=None, existing=None):
+        """
+        Записывает строки (словари attname -> значение) через INSERT ... ON CONFLICT DO UPDATE.
+        Строки, совпадающие с базой, не записываются. Возвращает {ключ: pk} для всех строк.
+        В список changes добавляются (ключ, строка, прежние значения или None) записанных строк.
+        existing — уже выбранные строки (результат _fetch_existing), чтобы не запрашивать их повторно.
+        """
+        opts = model._meta
+        key_attrs = [opts.get_field(name).attname for name in unique_fields]
+        value_attrs = [opts.get_field(name).attname for name in update_fields]
+        rows = {tuple(row[attr] for attr in key_attrs): row for row in rows}
+        if not rows:
+            return {}
+
+        if existing is None:
+            existing = self._fetch_existing(model, key_attrs, value_attrs, rows.keys())
+        pks = {key: current['pk'] for key, current in existing.items()}
+        to_write = []
+        for key, row in rows.items():
+            current = existing.get(key)
+            if current is None:
+                stats.add(model.__name__, 'inserted')
+            elif any(current[attr] != row[attr] for attr in value_attrs):
+                stats.add(model.__name__, 'updated')
+            else:
+                stats.add(model.__name__, 'unchanged')
+                continue
+            to_write.append((key, model(**row)))
+            if changes is not None:
+                changes.append((key, row, current))
+
+        if to_write:
+            model.objects.bulk_create(
+                [obj for _, obj in to_write],
+                batch_size=self.batch_size,
+                update_conflicts=True,
+                unique_fields=unique_fields,
+                update_fields=update_fields,
+            )
+            pks.update({key: obj.pk for key, obj in to_write})
+            # Бэкенды без RETURNING не проставляют pk после bulk_create
+            unresolved = [key for key, pk in pks.items() if pk is None]
+            if unresolved:
+                refetched = self._fetch_existing(model, key_attrs, [], unresolved)
+                pks.update({key: current['pk'] for key, current in refetched.items()})
+        return pks
+
+    @staticmethod
+    def _fetch_existing(model, key_attrs, value_attrs, keys):
+        keys = set(keys)
+        lookup = {f'{attr}__in': {key[i] for key in keys} for i, attr in enumerate(key_attrs)}
+        existing = {}
+        for row in model.objects.filter(**lookup).values('pk', *key_attrs, *value_attrs):
+            key = tuple(row[attr] for attr in key_attrs)
+            if key in keys:
+                existing[key] = row
+        return existing
+
+
+def file_sha256(file_path, chunk_size=1024 * 1024):
+    """SHA-256 содержимого файла, читаемого блоками"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        while chunk := file.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_import_run(shop, stats, started_at, source='', success=True, options=None):
+    """Сохраняет запуск импорта и его отчёт в истории импортов"""
+    finished_at = timezone.now()
+    return ImportRun.objects.create(
+        shop=shop,
+        source=source[:ImportRun._meta.get_field('source').max_length],
+        options=options or {},
+        success=success,
+        rows=stats.rows,
+        duration=(finished_at - started_at).total_seconds(),
+        report=stats.report(),
+        started_at=started_at,
+    )
+
+
+@contextmanager
+def shop_lock(shop_name):
+    """
+    Сессионная advisory-блокировка PostgreSQL на время импорта прайса магазина.
+    Блокировка берётся по имени, так как магазин может ещё не существовать.
+    На других СУБД ничего не делает.
+    """
+    if connection.vendor != 'postgresql':
+        yield
+        return
+    key = zlib.crc32(shop_name.encode('utf-8')) - 2 ** 31  # int4 для pg_advisory_lock(int, int)
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_lock(%s, %s)', [SHOP_LOCK_NAMESPACE, key])
+    try:
+        yield
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_unlock(%s, %s)', [SHOP_LOCK_NAMESPACE, key])
+
+
+def import_feed(file_path, feed_format=None, **options):
+    """
+    Пакетный импорт одного прайса под блокировкой его магазина; options передаются GoodsImporter.
+    Формат прайса (FEED_FORMATS) по умолчанию определяется по расширению файла.
+    """
+    with open(file_path, 'rb') as file:
+        feed = open_feed(file, feed_format or detect_feed_format(file_path))
+        with shop_lock(feed.shop):
+            importer = GoodsImporter(feed.shop, source=file_path, feed_hash=file_sha256(file_path), **options)
+            return importer.run(feed.categories, feed)
+
+
+def _import_feed_worker(file_path, options):
+    # Исключения не пробрасываются в родительский процесс, а попадают в статистику прайса
+    try:
+        return import_feed(file_path, **options)
+    except Exception as e:
+        return _aborted_stats(file_path, e)
+    finally:
+        connections.close_all()
+
+
+def _aborted_stats(file_path, error):
+    """Статистика прайса, импорт которого прерван исключением"""
+    stats = ImportStats()
+    stats.error(f'Импорт {file_path} прерван: {error}', kind='aborted')
+    return stats
+
+
+def import_feeds(file_paths, workers=1, **options):
+    """
+    Импортирует несколько прайсов в пуле из workers процессов.
+    Отдаёт пары (путь к файлу, ImportStats) по мере завершения.
+    """
+    if workers <= 1:
+        for file_path in file_paths:
+            yield file_path, _import_feed_worker(file_path, options)
+        return
+
+    # Дочерние процессы не должны унаследовать открытое подключение родителя
+    connections.close_all()
+    context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=connections.close_all) as pool:
+        futures = {
+            pool.submit(_import_feed_worker, file_path, options): file_path
+            for file_path in file_paths
+        }
+        for future in as_completed(futures):
+            try:
+                stats = future.result()
+            except Exception as e:
+                # Процесс пула завершился аварийно или результат не удалось передать — остальные прайсы продолжаются
+                stats = _aborted_stats(futures[future], e)
+            yield futures[future], stats
@@ -0,0 +1,181 @@
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.utils import timezone
+from backend.catalog import card_signals_disconnected, refresh_product_cards
+from backend.feeds import FEED_FORMATS, open_feed
+from backend.importer import DEFAULT_BATCH_SIZE, import_feed
+from backend.models import Product, Shop
+from .generate_feed import write_feed
+
+BENCHMARK_SHOP = 'Benchmark'
+
+
+class QueryCounter:
+    """Считает SQL-запросы, выполненные через подключение"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def _peak_rss_mb():
+    # ru_maxrss в Linux измеряется в килобайтах
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def run_parse_case(file_path, feed_format):
+    """Только разбирает прайс без обращения к базе, чтобы замерить стоимость формата"""
+    started = time.perf_counter()
+    with open(file_path, 'rb') as file:
+        rows = sum(1 for _ in open_feed(file, feed_format))
+    wall_time = time.perf_counter() - started
+    return {
+        'rows': rows,
+        'wall_time': round(wall_time, 3),
+        'rows_per_second': round(rows / wall_time, 1) if wall_time else None,
+        'peak_rss_mb': _peak_rss_mb(),
+        'queries': 0,
+    }
+
+
+def run_case(file_path, options):
+    """
+    Импортирует прайс и возвращает время, число запросов и пиковую память процесса.
+    Выполняется в отдельном процессе, чтобы пиковая память относилась к одному запуску.
+    """
+    counter = QueryCounter()
+    started = time.perf_counter()
+    with connection.execute_wrapper(counter):
+        stats = import_feed(file_path, **options)
+    wall_time = time.perf_counter() - started
+    connections.close_all()
+
+    return {
+        'rows': stats.rows,
+        'wall_time': round(wall_time, 3),
+        'rows_per_second': round(stats.rows / wall_time, 1) if wall_time else None,
+        'peak_rss_mb': _peak_rss_mb(),
+        'queries': counter.count,
+        'stats': stats.report(),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        'Замеряет производительность пакетного импорта на синтетических прайсах: время, товаров в секунду, '
+        'пиковую память и число SQL-запросов. Запускайте на отдельной базе данных.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            type=str,
+            default='10000,100000',
+            help='Размеры прайсов через запятую, например 10000,100000,1000000'
+        )
+        parser.add_argument('--categories', type=int, default=10, help='Количество категорий')
+        parser.add_argument('--parameters', type=int, default=4, help='Количество параметров у товара')
+        parser.add_argument('--duplicates', type=float, default=0.0, help='Доля товаров с повторяющимся external_id')
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=2,
+            help='Сколько раз импортировать каждый прайс; повторные запуски замеряют импорт без изменений'
+        )
+        parser.add_argument('--format', choices=FEED_FORMATS, default='yaml', help='Формат прайса')
+        parser.add_argument(
+            '--parse-only',
+            action='store_true',
+            help='Замерять только разбор прайса, без записи в базу данных'
+        )
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Размер пачки импорта')
+        parser.add_argument('--staged', action='store_true', help='Поэтапный импорт с публикацией')
+        parser.add_argument('--copy', action='store_true', help='Загрузка параметров командой COPY (PostgreSQL)')
+        parser.add_argument(
+            '--feeds-dir',
+            type=str,
+            default=os.path.join(tempfile.gettempdir(), 'import-benchmark'),
+            help='Каталог для сгенерированных прайсов (повторно используются между запусками)'
+        )
+        parser.add_argument(
+            '--output',
+            type=str,
+            default='import_benchmark.jsonl',
+            help='Файл, в который дописываются результаты (по строке JSON на запуск)'
+        )
+
+    def handle(self, *args, **kwargs):
+        os.makedirs(kwargs['feeds_dir'], exist_ok=True)
+        feed_options = {name: kwargs[name] for name in ('categories', 'parameters', 'duplicates')}
+        feed_format = kwargs['format']
+        import_options = {'batch_size': kwargs['batch_size'], 'staged': kwargs['staged'], 'copy': kwargs['copy']}
+
+        with open(kwargs['output'], 'a', encoding='utf-8') as output:
+            for size in [int(size) for size in kwargs['sizes'].split(',')]:
+                file_path = self.generate(kwargs['feeds_dir'], size, feed_format, feed_options)
+                if not kwargs['parse_only']:
+                    self.cleanup()
+                for attempt in range(1, kwargs['repeat'] + 1):
+                    if kwargs['parse_only']:
+                        result = self.run_isolated(run_parse_case, file_path, feed_format)
+                    else:
+                        result = self.run_isolated(run_case, file_path, dict(import_options, feed_format=feed_format))
+                    result.update({
+                        'date': timezone.now().isoformat(),
+                        'database': connection.vendor,
+                        'size': size,
+                        'attempt': attempt,
+                        'format': feed_format,
+                        'parse_only': kwargs['parse_only'],
+                        **feed_options,
+                        **import_options,
+                    })
+                    output.write(json.dumps(result, ensure_ascii=False) + '\n')
+                    output.flush()
+                    self.stdout.write(
+                        f"{size} товаров, запуск {attempt}: {result['wall_time']} с, "
+                        f"{result['rows_per_second']} товаров/с, {result['peak_rss_mb']} МБ, "
+                        f"{result['queries']} запросов"
+                    )
+        self.stdout.write(self.style.SUCCESS(f"Результаты записаны в {kwargs['output']}."))
+
+    def generate(self, feeds_dir, size, feed_format, feed_options):
+        file_path = os.path.join(
+            feeds_dir,
+            'feed-{size}-{categories}-{parameters}-{duplicates}.{feed_format}'.format(
+                size=size, feed_format=feed_format, **feed_options
+            )
+        )
+        if not os.path.exists(file_path):
+            self.stdout.write(f'Генерация прайса на {size} товаров...')
+            with open(file_path, 'w', encoding='utf-8', newline='') as file:
+                write_feed(file, goods=size, shop=BENCHMARK_SHOP, feed_format=feed_format, **feed_options)
+        return file_path
+
+    def cleanup(self):
+        """Удаляет данные предыдущих замеров, чтобы первый запуск каждого размера был импортом в пустой каталог"""
+        products = Product.objects.filter(infos__shop__name=BENCHMARK_SHOP)
+        product_ids = list(products.values_list('pk', flat=True).distinct())
+        # Без сигналов карточек ORM удаляет строки без выборки, а фасеты удалённых товаров
+        # убирает одна пересборка их карточек
+        with card_signals_disconnected():
+            products.delete()
+            Shop.objects.filter(name=BENCHMARK_SHOP).delete()
+        refresh_product_cards(product_ids)
+
+    def run_isolated(self, case, *args):
+        # Дочерний процесс открывает своё подключение, поэтому подключение родителя закрывается заранее
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            return pool.submit(case, *args).result()
@@ -0,0 +1,134 @@
+import json
+import random
+import statistics
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from backend import renderers
+from backend.renderers import UJSONRenderer
+
+RENDERERS = {'json': JSONRenderer, 'ujson': UJSONRenderer}
+COLORS = ['черный', 'белый', 'синий', 'красный', 'золотистый']
+SHOPS = ['Связной', 'Евросеть', 'М.Видео', 'DNS']
+
+
+def product_page(size):
+    """Страница каталога из size карточек товаров той же структуры, что и ответ /api/products/"""
+    rng = random.Random(size)
+    results = []
+    for product_id in range(1, size + 1):
+        price = rng.randrange(1000, 150000, 10)
+        results.append({
+            'id': product_id,
+            'name': f'Смартфон Apple iPhone XR {rng.choice([64, 128, 256])}GB ({rng.choice(COLORS)})',
+            'shop': rng.choice(SHOPS),
+            'price': price,
+            'quantity': rng.randrange(0, 50),
+            'model': 'apple/iphone/xr',
+            'characteristics': {
+                'Диагональ (дюйм)': '6.1',
+                'Разрешение (пикс)': '1792x828',
+                'Встроенная память (Гб)': str(rng.choice([64, 128, 256])),
+                'Цвет': rng.choice(COLORS),
+            },
+            'offers_summary': {
+                'offers': 3,
+                'in_stock': 2,
+                'min_price': price,
+                'max_price': price + 5000,
+                'cheapest_shop': rng.choice(SHOPS),
+            },
+        })
+    return {'next': 'https://netology.local/api/products/?cursor=cD0xMDAw', 'previous': None, 'results': results}
+
+
+def order_list(size, items):
+    """Список из size заказов по items позиций той же структуры, что и ответ /api/orders/"""
+    rng = random.Random(size * items)
+    orders = []
+    for order_id in range(1, size + 1):
+        order_items = []
+        for item_id in range(items):
+            price = rng.randrange(1000, 150000, 10)
+            quantity = rng.randrange(1, 5)
+            order_items.append({
+                'id': order_id * items + item_id,
+                'product_name': f'Смартфон Samsung Galaxy S20 128GB ({rng.choice(COLORS)})',
+                'shop': rng.choice(SHOPS),
+                'price': price,
+                'quantity': quantity,
+                'total': price * quantity,
+            })
+        orders.append({'id': order_id, 'contact': rng.randrange(1, 1000), 'items': order_items, 'state': 'new'})
+    return orders
+
+
+def measure(renderer_class, data, repeat):
+    """Время рендеринга (лучшее и медиана по repeat запускам) и размер ответа"""
+    renderer = renderer_class()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = renderer.render(data)
+        timings.append(time.perf_counter() - started)
+    return body, {
+        'best_time': round(min(timings), 4),
+        'median_time': round(statistics.median(timings), 4),
+        'bytes': len(body),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        'Сравнивает время рендеринга больших ответов API (страница каталога, список заказов) '
+        'стандартным JSONRenderer и UJSONRenderer. База данных не используется.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=10000, help='Товаров на странице каталога')
+        parser.add_argument('--orders', type=int, default=2000, help='Заказов в списке')
+        parser.add_argument('--items', type=int, default=5, help='Позиций в заказе')
+        parser.add_argument('--repeat', type=int, default=10, help='Запусков рендеринга каждого ответа')
+        parser.add_argument(
+            '--output',
+            type=str,
+            default='renderer_benchmark.jsonl',
+            help='Файл, в который дописываются результаты (по строке JSON на ответ и рендерер)'
+        )
+
+    def handle(self, *args, **kwargs):
+        payloads = {
+            'products': product_page(kwargs['products']),
+            'orders': order_list(kwargs['orders'], kwargs['items']),
+        }
+        if renderers.ujson is None:
+            self.stdout.write(self.style.WARNING('ujson не установлен: UJSONRenderer работает через стандартный json.'))
+        with open(kwargs['output'], 'a', encoding='utf-8') as output:
+            for payload, data in payloads.items():
+                expected = JSONRenderer().render(data)
+                results = {}
+                for name, renderer_class in RENDERERS.items():
+                    body, result = measure(renderer_class, data, kwargs['repeat'])
+                    # Ответы обоих рендереров должны совпадать, иначе сравнение времени не имеет смысла
+                    if body != expected:
+                        raise CommandError(f'Ответ {name} для {payload} отличается от стандартного')
+                    result.update({
+                        'date': timezone.now().isoformat(),
+                        'payload': payload,
+                        'renderer': name,
+                        'ujson': renderers.ujson is not None,
+                        'products': kwargs['products'],
+                        'orders': kwargs['orders'],
+                        'items': kwargs['items'],
+                        'repeat': kwargs['repeat'],
+                    })
+                    output.write(json.dumps(result, ensure_ascii=False) + '\n')
+                    output.flush()
+                    results[name] = result
+                speedup = results['json']['best_time'] / max(results['ujson']['best_time'], 0.0001)
+                self.stdout.write(
+                    f"{payload}: {results['json']['bytes']} байт, json {results['json']['best_time']} с, "
+                    f"ujson {results['ujson']['best_time']} с, ускорение {speedup:.1f}x"
+                )
+        self.stdout.write(self.style.SUCCESS(f"Результаты записаны в {kwargs['output']}."))
@@ -0,0 +1,136 @@
+import csv
+import json
+import random
+from django.core.management.base import BaseCommand
+from backend.feeds import FEED_FORMATS
+
+BRANDS = ['Apple', 'Samsung', 'Xiaomi', 'Huawei', 'Sony', 'LG', 'Philips', 'Lenovo', 'Asus', 'Honor']
+CATEGORY_NAMES = ['Смартфоны', 'Аксессуары', 'Flash-накопители', 'Телевизоры', 'Ноутбуки', 'Планшеты', 'Наушники']
+COLORS = ['черный', 'белый', 'красный', 'синий', 'золотистый', 'серебристый', 'зеленый']
+PARAMETERS = {
+    'Диагональ (дюйм)': lambda rnd: round(rnd.uniform(4.0, 85.0), 1),
+    'Разрешение (пикс)': lambda rnd: rnd.choice(['1920x1080', '2688x1242', '1792x828', '3840x2160']),
+    'Встроенная память (Гб)': lambda rnd: rnd.choice([32, 64, 128, 256, 512]),
+    'Цвет': lambda rnd: rnd.choice(COLORS),
+    'Объем памяти (Гб)': lambda rnd: rnd.choice([8, 16, 32, 64, 128]),
+    'Смарт-ТВ': lambda rnd: rnd.choice([True, False]),
+}
+
+
+def _scalar(value):
+    # JSON-строка является корректным скаляром YAML в двойных кавычках
+    return json.dumps(value, ensure_ascii=False)
+
+
+def generate_feed(goods=10000, categories=10, parameters=4, duplicates=0.0, seed=0):
+    """
+    Возвращает список категорий, список имён параметров и генератор товаров синтетического прайса.
+    duplicates — доля товаров, повторяющих external_id одного из предыдущих товаров.
+    """
+    rnd = random.Random(seed)
+    parameter_names = list(PARAMETERS) + [f'Характеристика {i}' for i in range(max(parameters - len(PARAMETERS), 0))]
+    category_list = [
+        {'id': category_id, 'name': f'{CATEGORY_NAMES[(category_id - 1) % len(CATEGORY_NAMES)]} {category_id}'}
+        for category_id in range(1, categories + 1)
+    ]
+
+    def goods_iterator():
+        for number in range(goods):
+            external_id = number + 1
+            if number and rnd.random() < duplicates:
+                external_id = rnd.randint(1, number)
+            brand = rnd.choice(BRANDS)
+            price = rnd.randint(500, 200000)
+            good = {
+                'id': external_id,
+                'category': rnd.randint(1, categories),
+                'model': f'{brand.lower()}/series-{rnd.randint(1, 50)}/{external_id}',
+                'name': f'{brand} Модель {external_id} ({rnd.choice(COLORS)})',
+                'price': price,
+                'price_rrc': price + rnd.randint(0, price // 10),
+                'quantity': rnd.randint(0, 100),
+                'parameters': {},
+            }
+            for name in rnd.sample(parameter_names, min(parameters, len(parameter_names))):
+                generate = PARAMETERS.get(name)
+                good['parameters'][name] = generate(rnd) if generate else f'значение {rnd.randint(1, 20)}'
+            yield good
+
+    return category_list, parameter_names, goods_iterator()
+
+
+def write_feed(stream, goods=10000, categories=10, parameters=4, duplicates=0.0, shop='Benchmark', seed=0,
+               feed_format='yaml'):
+    """Записывает в stream синтетический прайс в формате feed_format (структура как в data/shop1.yaml)"""
+    category_list, parameter_names, goods_iterator = generate_feed(goods, categories, parameters, duplicates, seed)
+    writers = {'yaml': _write_yaml, 'csv': _write_csv, 'jsonl': _write_jsonl}
+    writers[feed_format](stream, shop, category_list, parameter_names, goods_iterator)
+
+
+def _write_yaml(stream, shop, category_list, parameter_names, goods):
+    stream.write(f'shop: {_scalar(shop)}\ncategories:\n')
+    for category in category_list:
+        stream.write(f"  - id: {category['id']}\n    name: {_scalar(category['name'])}\n")
+    stream.write('goods:\n')
+    for good in goods:
+        stream.write(
+            f"  - id: {good['id']}\n"
+            f"    category: {good['category']}\n"
+            f"    model: {_scalar(good['model'])}\n"
+            f"    name: {_scalar(good['name'])}\n"
+            f"    price: {good['price']}\n"
+            f"    price_rrc: {good['price_rrc']}\n"
+            f"    quantity: {good['quantity']}\n"
+            f"    parameters:\n"
+        )
+        for name, value in good['parameters'].items():
+            stream.write(f'      {_scalar(name)}: {_scalar(value)}\n')
+
+
+def _write_csv(stream, shop, category_list, parameter_names, goods):
+    # Раздела категорий в CSV нет: название категории передаётся в каждой строке
+    category_names = {category['id']: category['name'] for category in category_list}
+    writer = csv.writer(stream)
+    fields = ['id', 'category', 'model', 'name', 'price', 'price_rrc', 'quantity']
+    writer.writerow(['shop', *fields, 'category_name', *parameter_names])
+    for good in goods:
+        writer.writerow([
+            shop, *(good[field] for field in fields), category_names[good['category']],
+            *(good['parameters'].get(name, '') for name in parameter_names)
+        ])
+
+
+def _write_jsonl(stream, shop, category_list, parameter_names, goods):
+    stream.write(json.dumps({'shop': shop, 'categories': category_list}, ensure_ascii=False) + '\n')
+    for good in goods:
+        stream.write(json.dumps(good, ensure_ascii=False) + '\n')
+
+
+class Command(BaseCommand):
+    help = 'Генерирует синтетический прайс заданного размера для нагрузочного тестирования импорта'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--goods', type=int, default=10000, help='Количество товаров')
+        parser.add_argument('--categories', type=int, default=10, help='Количество категорий')
+        parser.add_argument('--parameters', type=int, default=4, help='Количество параметров у товара')
+        parser.add_argument(
+            '--duplicates',
+            type=float,
+            default=0.0,
+            help='Доля товаров с повторяющимся external_id (от 0 до 1)'
+        )
+        parser.add_argument('--shop', type=str, default='Benchmark', help='Название магазина')
+        parser.add_argument('--seed', type=int, default=0, help='Начальное значение генератора случайных чисел')
+        parser.add_argument('--format', choices=FEED_FORMATS, default='yaml', help='Формат прайса')
+        parser.add_argument('--output', type=str, help='Путь к файлу (по умолчанию вывод в stdout)')
+
+    def handle(self, *args, **kwargs):
+        options = {name: kwargs[name] for name in ('goods', 'categories', 'parameters', 'duplicates', 'shop', 'seed')}
+        options['feed_format'] = kwargs['format']
+        if not kwargs['output']:
+            write_feed(self.stdout, **options)
+            return
+
+        with open(kwargs['output'], 'w', encoding='utf-8', newline='') as file:
+            write_feed(file, **options)
+        self.stderr.write(self.style.SUCCESS(f"Прайс на {kwargs['goods']} товаров записан в {kwargs['output']}."))
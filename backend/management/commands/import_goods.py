@@ -1,137 +1,338 @@
+import glob
+import json
 import yaml
 import uuid
 import os
 from django.core.management.base import BaseCommand
 from django.db import IntegrityError
+from django.utils import timezone
 from backend.models import Category, Product, ProductInfo, ProductParameter, Shop, Parameter
+from backend.importer import (
+    DEFAULT_BATCH_SIZE, PARAMETER_TRANSLATIONS, GoodsImporter, ImportStats, MISSING_OFFER_ACTIONS,
+    file_sha256, import_feeds, save_import_run, shop_lock
+)
+from backend.feeds import FEED_FORMATS, detect_feed_format, open_feed
 
-# Словарь перевода параметров на русский язык
-PARAMETER_TRANSLATIONS = {
-    "Screen Size (inches)": "Диагональ (дюйм)",
-    "Resolution (pixels)": "Разрешение (пикс)",
-    "Internal Memory (GB)": "Встроенная память (Гб)",
-    "Color": "Цвет",
-    "Capacity (GB)": "Объем памяти (Гб)",
-    "Smart TV": "Смарт-ТВ"
-}
 
 class Command(BaseCommand):
-    help = 'Импортирует товары из YAML файла'
+    help = 'Импортирует товары из YAML, CSV или JSON Lines файла'
 
     def add_arguments(self, parser):
         parser.add_argument(
             '--file',
             type=str,
-            help='Путь к YAML файлу',
+            help='Путь к файлу прайса',
             default='data/shop1.yaml'
         )
+        parser.add_argument(
+            '--format',
+            choices=FEED_FORMATS,
+            help='Формат прайса; по умолчанию определяется по расширению файла. '
+                 'CSV и JSONL импортируются только в пакетном режиме'
+        )
+        parser.add_argument(
+            '--bulk',
+            action='store_true',
+            help='Пакетный импорт через INSERT ... ON CONFLICT вместо get_or_create на каждую строку'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=DEFAULT_BATCH_SIZE,
+            help='Количество товаров в одной транзакции пакетного импорта'
+        )
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Записывать все товары пакетного импорта, даже если они не изменились с прошлого импорта'
+        )
+        parser.add_argument(
+            '--staged',
+            action='store_true',
+            help='Загружать предложения в промежуточные таблицы и публиковать их одной транзакцией после проверки '
+                 '(включает пакетный режим)'
+        )
+        parser.add_argument(
+            '--missing',
+            choices=MISSING_OFFER_ACTIONS,
+            default='keep',
+            help='Что делать с предложениями магазина, которых нет в прайсе: оставить, '
+                 'обнулить количество (out-of-stock) или архивировать (archive); '
+                 'кроме keep, включает пакетный режим'
+        )
+        parser.add_argument(
+            '--files',
+            type=str,
+            help='Шаблон путей к файлам прайсов (например, "data/*.yaml"), импортируются в пакетном режиме'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Количество процессов для параллельного импорта файлов из --files'
+        )
+        parser.add_argument(
+            '--copy',
+            action='store_true',
+            help='Загружать параметры товаров командой COPY PostgreSQL (на других СУБД — пакетными upsert); '
+                 'включает пакетный режим'
+        )
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            help='Продолжить прерванный пакетный импорт того же файла с последней записанной пачки'
+        )
+        parser.add_argument(
+            '--json',
+            action='store_true',
+            help='Вывести отчёт о запуске (счётчики, время этапов, основные ошибки) в формате JSON'
+        )
 
     def handle(self, *args, **kwargs):
+        # Построчный вывод (каждый товар и каждая ошибка) только при --verbosity 2 и выше
+        self.verbosity = kwargs['verbosity']
+        self.json_report = kwargs['json']
+        # Параметры пакетного импорта, передаются в GoodsImporter
+        importer_options = {
+            'batch_size': kwargs['batch_size'],
+            'full': kwargs['full'],
+            'staged': kwargs['staged'],
+            'missing': kwargs['missing'],
+            'resume': kwargs['resume'],
+            'copy': kwargs['copy'],
+        }
+        if kwargs['resume'] and kwargs['staged']:
+            self.stdout.write(self.style.ERROR('Поэтапный импорт публикуется целиком и не может быть возобновлён.'))
+            return
+        if kwargs['files']:
+            self.handle_files(kwargs['files'], kwargs['workers'], dict(importer_options, feed_format=kwargs['format']))
+            return
+
         file_path = kwargs['file']
 
         if not os.path.exists(file_path):
             self.stdout.write(self.style.ERROR(f'Файл {file_path} не найден!'))
             return
 
-        with open(file_path, 'r', encoding='utf-8') as file:
-            data = yaml.safe_load(file)
+        feed_format = kwargs['format'] or detect_feed_format(file_path)
+
+        # Прайс читается потоково: товары поступают в импорт по одному, не дожидаясь разбора всего файла
+        with open(file_path, 'rb') as file:
+            try:
+                feed = open_feed(file, feed_format)
+            except (ValueError, yaml.YAMLError) as e:
+                self.stdout.write(self.style.ERROR(f'Некорректный файл {file_path}: {e}'))
+                return
+
+            # Эти параметры поддерживает только пакетный импорт, поэтому они его включают
+            bulk_only = kwargs['resume'] or kwargs['staged'] or kwargs['missing'] != 'keep' or kwargs['copy']
+            if kwargs['bulk'] or bulk_only or feed_format != 'yaml':
+                importer_options.update(source=file_path, feed_hash=file_sha256(file_path))
+                self.handle_bulk(feed.shop, feed.categories, feed, importer_options)
+            else:
+                self.handle_rows(feed.shop, feed.categories, feed, file_path)
+
+    def write_row(self, message, style):
+        if self.verbosity >= 2:
+            self.stdout.write(style(message))
+
+    def write_status(self, message, style):
+        # При выводе отчёта в JSON сообщения о ходе импорта уходят в stderr, чтобы stdout оставался JSON
+        (self.stderr if self.json_report else self.stdout).write(style(message))
 
-        shop_name = data.get('shop')
-        categories = data.get('categories', [])
-        goods = data.get('goods', [])
+    def handle_rows(self, shop_name, categories, goods, source=''):
+        started_at = timezone.now()
+        stats = ImportStats()
 
         # Создание/поиск магазина
         shop_instance, created = Shop.objects.get_or_create(name=shop_name)
         if created:
-            self.stdout.write(self.style.SUCCESS(f'Создан магазин {shop_name}.'))
+            self.write_row(f'Создан магазин {shop_name}.', self.style.SUCCESS)
         else:
-            self.stdout.write(self.style.WARNING(f'Магазин {shop_name} уже существует.'))
+            self.write_row(f'Магазин {shop_name} уже существует.', self.style.WARNING)
 
         # Импорт категорий
         category_map = {}
-        for category_data in categories:
-            category, created = Category.objects.get_or_create(
-                id=category_data['id'], defaults={'name': category_data['name']}
-            )
-            if created:
-                self.stdout.write(self.style.SUCCESS(f'Категория {category.name} добавлена.'))
-            else:
-                self.stdout.write(self.style.WARNING(f'Категория {category.name} уже существует.'))
-            category_map[category_data['id']] = category
+        with stats.timer('categories'):
+            for category_data in categories:
+                category, created = Category.objects.get_or_create(
+                    id=category_data['id'], defaults={'name': category_data['name']}
+                )
+                stats.add('Category', 'inserted' if created else 'unchanged')
+                if created:
+                    self.write_row(f'Категория {category.name} добавлена.', self.style.SUCCESS)
+                else:
+                    self.write_row(f'Категория {category.name} уже существует.', self.style.WARNING)
+                category_map[category_data['id']] = category
 
         # Проверка на дубликаты в YAML-файле
         seen_external_ids = set()
-        for product_data in goods:
-            external_id = product_data.get('id')
+        with stats.timer('rows'):
+            for product_data in goods:
+                stats.rows += 1
+                self.import_row(shop_instance, category_map, product_data, seen_external_ids, stats)
 
-            # Генерация уникального external_id, если он отсутствует
-            if not external_id:
-                external_id = str(uuid.uuid4())
+        save_import_run(shop_instance, stats, started_at, source=source)
+        self.write_stats(stats)
+        self.write_status(f'Импорт товаров из {shop_name} завершён.', self.style.SUCCESS)
 
-            if external_id in seen_external_ids:
-                self.stdout.write(self.style.ERROR(f"Дубликат external_id {external_id} найден в YAML-файле. Пропускаем этот товар."))
-                continue
-            seen_external_ids.add(external_id)
+    def import_row(self, shop_instance, category_map, product_data, seen_external_ids, stats):
+        external_id = product_data.get('id')
 
-            category = category_map.get(product_data['category'])
-            if not category:
-                self.stdout.write(self.style.ERROR(f"Категория с ID {product_data['category']} не найдена, товар пропущен."))
-                continue
+        # Генерация уникального external_id, если он отсутствует
+        if not external_id:
+            external_id = str(uuid.uuid4())
 
-            try:
-                # Импорт продукта
-                product, created = Product.objects.get_or_create(
+        if external_id in seen_external_ids:
+            stats.skipped += 1
+            stats.error(
+                f"Дубликат external_id {external_id} найден в YAML-файле. Пропускаем этот товар.",
+                kind='duplicate', sample=product_data
+            )
+            return
+        seen_external_ids.add(external_id)
+
+        category = category_map.get(product_data['category'])
+        if not category:
+            stats.skipped += 1
+            stats.error(
+                f"Категория с ID {product_data['category']} не найдена, товар пропущен.",
+                kind='category', sample=product_data
+            )
+            return
+
+        try:
+            # Импорт продукта: артикул уникален только в пределах магазина, поэтому продукт ищется через предложение
+            offer = ProductInfo.objects.filter(
+                shop=shop_instance, external_id=external_id
+            ).select_related('product').first()
+            if offer is not None:
+                product, created = offer.product, False
+            else:
+                product, created = Product.objects.create(
                     external_id=external_id,
-                    defaults={
-                        'category': category,
-                        'name': product_data['name'],
-                        'model': product_data['model'],
-                        'description': product_data.get('description', ''),
-                        'stock': product_data.get('quantity', 0),
-                        'brand': product_data.get('brand', '')
-                    }
-                )
-                if created:
-                    self.stdout.write(self.style.SUCCESS(f'Продукт {product.name} создан с external_id {external_id}.'))
-                else:
-                    self.stdout.write(self.style.WARNING(f'Продукт {product.name} уже существует с external_id {external_id}.'))
-
-                # Импорт информации о товаре
-                product_info, created = ProductInfo.objects.get_or_create(
-                    product=product,
-                    shop=shop_instance,
-                    defaults={
-                        'model': product_data['model'],
-                        'external_id': external_id,
-                        'quantity': product_data['quantity'],
-                        'price': product_data['price'],
-                        'price_rrc': product_data['price_rrc']
-                    }
-                )
-                if created:
-                    self.stdout.write(self.style.SUCCESS(f'Информация о товаре {product.name} создана.'))
-                else:
-                    self.stdout.write(self.style.WARNING(f'Информация о товаре {product.name} уже существует.'))
-
-                # Импорт параметров товара (с переводом на русский язык)
-                for param_name, param_value in product_data.get('parameters', {}).items():
-                    if param_value:  # Пропуск пустых значений параметров
-                        translated_param_name = PARAMETER_TRANSLATIONS.get(param_name, param_name)  # Перевод
-                        param, created = Parameter.objects.get_or_create(name=translated_param_name)
-                        product_param, created = ProductParameter.objects.get_or_create(
-                            product_info=product_info,
-                            parameter=param,
-                            defaults={'value': param_value}
+                    category=category,
+                    name=product_data['name'],
+                    model=product_data['model'],
+                    description=product_data.get('description', ''),
+                    quantity=product_data.get('quantity', 0),
+                    brand=product_data.get('brand', '')
+                ), True
+            stats.add('Product', 'inserted' if created else 'unchanged')
+            if created:
+                self.write_row(f'Продукт {product.name} создан с external_id {external_id}.', self.style.SUCCESS)
+            else:
+                self.write_row(f'Продукт {product.name} уже существует с external_id {external_id}.', self.style.WARNING)
+
+            # Импорт информации о товаре
+            product_info, created = ProductInfo.objects.get_or_create(
+                shop=shop_instance,
+                external_id=external_id,
+                defaults={
+                    'product': product,
+                    'model': product_data['model'],
+                    'quantity': product_data['quantity'],
+                    'price': product_data['price'],
+                    'price_rrc': product_data['price_rrc']
+                }
+            )
+            stats.add('ProductInfo', 'inserted' if created else 'unchanged')
+            if created:
+                self.write_row(f'Информация о товаре {product.name} создана.', self.style.SUCCESS)
+            else:
+                self.write_row(f'Информация о товаре {product.name} уже существует.', self.style.WARNING)
+
+            # Импорт параметров товара (с переводом на русский язык)
+            for param_name, param_value in product_data.get('parameters', {}).items():
+                if param_value:  # Пропуск пустых значений параметров
+                    translated_param_name = PARAMETER_TRANSLATIONS.get(param_name, param_name)  # Перевод
+                    param, created = Parameter.objects.get_or_create(name=translated_param_name)
+                    product_param, created = ProductParameter.objects.get_or_create(
+                        product_info=product_info,
+                        parameter=param,
+                        defaults={'value': param_value}
+                    )
+                    stats.add('ProductParameter', 'inserted' if created else 'unchanged')
+                    if created:
+                        self.write_row(
+                            f'Параметр {translated_param_name}: {param_value} добавлен для товара {product.name}.',
+                            self.style.SUCCESS
                         )
-                        if created:
-                            self.stdout.write(self.style.SUCCESS(f'Параметр {translated_param_name}: {param_value} добавлен для товара {product.name}.'))
-                        else:
-                            self.stdout.write(self.style.WARNING(f'Параметр {translated_param_name}: {param_value} для товара {product.name} уже существует.'))
+                    else:
+                        self.write_row(
+                            f'Параметр {translated_param_name}: {param_value} для товара {product.name} уже существует.',
+                            self.style.WARNING
+                        )
+
+        except IntegrityError as e:
+            stats.skipped += 1
+            stats.error(
+                f"Ошибка целостности при импорте товара {product_data['name']}: {e}",
+                kind='integrity', sample=product_data
+            )
+        except Exception as e:
+            stats.skipped += 1
+            stats.error(
+                f"Неизвестная ошибка при импорте товара {product_data['name']}: {e}",
+                kind='unknown', sample=product_data
+            )
 
-            except IntegrityError as e:
-                self.stdout.write(self.style.ERROR(f"Ошибка целостности при импорте товара {product_data['name']}: {e}"))
-            except Exception as e:
-                self.stdout.write(self.style.ERROR(f"Неизвестная ошибка при импорте товара {product_data['name']}: {e}"))
+    def handle_bulk(self, shop_name, categories, goods, importer_options):
+        with shop_lock(shop_name):
+            try:
+                stats = GoodsImporter(shop_name, **importer_options).run(categories, goods)
+            except ValueError as e:
+                self.stdout.write(self.style.ERROR(str(e)))
+                return
+        self.write_stats(stats)
+        self.write_status(f'Пакетный импорт товаров из {shop_name} завершён.', self.style.SUCCESS)
+
+    def handle_files(self, pattern, workers, importer_options):
+        file_paths = sorted(glob.glob(pattern))
+        if not file_paths:
+            self.stdout.write(self.style.ERROR(f'Файлы по шаблону {pattern} не найдены!'))
+            return
+
+        total = ImportStats()
+        for file_path, stats in import_feeds(file_paths, workers=workers, **importer_options):
+            total.merge(stats)
+            if stats.errors and not stats.models:
+                self.write_status(f'{file_path}: импорт не выполнен.', self.style.ERROR)
+            else:
+                self.write_status(f'{file_path}: импорт завершён.', self.style.SUCCESS)
 
-        self.stdout.write(self.style.SUCCESS(f'Импорт товаров из {shop_name} завершён.'))
+        self.write_status('Итого по всем файлам:', str)
+        self.write_stats(total)
+        self.write_status(f'Импорт {len(file_paths)} файлов завершён.', self.style.SUCCESS)
 
+    def write_stats(self, stats):
+        if self.json_report:
+            self.stdout.write(json.dumps(stats.report(), ensure_ascii=False, indent=2))
+            return
+
+        if self.verbosity >= 2:
+            for message in stats.errors:
+                self.stdout.write(self.style.ERROR(message))
+        else:
+            report = stats.report()
+            for group in report['top_errors']:
+                self.stdout.write(self.style.ERROR(f"{group['message']} (всего таких ошибок: {group['count']})"))
+            if report['errors_total']:
+                self.stdout.write(f"Всего ошибок: {report['errors_total']}; все ошибки выводятся при --verbosity 2.")
+        for model_name, counters in stats.models.items():
+            line = (
+                f"{model_name}: добавлено {counters['inserted']}, "
+                f"обновлено {counters['updated']}, без изменений {counters['unchanged']}"
+            )
+            if counters['deleted']:
+                line += f", удалено {counters['deleted']}"
+            self.stdout.write(line)
+        if stats.resumed:
+            self.stdout.write(f'Пропущено товаров, записанных до контрольной точки: {stats.resumed}')
+        if stats.skipped:
+            self.stdout.write(self.style.WARNING(f'Пропущено товаров: {stats.skipped}'))
+        if stats.deactivated:
+            self.stdout.write(self.style.WARNING(f'Снято с продажи предложений, отсутствующих в прайсе: {stats.deactivated}'))
+        if stats.timings:
+            timings = ', '.join(f'{stage} {seconds:.2f} с' for stage, seconds in stats.timings.items())
+            self.stdout.write(f'Время этапов: {timings}')
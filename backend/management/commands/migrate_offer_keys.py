@@ -0,0 +1,97 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Count
+from backend.models import Product, ProductInfo
+
+OFFER_KEY_CONSTRAINT = 'unique_shop_external_id'
+
+
+def _unique_column_constraints(model, column):
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, model._meta.db_table)
+    return [
+        name for name, info in constraints.items()
+        if info['unique'] and not info['primary_key'] and info['columns'] == [column]
+    ]
+
+
+def _has_constraint(model, name):
+    with connection.cursor() as cursor:
+        return name in connection.introspection.get_constraints(cursor, model._meta.db_table)
+
+
+def _field_with(model, name, **changes):
+    """Копия поля модели с изменёнными параметрами — прежнее состояние поля для alter_field"""
+    field = model._meta.get_field(name)
+    _, _, args, kwargs = field.deconstruct()
+    kwargs.update(changes)
+    old_field = field.__class__(*args, **kwargs)
+    old_field.set_attributes_from_name(name)
+    old_field.model = model
+    return old_field
+
+
+class Command(BaseCommand):
+    help = (
+        'Переводит существующую базу на артикулы предложений в пределах магазина: заполняет пустые '
+        'ProductInfo.external_id, снимает глобальную уникальность external_id и создаёт уникальный индекс '
+        '(shop, external_id). Повторный запуск ничего не меняет.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Только показать, что будет изменено')
+
+    def handle(self, *args, **kwargs):
+        dry_run = kwargs['dry_run']
+
+        blank = ProductInfo.objects.filter(external_id='').select_related('product')
+        self.stdout.write(f'Предложений без артикула: {blank.count()}')
+        if not dry_run:
+            self.fill_blank_external_ids(blank)
+
+        duplicates = list(
+            ProductInfo.objects.exclude(external_id='').values('shop_id', 'external_id')
+            .annotate(offers=Count('id')).filter(offers__gt=1)[:20]
+        )
+        if duplicates:
+            for row in duplicates:
+                self.stdout.write(self.style.ERROR(
+                    f"Магазин {row['shop_id']}: артикул {row['external_id']} у {row['offers']} предложений"
+                ))
+            self.stdout.write(self.style.ERROR('Устраните повторяющиеся артикулы и запустите команду снова.'))
+            return
+
+        changes = []
+        for model in (Product, ProductInfo):
+            if _unique_column_constraints(model, model._meta.get_field('external_id').column):
+                changes.append((f'Снятие глобальной уникальности {model.__name__}.external_id', model))
+        if not _has_constraint(ProductInfo, OFFER_KEY_CONSTRAINT):
+            changes.append(('Создание уникального индекса (shop, external_id)', None))
+
+        for description, _ in changes:
+            self.stdout.write(description)
+        if dry_run or not changes:
+            self.stdout.write(self.style.SUCCESS('Изменения схемы не требуются.' if not changes else 'Пробный запуск.'))
+            return
+
+        with connection.schema_editor() as editor:
+            for _, model in changes:
+                if model is not None:
+                    new_field = model._meta.get_field('external_id')
+                    editor.alter_field(model, _field_with(model, 'external_id', unique=True, db_index=False), new_field)
+        # SQLite пересоздаёт таблицу при alter_field вместе с ограничениями модели, поэтому проверяем заново
+        if not _has_constraint(ProductInfo, OFFER_KEY_CONSTRAINT):
+            constraint = next(c for c in ProductInfo._meta.constraints if c.name == OFFER_KEY_CONSTRAINT)
+            with connection.schema_editor() as editor:
+                editor.add_constraint(ProductInfo, constraint)
+        self.stdout.write(self.style.SUCCESS('Артикулы предложений переведены на уникальность в пределах магазина.'))
+
+    def fill_blank_external_ids(self, offers):
+        """Пустой артикул заменяется артикулом продукта, а при совпадении в магазине — дополняется id предложения"""
+        with transaction.atomic():
+            for offer in offers.select_for_update():
+                external_id = offer.product.external_id or str(offer.pk)
+                if ProductInfo.objects.filter(shop_id=offer.shop_id, external_id=external_id).exists():
+                    external_id = f'{external_id}-{offer.pk}'
+                # update() вместо save(): не сбрасывать хэш прайса и не писать историю цен
+                ProductInfo.objects.filter(pk=offer.pk).update(external_id=external_id)
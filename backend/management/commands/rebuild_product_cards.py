@@ -0,0 +1,26 @@
+from cacheops import invalidate_model
+from django.core.management.base import BaseCommand
+from backend.catalog import CARD_BATCH_SIZE, recount_facets, refresh_product_cards
+from backend.models import FacetCount, Product, ProductCard
+
+
+class Command(BaseCommand):
+    help = (
+        'Пересобирает карточки каталога (ProductCard) и индекс фасетов для всех товаров, '
+        'затем заново считает счётчики фасетов. '
+        'Нужна один раз для существующей базы и после изменения состава карточки.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=CARD_BATCH_SIZE, help='Товаров в одной пачке')
+
+    def handle(self, *args, **kwargs):
+        # id читаются потоком по возрастанию, не загружая в память весь каталог
+        product_ids = Product.objects.order_by('pk').values_list('pk', flat=True).iterator(
+            chunk_size=kwargs['batch_size']
+        )
+        written = refresh_product_cards(product_ids, batch_size=kwargs['batch_size'])
+        recount_facets()
+        invalidate_model(ProductCard)
+        invalidate_model(FacetCount)
+        self.stdout.write(self.style.SUCCESS(f'Карточек товаров пересобрано: {written}.'))
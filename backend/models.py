@@ -1,15 +1,21 @@
+import uuid
+
 from django.contrib.auth.base_user import BaseUserManager
 from django.contrib.auth.models import AbstractUser
 from django.contrib.auth.validators import UnicodeUsernameValidator
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django_rest_passwordreset.tokens import get_token_generator
 from versatileimagefield.fields import VersatileImageField
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from .tasks import warm_image_versions
 from cacheops import invalidate_obj
 from cacheops import invalidate_model
+from cacheops.invalidation import invalidate_dict
 
 # Статусы для заказа
 STATE_CHOICES = (
@@ -22,6 +28,14 @@ STATE_CHOICES = (
     ('canceled', 'Отменен'),
 )
 
+# Статусы фонового импорта прайса
+IMPORT_STATE_CHOICES = (
+    ('pending', 'В очереди'),
+    ('running', 'Выполняется'),
+    ('done', 'Завершён'),
+    ('failed', 'Ошибка'),
+)
+
 # Типы пользователей
 USER_TYPE_CHOICES = (
     ('shop', 'Магазин'),
@@ -131,7 +145,7 @@ class Shop(models.Model):
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
         # Сброс кэша всех продуктов магазина
-        ProductInfo.objects.filter(shop=self).invalidate()
+        invalidate_dict(ProductInfo, {'shop_id': self.pk})
 
     class Meta:
         verbose_name = 'Магазин'
@@ -164,7 +178,8 @@ class Category(models.Model):
 class Product(models.Model):
     name = models.CharField(max_length=80, verbose_name='Название')
     model = models.CharField(max_length=80, verbose_name='Модель', blank=True)
-    external_id = models.CharField(max_length=255, unique=True)
+    # Артикул магазина, создавшего продукт; артикулы уникальны только в пределах магазина (см. ProductInfo)
+    external_id = models.CharField(max_length=255, db_index=True)
     brand = models.CharField(max_length=100, verbose_name='Бренд', blank=True)
     quantity = models.PositiveIntegerField(verbose_name='Количество на складе', default=0)
     category = models.ForeignKey(
@@ -215,14 +230,34 @@ class ProductInfo(models.Model):
         on_delete=models.CASCADE
     )
     model = models.CharField(max_length=255, default='')
-    external_id = models.CharField(max_length=255, unique=True, default='')
+    external_id = models.CharField(max_length=255, default='')
     quantity = models.PositiveIntegerField(default=0, verbose_name='Количество')
     price = models.PositiveIntegerField(default=0, verbose_name='Цена')
     price_rrc = models.PositiveIntegerField(default=0, verbose_name='Рекомендуемая розничная цена')
     discount = models.PositiveIntegerField(default=0, verbose_name='Скидка (%)', blank=True, null=True)
+    feed_hash = models.CharField(max_length=64, blank=True, default='', verbose_name='Хэш строки прайса')
+    is_active = models.BooleanField(default=True, verbose_name='Активно')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Загруженные значения нужны save(), чтобы записать в историю только фактические изменения.
+        # Отложенные поля (.only(), выборка при каскадном удалении) не читаются: чтение загрузило бы их
+        # новым запросом, снова через from_db
+        if set(PRICE_HISTORY_FIELDS) <= set(field_names):
+            instance._loaded_prices = instance.price_values()
+        return instance
+
+    def price_values(self):
+        return tuple(getattr(self, field, None) for field in PRICE_HISTORY_FIELDS)
 
     def save(self, *args, **kwargs):
+        # Изменённое вручную предложение не должно пропускаться следующим импортом как неизменное
+        self.feed_hash = ''
         super().save(*args, **kwargs)
+        if self.price_values() != getattr(self, '_loaded_prices', None):
+            PriceHistory.objects.create(**PriceHistory.row(self.pk, *self.price_values()))
+            self._loaded_prices = self.price_values()
         invalidate_obj(self.product)  # Сброс кэша родительского Product
 
     class Meta:
@@ -230,6 +265,8 @@ class ProductInfo(models.Model):
         verbose_name_plural = "Информационный список о продуктах"
         constraints = [
             models.UniqueConstraint(fields=['product', 'shop'], name='unique_product_info'),
+            # Артикул предложения уникален в пределах магазина; индекс (shop, external_id) используется импортом
+            models.UniqueConstraint(fields=['shop', 'external_id'], name='unique_shop_external_id'),
         ]
 
     def __str__(self):
@@ -242,6 +279,59 @@ class ProductInfo(models.Model):
             total_price -= total_price * self.discount / 100
         return total_price
 
+    @property
+    def effective_price(self):
+        """Цена единицы товара с учётом скидки, в целых рублях"""
+        return round(self.get_total_price(1))
+
+
+# Поля предложения, изменения которых сохраняются в истории цен
+PRICE_HISTORY_FIELDS = ('price', 'price_rrc', 'quantity')
+
+
+class PriceHistory(models.Model):
+    """
+    Неизменяемая история цен и остатков предложений: строка добавляется только
+    при фактическом изменении price, price_rrc или quantity. Колонка month
+    (первое число месяца) служит ключом помесячного секционирования таблицы.
+    """
+    product_info = models.ForeignKey(
+        ProductInfo,
+        verbose_name='Информация о продукте',
+        related_name='price_history',
+        on_delete=models.CASCADE
+    )
+    price = models.PositiveIntegerField(verbose_name='Цена')
+    price_rrc = models.PositiveIntegerField(verbose_name='Рекомендуемая розничная цена')
+    quantity = models.PositiveIntegerField(verbose_name='Количество')
+    changed_at = models.DateTimeField(verbose_name='Изменено', default=timezone.now)
+    month = models.DateField(verbose_name='Месяц')
+
+    class Meta:
+        verbose_name = 'Изменение цены'
+        verbose_name_plural = 'История цен'
+        ordering = ('changed_at',)
+        indexes = [
+            models.Index(fields=['product_info', 'changed_at'], name='price_history_offer_idx'),
+            models.Index(fields=['month'], name='price_history_month_idx'),
+        ]
+
+    @staticmethod
+    def row(product_info_id, price, price_rrc, quantity, changed_at=None):
+        """Значения полей строки истории; month вычисляется из changed_at"""
+        changed_at = changed_at or timezone.now()
+        return {
+            'product_info_id': product_info_id,
+            'price': price,
+            'price_rrc': price_rrc,
+            'quantity': quantity,
+            'changed_at': changed_at,
+            'month': changed_at.date().replace(day=1),
+        }
+
+    def __str__(self):
+        return f'{self.product_info_id}: {self.price} ({self.changed_at:%Y-%m-%d %H:%M})'
+
 
 class Parameter(models.Model):
     name = models.CharField(max_length=40, verbose_name='Название')
@@ -284,6 +374,131 @@ class ProductParameter(models.Model):
         return f'{self.parameter.name}: {self.value}'
 
 
+class ProductCard(models.Model):
+    """
+    Денормализованная карточка товара для каталога: готовый ответ API (payload)
+    и колонки для фильтрации и сортировки. Пересобирается при изменении товара,
+    его предложений, параметров и магазинов (см. catalog.py).
+    """
+    product = models.OneToOneField(
+        Product,
+        verbose_name='Продукт',
+        related_name='card',
+        primary_key=True,
+        on_delete=models.CASCADE
+    )
+    category = models.ForeignKey(
+        Category,
+        verbose_name='Категория',
+        related_name='cards',
+        on_delete=models.CASCADE
+    )
+    name = models.CharField(max_length=80, verbose_name='Название')
+    # Минимальная цена активных предложений со скидкой (offers_summary.min_price), в том числе без остатка;
+    # пусто, если активных предложений нет. Цена в ответе (payload) — цена лучшего предложения
+    price = models.PositiveIntegerField(verbose_name='Минимальная цена', null=True)
+    quantity = models.PositiveIntegerField(verbose_name='Доступно во всех активных предложениях', default=0)
+    payload = models.JSONField(verbose_name='Карточка')
+    # Полнотекстовый индекс (PostgreSQL, словарь russian): название, бренд, модель и описание с весами A-D
+    search_vector = SearchVectorField(verbose_name='Поисковый вектор', null=True, editable=False)
+    updated_at = models.DateTimeField(verbose_name='Обновлена', auto_now=True)
+
+    class Meta:
+        verbose_name = 'Карточка товара'
+        verbose_name_plural = 'Карточки товаров'
+        indexes = [
+            # Ключ курсорной пагинации каталога при сортировке по количеству (см. ProductCursorPagination)
+            models.Index(fields=['quantity', 'product'], name='product_card_quantity_idx'),
+            models.Index(fields=['price', 'product'], name='product_card_price_idx'),
+            GinIndex(fields=['search_vector'], name='product_card_search_idx'),
+        ]
+
+    def __str__(self):
+        return self.name
+
+
+class ProductFacet(models.Model):
+    """
+    Индекс фасетов: значение параметра у активных предложений товара, по строке
+    на (товар, параметр, значение). Строки удалённого товара убирает пересборка
+    карточек (см. catalog.py), поэтому внешний ключ на товар без ограничения в базе:
+    иначе каскадное удаление не оставило бы строк для уменьшения счётчиков FacetCount.
+    """
+    product = models.ForeignKey(
+        Product,
+        verbose_name='Продукт',
+        related_name='facets',
+        on_delete=models.DO_NOTHING,
+        db_constraint=False
+    )
+    category = models.ForeignKey(Category, verbose_name='Категория', related_name='+', on_delete=models.CASCADE)
+    parameter = models.ForeignKey(Parameter, verbose_name='Параметр', related_name='+', on_delete=models.CASCADE)
+    value = models.CharField(verbose_name='Значение', max_length=100)
+
+    class Meta:
+        verbose_name = 'Фасет товара'
+        verbose_name_plural = 'Фасеты товаров'
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'parameter', 'value'], name='unique_product_facet'),
+        ]
+        indexes = [
+            models.Index(fields=['parameter', 'value'], name='product_facet_value_idx'),
+        ]
+
+
+class FacetCount(models.Model):
+    """Число товаров категории с данным значением параметра; изменяется приращениями при пересборке фасетов"""
+    category = models.ForeignKey(Category, verbose_name='Категория', related_name='+', on_delete=models.CASCADE)
+    parameter = models.ForeignKey(Parameter, verbose_name='Параметр', related_name='+', on_delete=models.CASCADE)
+    value = models.CharField(verbose_name='Значение', max_length=100)
+    # Не PositiveIntegerField: приращение может быть отрицательным до применения к существующей строке
+    products = models.IntegerField(verbose_name='Товаров', default=0)
+
+    class Meta:
+        verbose_name = 'Счётчик фасета'
+        verbose_name_plural = 'Счётчики фасетов'
+        constraints = [
+            models.UniqueConstraint(fields=['category', 'parameter', 'value'], name='unique_facet_count'),
+        ]
+
+
+# Промежуточные таблицы поэтапного импорта: предложения и параметры прайса
+# загружаются сюда и переносятся в ProductInfo/ProductParameter одной транзакцией
+class ProductInfoStage(models.Model):
+    run = models.UUIDField(verbose_name='Запуск импорта', db_index=True)
+    shop = models.ForeignKey(Shop, verbose_name='Магазин', on_delete=models.CASCADE)
+    # Пусто для нового предложения: продукт создаётся только при публикации
+    product = models.ForeignKey(Product, verbose_name='Продукт', blank=True, null=True, on_delete=models.CASCADE)
+    # Поля продукта переносятся в Product при публикации
+    category = models.ForeignKey(Category, verbose_name='Категория', on_delete=models.CASCADE)
+    name = models.CharField(max_length=80, verbose_name='Название')
+    brand = models.CharField(max_length=100, verbose_name='Бренд', blank=True, default='')
+    description = models.TextField(verbose_name='Описание', blank=True, default='')
+    model = models.CharField(max_length=255, default='')
+    external_id = models.CharField(max_length=255, default='')
+    quantity = models.PositiveIntegerField(default=0, verbose_name='Количество')
+    price = models.PositiveIntegerField(default=0, verbose_name='Цена')
+    price_rrc = models.PositiveIntegerField(default=0, verbose_name='Рекомендуемая розничная цена')
+    feed_hash = models.CharField(max_length=64, blank=True, default='', verbose_name='Хэш строки прайса')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Предложение на публикацию'
+        verbose_name_plural = 'Предложения на публикацию'
+
+
+class ProductParameterStage(models.Model):
+    run = models.UUIDField(verbose_name='Запуск импорта', db_index=True)
+    # Предложение магазина определяется артикулом: продукта нового предложения до публикации нет
+    external_id = models.CharField(max_length=255, default='')
+    parameter = models.ForeignKey(Parameter, verbose_name='Параметр', on_delete=models.CASCADE)
+    value = models.CharField(verbose_name='Значение', max_length=100)
+
+    class Meta:
+        verbose_name = 'Параметр на публикацию'
+        verbose_name_plural = 'Параметры на публикацию'
+
+
 class Contact(models.Model):
     first_name = models.CharField(max_length=100, default='', verbose_name='Имя')
     last_name = models.CharField(max_length=100, default='', verbose_name='Фамилия')
@@ -316,13 +531,13 @@ class Order(models.Model):
     state = models.CharField(max_length=20, choices=STATE_CHOICES, verbose_name="Статус заказа")
 
     def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        invalidate_obj(self)  # Сброс кэша при изменении заказа
         previous_state = None
         if self.pk:
-            previous_state = Order.objects.get(pk=self.pk).state  # Получаем старый статус заказа
+            # Получаем старый статус заказа
+            previous_state = Order.objects.filter(pk=self.pk).values_list('state', flat=True).first()
 
         super().save(*args, **kwargs)
+        invalidate_obj(self)  # Сброс кэша при изменении заказа
 
         if previous_state and previous_state != self.state:
             send_order_update_email.delay(self.user.id)
@@ -417,6 +632,118 @@ class ConfirmEmailToken(models.Model):
         return f"Токен для {self.user.email}"
 
 
+
+# Фоновый импорт прайса, загруженного через API
+class ImportJob(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(
+        User,
+        verbose_name='Пользователь',
+        related_name='import_jobs',
+        blank=True,
+        null=True,
+        on_delete=models.SET_NULL
+    )
+    shop = models.ForeignKey(
+        Shop,
+        verbose_name='Магазин',
+        related_name='import_jobs',
+        blank=True,
+        null=True,
+        on_delete=models.SET_NULL
+    )
+    file = models.FileField(verbose_name='Файл прайса', upload_to='imports/')
+    state = models.CharField(
+        verbose_name='Статус импорта',
+        choices=IMPORT_STATE_CHOICES,
+        max_length=10,
+        default='pending'
+    )
+    total_chunks = models.PositiveIntegerField(verbose_name='Всего частей', default=0)
+    chunks_done = models.PositiveIntegerField(verbose_name='Обработано частей', default=0)
+    rows_done = models.PositiveIntegerField(verbose_name='Обработано товаров', default=0)
+    stats = models.JSONField(verbose_name='Результаты по моделям', default=dict, blank=True)
+    errors = models.JSONField(verbose_name='Ошибки', default=list, blank=True)
+    created_at = models.DateTimeField(verbose_name='Создан', auto_now_add=True)
+    started_at = models.DateTimeField(verbose_name='Начат', blank=True, null=True)
+    finished_at = models.DateTimeField(verbose_name='Завершён', blank=True, null=True)
+
+    class Meta:
+        verbose_name = 'Импорт прайса'
+        verbose_name_plural = 'Список импортов прайсов'
+        ordering = ('-created_at',)
+
+    def __str__(self):
+        return f'Импорт {self.id} ({self.get_state_display()})'
+
+
+class ImportRun(models.Model):
+    shop = models.ForeignKey(
+        Shop,
+        verbose_name='Магазин',
+        related_name='import_runs',
+        blank=True,
+        null=True,
+        on_delete=models.SET_NULL
+    )
+    source = models.CharField(verbose_name='Источник', max_length=255, blank=True)
+    options = models.JSONField(verbose_name='Параметры импорта', default=dict, blank=True)
+    success = models.BooleanField(verbose_name='Успешно', default=True)
+    rows = models.PositiveIntegerField(verbose_name='Обработано товаров', default=0)
+    duration = models.FloatField(verbose_name='Длительность, с', default=0)
+    report = models.JSONField(verbose_name='Отчёт', default=dict, blank=True)
+    started_at = models.DateTimeField(verbose_name='Начат')
+    finished_at = models.DateTimeField(verbose_name='Завершён', auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Запуск импорта'
+        verbose_name_plural = 'История импортов'
+        ordering = ('-started_at',)
+
+    def __str__(self):
+        return f'Импорт {self.source or self.shop} от {self.started_at:%Y-%m-%d %H:%M}'
+
+
+class ResourceVersion(models.Model):
+    """
+    Счётчик версии ресурса API (каталог, заказы пользователя, заказ) для ETag и Last-Modified.
+    Увеличивается при записи ресурса (см. versions.py), поэтому проверка If-None-Match
+    стоит одного чтения по первичному ключу.
+    """
+    key = models.CharField(verbose_name='Ресурс', max_length=100, primary_key=True)
+    version = models.PositiveBigIntegerField(verbose_name='Версия', default=0)
+    updated_at = models.DateTimeField(verbose_name='Изменён', default=timezone.now)
+
+    class Meta:
+        verbose_name = 'Версия ресурса'
+        verbose_name_plural = 'Версии ресурсов'
+
+    def __str__(self):
+        return f'{self.key}: {self.version}'
+
+
+class ImportCheckpoint(models.Model):
+    shop = models.ForeignKey(
+        Shop,
+        verbose_name='Магазин',
+        related_name='import_checkpoints',
+        on_delete=models.CASCADE
+    )
+    feed_hash = models.CharField(verbose_name='SHA-256 файла прайса', max_length=64)
+    offset = models.PositiveBigIntegerField(verbose_name='Записано товаров из прайса', default=0)
+    updated_at = models.DateTimeField(verbose_name='Обновлена', auto_now=True)
+
+    class Meta:
+        verbose_name = 'Контрольная точка импорта'
+        verbose_name_plural = 'Контрольные точки импорта'
+        constraints = [
+            models.UniqueConstraint(fields=['shop', 'feed_hash'], name='unique_import_checkpoint'),
+        ]
+
+    def __str__(self):
+        return f'{self.shop}: {self.offset} товаров прайса {self.feed_hash[:12]}'
+
+
 @receiver(post_save, sender=User)
 def warm_user_avatar(sender, instance, **kwargs):
     if instance.avatar:
@@ -428,3 +755,47 @@ def warm_product_image(sender, instance, **kwargs):
     if instance.image:
         warm_image_versions.delay(instance.id, 'product')
 
+
+
+# Пересборка карточек каталога после изменений через ORM; импорт пересобирает карточки сам
+@receiver([post_save, post_delete], sender=Product)
+def refresh_product_card(sender, instance, **kwargs):
+    from .catalog import schedule_card_refresh
+    # После удаления ORM обнуляет pk экземпляра, поэтому id запоминается сразу
+    product_id = instance.pk
+    schedule_card_refresh(lambda: [product_id])
+
+
+@receiver([post_save, post_delete], sender=ProductInfo)
+def refresh_offer_product_card(sender, instance, **kwargs):
+    from .catalog import schedule_card_refresh
+    schedule_card_refresh(lambda: [instance.product_id])
+
+
+@receiver([post_save, post_delete], sender=ProductParameter)
+def refresh_parameter_product_card(sender, instance, **kwargs):
+    from .catalog import schedule_card_refresh
+    schedule_card_refresh(
+        lambda: ProductInfo.objects.filter(pk=instance.product_info_id).values_list('product_id', flat=True)
+    )
+
+
+@receiver(post_save, sender=Shop)
+def refresh_shop_product_cards(sender, instance, **kwargs):
+    from .catalog import schedule_card_refresh
+    schedule_card_refresh(
+        lambda: ProductInfo.objects.filter(shop_id=instance.pk).values_list('product_id', flat=True).distinct()
+    )
+
+
+# Версии заказов для условных GET; версия каталога увеличивается при пересборке карточек
+@receiver([post_save, post_delete], sender=Order)
+def bump_order_versions(sender, instance, **kwargs):
+    from .versions import bump_versions, order_key, orders_key
+    bump_versions(orders_key(instance.user_id), order_key(instance.pk))
+
+
+@receiver([post_save, post_delete], sender=OrderItem)
+def bump_order_item_versions(sender, instance, **kwargs):
+    from .versions import bump_versions, order_key, orders_key
+    bump_versions(orders_key(instance.order.user_id), order_key(instance.order_id))
@@ -0,0 +1,41 @@
+"""
+Быстрый JSON-парсер тела запроса на ujson.
+
+ujson принимает NaN и Infinity, которые стандартный парсер при STRICT_JSON
+отклоняет, поэтому такие тела, как и тела, которые ujson разобрать не смог,
+разбираются стандартным JSONParser: результат и сообщения об ошибках
+совпадают с DRF. Без ujson парсер работает как JSONParser.
+"""
+import io
+import re
+
+from django.conf import settings
+from rest_framework.parsers import JSONParser
+
+from .renderers import UJSONRenderer
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+NON_FINITE = re.compile(rb'NaN|Infinity')
+
+
+class UJSONParser(JSONParser):
+    """JSONParser, разбирающий тело запроса через ujson с откатом на стандартный json"""
+    renderer_class = UJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        if ujson is None:
+            return super().parse(stream, media_type, parser_context)
+
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        body = stream.read()
+        if not (self.strict and NON_FINITE.search(body)):
+            try:
+                return ujson.loads(body.decode(encoding))
+            except ValueError:
+                pass
+        return super().parse(io.BytesIO(body), media_type, parser_context)
@@ -0,0 +1,85 @@
+"""
+Загрузка строк в PostgreSQL командой COPY FROM STDIN.
+
+Строки передаются в базу одним потоком в формате CSV, без разбора
+INSERT-запроса на каждую пачку. Для обновления существующих строк данные
+сначала копируются во временную таблицу сеанса и затем переносятся одним
+INSERT ... SELECT ... ON CONFLICT DO UPDATE, который пропускает строки
+без изменений и возвращает количество добавленных и обновлённых строк.
+На других СУБД copy_supported() возвращает False, и вызывающий код
+использует обычные пакетные upsert-запросы.
+"""
+import csv
+import io
+
+from django.db import connection, transaction
+
+
+def copy_supported():
+    return connection.vendor == 'postgresql'
+
+
+def _columns(model, attnames):
+    opts = model._meta
+    return [opts.get_field(attname).column for attname in attnames]
+
+
+def _copy(cursor, table, columns, rows):
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerows(rows)
+    buffer.seek(0)
+    # NULL задаётся явно, чтобы пустая строка в CSV оставалась пустой строкой
+    cursor.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer
+    )
+
+
+def copy_rows(model, rows, attnames):
+    """Добавляет строки (словари attname -> значение) в таблицу модели командой COPY"""
+    quote_name = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        _copy(
+            cursor,
+            quote_name(model._meta.db_table),
+            [quote_name(column) for column in _columns(model, attnames)],
+            ([row[attr] for attr in attnames] for row in rows)
+        )
+
+
+def copy_upsert(model, rows, key_attrs, value_attrs):
+    """
+    Записывает строки (словари attname -> значение) через COPY во временную таблицу
+    и INSERT ... ON CONFLICT (key_attrs) DO UPDATE. Возвращает (добавлено, обновлено).
+    """
+    if not rows:
+        return 0, 0
+    quote_name = connection.ops.quote_name
+    table = quote_name(model._meta.db_table)
+    temp_table = quote_name(f'import_copy_{model._meta.db_table}')
+    keys = [quote_name(column) for column in _columns(model, key_attrs)]
+    values = [quote_name(column) for column in _columns(model, value_attrs)]
+    columns = ', '.join(keys + values)
+    assignments = ', '.join(f'{column} = EXCLUDED.{column}' for column in values)
+    current = ', '.join(f't.{column}' for column in values)
+    excluded = ', '.join(f'EXCLUDED.{column}' for column in values)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        # Структура временной таблицы повторяет нужные колонки основной, без ограничений и значений по умолчанию
+        cursor.execute(
+            f'CREATE TEMPORARY TABLE IF NOT EXISTS {temp_table} AS SELECT {columns} FROM {table} WITH NO DATA'
+        )
+        _copy(cursor, temp_table, keys + values, ([row[attr] for attr in (*key_attrs, *value_attrs)] for row in rows))
+        # ORDER BY делает выбор строки среди повторов ключа детерминированным, а вставку — в порядке ключей,
+        # поэтому параллельные импорты блокируют строки в одном порядке
+        cursor.execute(
+            f'WITH merged AS ('
+            f'INSERT INTO {table} AS t ({columns}) '
+            f"SELECT DISTINCT ON ({', '.join(keys)}) {columns} FROM {temp_table} ORDER BY {columns} "
+            f"ON CONFLICT ({', '.join(keys)}) DO UPDATE SET {assignments} "
+            f'WHERE ROW({current}) IS DISTINCT FROM ROW({excluded}) '
+            f'RETURNING (xmax = 0) AS inserted'
+            f') SELECT COUNT(*) FILTER (WHERE inserted), COUNT(*) FILTER (WHERE NOT inserted) FROM merged'
+        )
+        inserted, updated = cursor.fetchone()
+        cursor.execute(f'TRUNCATE {temp_table}')
+    return inserted, updated
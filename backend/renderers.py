@@ -0,0 +1,104 @@
+"""
+Быстрый JSON-рендерер API на ujson.
+
+Ответ совпадает с ответом стандартного JSONRenderer DRF: типы, которых нет
+в JSON (datetime, date, time, timedelta, UUID, ленивые строки перевода,
+QuerySet, множества), преобразуются тем же rest_framework.encoders.JSONEncoder,
+Decimal кодируется числом, символы U+2028 и U+2029 экранируются, отступ
+берётся из Accept (application/json; indent=4) или контекста рендерера.
+
+Если ujson не установлен, включены некомпактные разделители (COMPACT_JSON)
+или ujson не может закодировать значение (NaN при STRICT_JSON, целые вне
+диапазона), ответ строится стандартным рендерером.
+
+Рендереры выгрузки (NDJSON и CSV) кодируют строки пачками: метод stream
+принимает итератор пачек строк и отдаёт байты по одной пачке, поэтому
+выгрузка через StreamingHttpResponse не держит весь ответ в памяти.
+"""
+import csv
+import io
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class UJSONRenderer(JSONRenderer):
+    """JSONRenderer, кодирующий ответ через ujson с откатом на стандартный json"""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if ujson is None or not self.compact:
+            return super().render(data, accepted_media_type, renderer_context)
+        if data is None:
+            return b''
+
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        try:
+            ret = ujson.dumps(
+                data,
+                ensure_ascii=self.ensure_ascii,
+                escape_forward_slashes=False,
+                allow_nan=not self.strict,
+                reject_bytes=False,
+                indent=indent or 0,
+                default=self.encoder_class().default,
+            )
+        except (OverflowError, TypeError):
+            return super().render(data, accepted_media_type, renderer_context)
+
+        # Как и JSONRenderer, экранируем разделители строк, чтобы ответ оставался подмножеством JavaScript
+        return ret.replace('\u2028', '\\u2028').replace('\u2029', '\\u2029').encode()
+
+
+class NDJSONRenderer(BaseRenderer):
+    """JSON Lines: по объекту JSON на строку"""
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return b''.join(self.stream([data if isinstance(data, list) else [data]]))
+
+    def stream(self, batches, fields=None):
+        renderer = UJSONRenderer()
+        for rows in batches:
+            yield b''.join(renderer.render(row) + b'\n' for row in rows)
+
+
+class CSVRenderer(BaseRenderer):
+    """
+    CSV с заголовком из имён полей; вложенные значения (характеристики,
+    предложения) записываются в ячейку строкой JSON
+    """
+    media_type = 'text/csv'
+    format = 'csv'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        rows = data if isinstance(data, list) else [data]
+        return b''.join(self.stream([rows], list(rows[0]) if rows else []))
+
+    def stream(self, batches, fields):
+        renderer = UJSONRenderer()
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        writer.writerow(fields)
+        for rows in batches:
+            for row in rows:
+                writer.writerow([
+                    renderer.render(value).decode() if isinstance(value, (dict, list)) else value
+                    for value in (row.get(field) for field in fields)
+                ])
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+        # Пустая выгрузка состоит из одного заголовка
+        if buffer.tell():
+            yield buffer.getvalue().encode()
@@ -1,12 +1,70 @@
 from rest_framework import serializers
 from drf_spectacular.utils import extend_schema_field
 from typing import Optional
+from django.utils import timezone
+from django.db.models import Prefetch, prefetch_related_objects
+from django.db.models.fields.json import KeyTransform
 
 from .models import (
     User as CustomUser, Shop, Category, Product, ProductInfo,
-    Parameter, ProductParameter, Contact, Order, OrderItem, ConfirmEmailToken
+    Parameter, ProductParameter, Contact, Order, OrderItem, ConfirmEmailToken, ImportJob, PriceHistory
 )
 
+def parse_field_paths(value):
+    """Разбирает список полей через запятую в дерево: 'id,items.total' -> {'id': {}, 'items': {'total': {}}}"""
+    tree = {}
+    for path in value.split(','):
+        node = tree
+        for name in filter(None, (part.strip() for part in path.split('.'))):
+            node = node.setdefault(name, {})
+    return tree
+
+class SelectableFieldsMixin:
+    """
+    Выбор полей ответа параметрами запроса ?fields= и ?expand=.
+    fields — нужные поля через запятую (без параметра выводятся все поля Meta.fields),
+    expand — поля из Meta.expandable_fields: без него они не выводятся или выводятся ссылкой.
+    Поля вложенных сериализаторов задаются через точку: ?fields=id,items.total&expand=items.product.
+    Вне запроса поля передаются аргументами fields и expand конструктора.
+    Выбранные поля (self.fields) передаются в setup_eager_loading, чтобы запрос загружал только их.
+    """
+
+    def __init__(self, *args, fields=None, expand=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._requested_fields = None
+        if fields is not None or expand is not None:
+            self._requested_fields = (parse_field_paths(fields or ''), parse_field_paths(expand or ''))
+
+    def get_requested_fields(self):
+        """Поддеревья fields и expand для этого сериализатора по пути полей от корня"""
+        path = []
+        node, requested = self, None
+        while node is not None:
+            requested = getattr(node, '_requested_fields', None)
+            if requested is not None:
+                break
+            if node.field_name:
+                path.insert(0, node.field_name)
+            node = node.parent
+        if requested is None:
+            request = self.context.get('request')
+            params = getattr(request, 'query_params', {})
+            requested = (parse_field_paths(params.get('fields', '')), parse_field_paths(params.get('expand', '')))
+        fields, expand = requested
+        for name in path:
+            fields, expand = fields.get(name, {}), expand.get(name, {})
+        return fields, expand
+
+    def get_fields(self):
+        fields = super().get_fields()
+        requested, expand = self.get_requested_fields()
+        for name, (field_class, kwargs) in getattr(self.Meta, 'expandable_fields', {}).items():
+            if name in expand:
+                fields[name] = field_class(**kwargs)
+        if requested:
+            fields = {name: field for name, field in fields.items() if name in requested or name in expand}
+        return fields
+
 class LoginSerializer(serializers.Serializer):
     email = serializers.EmailField(required=True, label="Email")
     password = serializers.CharField(required=True, write_only=True, label="Пароль")
@@ -42,45 +100,154 @@ class CategorySerializer(serializers.ModelSerializer):
         fields = ['id', 'name', 'shops']
         read_only_fields = ['id']
 
-class ProductSerializer(serializers.ModelSerializer):
+class OffersSummarySerializer(serializers.Serializer):
+    offers = serializers.IntegerField(help_text='Активных предложений')
+    in_stock = serializers.IntegerField(help_text='Предложений в наличии')
+    min_price = serializers.IntegerField(allow_null=True, help_text='Минимальная цена со скидкой')
+    max_price = serializers.IntegerField(allow_null=True, help_text='Максимальная цена со скидкой')
+    cheapest_shop = serializers.CharField(allow_null=True, help_text='Магазин с минимальной ценой')
+
+class ProductOfferSerializer(serializers.ModelSerializer):
+    shop = serializers.CharField(source='shop.name', read_only=True)
+    effective_price = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = ProductInfo
+        fields = ['id', 'shop', 'model', 'price', 'discount', 'effective_price', 'price_rrc', 'quantity']
+
+class ProductSerializer(SelectableFieldsMixin, serializers.ModelSerializer):
+    """
+    Товар каталога с данными лучшего предложения и характеристиками.
+    Предложения, магазины и параметры читаются из кэша prefetch_related (см. setup_eager_loading),
+    поэтому страница каталога любого размера загружается фиксированным числом запросов.
+    Раскрываемое поле offers — список активных предложений от самого дешёвого.
+    """
+    # Поля, для которых нужны предложения товара
+    offer_fields = {'shop', 'price', 'quantity', 'model', 'offers_summary', 'offers'}
+
     shop = serializers.SerializerMethodField()
     price = serializers.SerializerMethodField()
     quantity = serializers.SerializerMethodField()
     model = serializers.SerializerMethodField()
     characteristics = serializers.SerializerMethodField()
+    offers_summary = serializers.SerializerMethodField()
 
     class Meta:
         model = Product
-        fields = ['id', 'name', 'shop', 'price', 'quantity', 'model', 'characteristics']
+        fields = ['id', 'name', 'shop', 'price', 'quantity', 'model', 'characteristics', 'offers_summary']
+        expandable_fields = {'offers': (serializers.SerializerMethodField, {})}
+
+    @staticmethod
+    def offers_prefetch(characteristics=True):
+        queryset = ProductInfo.objects.select_related('shop').order_by('id')
+        if characteristics:
+            queryset = queryset.prefetch_related(
+                Prefetch('product_parameters', queryset=ProductParameter.objects.select_related('parameter').order_by('id'))
+            )
+        return Prefetch('infos', queryset=queryset)
+
+    @classmethod
+    def setup_eager_loading(cls, queryset, fields=None):
+        """Предзагрузка для выбранных полей (по умолчанию — всех): без предложений и параметров, если они не нужны"""
+        fields = set(cls.Meta.fields if fields is None else fields)
+        if fields & cls.offer_fields or 'characteristics' in fields:
+            queryset = queryset.prefetch_related(cls.offers_prefetch(characteristics='characteristics' in fields))
+        return queryset
+
+    def _offers(self, obj):
+        # Товар без предзагрузки (например, вложенный в ProductInfoSerializer) догружается теми же запросами
+        if 'infos' not in getattr(obj, '_prefetched_objects_cache', {}):
+            prefetch_related_objects([obj], self.offers_prefetch())
+        return obj.infos.all()
+
+    def _best_offer(self, obj) -> Optional[ProductInfo]:
+        """Лучшее предложение товара: активное, в наличии и с минимальной ценой со скидкой"""
+        offers = [offer for offer in self._offers(obj) if offer.is_active]
+        return min(offers, key=lambda offer: (offer.quantity == 0, offer.effective_price, offer.pk), default=None)
 
     @extend_schema_field(serializers.CharField(allow_null=True))
     def get_shop(self, obj) -> Optional[str]:
-        product_info = obj.infos.first()
+        product_info = self._best_offer(obj)
         return product_info.shop.name if product_info else None
 
     @extend_schema_field(serializers.IntegerField(allow_null=True))
     def get_price(self, obj) -> Optional[int]:
-        product_info = obj.infos.first()
-        return product_info.price if product_info else None
+        product_info = self._best_offer(obj)
+        return product_info.effective_price if product_info else None
 
     @extend_schema_field(serializers.IntegerField(allow_null=True))
     def get_quantity(self, obj) -> Optional[int]:
-        product_info = obj.infos.first()
+        product_info = self._best_offer(obj)
         return product_info.quantity if product_info else 0
 
     @extend_schema_field(serializers.CharField(allow_null=True))
     def get_model(self, obj) -> Optional[str]:
-        product_info = obj.infos.first()
+        product_info = self._best_offer(obj)
         return product_info.model if product_info else None
 
+    @extend_schema_field(OffersSummarySerializer)
+    def get_offers_summary(self, obj) -> dict:
+        """Сводка по активным предложениям всех магазинов для сравнения цен"""
+        offers = [offer for offer in self._offers(obj) if offer.is_active]
+        cheapest = min(offers, key=lambda offer: (offer.effective_price, offer.pk), default=None)
+        return {
+            'offers': len(offers),
+            'in_stock': sum(1 for offer in offers if offer.quantity),
+            'min_price': cheapest.effective_price if cheapest else None,
+            'max_price': max((offer.effective_price for offer in offers), default=None),
+            'cheapest_shop': cheapest.shop.name if cheapest else None,
+        }
+
+    @extend_schema_field(ProductOfferSerializer(many=True))
+    def get_offers(self, obj) -> list:
+        offers = [offer for offer in self._offers(obj) if offer.is_active]
+        offers.sort(key=lambda offer: (offer.effective_price, offer.pk))
+        return ProductOfferSerializer(offers, many=True).data
+
     @extend_schema_field(serializers.DictField(child=serializers.CharField()))
     def get_characteristics(self, obj) -> dict[str, str]:
         params = {}
-        for product_param in ProductParameter.objects.filter(product_info__product=obj):
-            params[product_param.parameter.name] = product_param.value
+        for product_info in self._offers(obj):
+            for product_param in product_info.product_parameters.all():
+                params[product_param.parameter.name] = product_param.value
         return params
 
-class OrderItemSerializer(serializers.ModelSerializer):
+class ProductCardSerializer(ProductSerializer):
+    """
+    Товар каталога из готовой карточки (ProductCard); схема ответа совпадает с ProductSerializer.
+    При выборе полей (?fields=) из payload карточки читаются только выбранные ключи.
+    """
+    payload_prefix = 'payload_'
+
+    @classmethod
+    def setup_eager_loading(cls, queryset, fields=None):
+        fields = set(cls.Meta.fields if fields is None else fields)
+        payload_fields = fields & set(cls.Meta.fields)
+        if payload_fields != set(cls.Meta.fields):
+            queryset = queryset.defer('payload').annotate(**{
+                cls.payload_prefix + name: KeyTransform(name, 'payload') for name in payload_fields
+            })
+        if 'offers' in fields:
+            queryset = queryset.prefetch_related(Prefetch(
+                'product', queryset=Product.objects.only('id').prefetch_related(cls.offers_prefetch(characteristics=False))
+            ))
+        return queryset
+
+    def get_offers(self, obj) -> list:
+        return super().get_offers(obj.product)
+
+    def to_representation(self, instance):
+        if 'payload' in instance.get_deferred_fields():
+            payload = {name: getattr(instance, self.payload_prefix + name, None) for name in self.Meta.fields}
+        else:
+            payload = instance.payload
+        return {
+            name: payload.get(name) if name in self.Meta.fields else field.to_representation(field.get_attribute(instance))
+            for name, field in self.fields.items()
+        }
+
+class OrderItemSerializer(SelectableFieldsMixin, serializers.ModelSerializer):
+    """Позиция заказа; раскрываемое поле product — карточка товара каталога"""
     product_name = serializers.CharField(source='product_info.product.name', read_only=True)
     shop = serializers.CharField(source='product_info.shop.name', read_only=True)
     price = serializers.IntegerField(source='product_info.price', read_only=True)
@@ -89,6 +256,25 @@ class OrderItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = OrderItem
         fields = ['id', 'product_name', 'shop', 'price', 'quantity', 'total']
+        expandable_fields = {
+            'product': (ProductCardSerializer, {'source': 'product_info.product.card', 'read_only': True}),
+        }
+
+    @classmethod
+    def setup_eager_loading(cls, queryset, fields=None):
+        """JOIN только тех связанных таблиц, которые нужны выбранным полям"""
+        fields = set(cls.Meta.fields if fields is None else fields)
+        related = set()
+        if fields & {'price', 'total'}:
+            related.add('product_info')
+        if 'product_name' in fields:
+            related.add('product_info__product')
+        if 'shop' in fields:
+            related.add('product_info__shop')
+        if 'product' in fields:
+            related.add('product_info__product__card')
+            queryset = queryset.defer('product_info__product__card__search_vector')
+        return queryset.select_related(*related)
 
     @extend_schema_field(serializers.IntegerField())
     def get_total(self, obj) -> int:
@@ -113,6 +299,11 @@ class ProductInfoSerializer(serializers.ModelSerializer):
         fields = ['id', 'product', 'shop', 'quantity', 'price', 'price_rrc']
         read_only_fields = ['id']
 
+class PriceHistorySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PriceHistory
+        fields = ['changed_at', 'price', 'price_rrc', 'quantity']
+
 class ParameterSerializer(serializers.ModelSerializer):
     class Meta:
         model = Parameter
@@ -136,13 +327,30 @@ class ContactSerializer(serializers.ModelSerializer):
         ]
 
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(SelectableFieldsMixin, serializers.ModelSerializer):
+    """Заказ с позициями; раскрываемое поле contact — адрес доставки вместо его id"""
     items = OrderItemSerializer(many=True)  # Добавить
     contact = serializers.PrimaryKeyRelatedField(queryset=Contact.objects.all())  # Изменить
 
     class Meta:
         model = Order
         fields = ['id', 'contact', 'items', 'state']  # Обновить
+        expandable_fields = {'contact': (ContactSerializer, {'read_only': True})}
+
+    @classmethod
+    def setup_eager_loading(cls, queryset, fields=None):
+        """
+        Загрузка заказов для выбранных полей: позиции предзагружаются одним запросом
+        только при выводе items, адрес — JOIN только при ?expand=contact
+        """
+        fields = cls().fields if fields is None else fields
+        if isinstance(fields.get('contact'), ContactSerializer):
+            queryset = queryset.select_related('contact')
+        if 'items' in fields:
+            queryset = queryset.prefetch_related(Prefetch('items', queryset=OrderItemSerializer.setup_eager_loading(
+                OrderItem.objects.order_by('id'), fields['items'].child.fields
+            )))
+        return queryset
 
     def create(self, validated_data):
         items_data = validated_data.pop('items')
@@ -156,3 +364,26 @@ class ConfirmEmailTokenSerializer(serializers.ModelSerializer):
         model = ConfirmEmailToken
         fields = ['id', 'user', 'created_at', 'key']
         read_only_fields = ['id', 'created_at', 'key']
+
+class ImportJobSerializer(serializers.ModelSerializer):
+    shop = serializers.CharField(source='shop.name', read_only=True, allow_null=True)
+    rows_per_second = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ImportJob
+        fields = [
+            'id', 'file', 'shop', 'state', 'total_chunks', 'chunks_done', 'rows_done',
+            'rows_per_second', 'stats', 'errors', 'created_at', 'started_at', 'finished_at'
+        ]
+        read_only_fields = [
+            'id', 'state', 'total_chunks', 'chunks_done', 'rows_done',
+            'stats', 'errors', 'created_at', 'started_at', 'finished_at'
+        ]
+        extra_kwargs = {'file': {'write_only': True}}
+
+    @extend_schema_field(serializers.FloatField(allow_null=True))
+    def get_rows_per_second(self, obj) -> Optional[float]:
+        if not obj.started_at:
+            return None
+        elapsed = ((obj.finished_at or timezone.now()) - obj.started_at).total_seconds()
+        return round(obj.rows_done / elapsed, 1) if elapsed > 0 else None
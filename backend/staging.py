@@ -0,0 +1,158 @@
+"""
+Поэтапная публикация прайса магазина.
+
+Предложения вместе с полями их продуктов и параметры сначала загружаются
+в ProductInfoStage и ProductParameterStage, проверяются там и затем одной
+короткой транзакцией переносятся в Product, ProductInfo и ProductParameter
+(предложения и параметры — запросами INSERT ... SELECT ... ON CONFLICT).
+Каталог видит либо прежнюю, либо новую версию предложений магазина, а
+неудачный импорт не затрагивает живые таблицы.
+"""
+from django.db import connection, transaction
+from django.db.models import Count
+
+from .models import PriceHistory, ProductInfo, ProductInfoStage, ProductParameter, ProductParameterStage
+
+
+def _tables():
+    quote_name = connection.ops.quote_name
+    return {
+        'info': quote_name(ProductInfo._meta.db_table),
+        'param': quote_name(ProductParameter._meta.db_table),
+        'info_stage': quote_name(ProductInfoStage._meta.db_table),
+        'param_stage': quote_name(ProductParameterStage._meta.db_table),
+        'history': quote_name(PriceHistory._meta.db_table),
+    }
+
+
+def _run_param(run_id):
+    # UUID хранится по-разному в разных СУБД, поэтому приводим его так же, как ORM
+    return ProductInfoStage._meta.get_field('run').get_db_prep_value(run_id, connection)
+
+
+def price_history_params():
+    """Время изменения и месяц для строк истории цен, добавляемых SQL-запросом"""
+    row = PriceHistory.row(None, None, None, None)
+    return [
+        PriceHistory._meta.get_field(field).get_db_prep_value(row[field], connection)
+        for field in ('changed_at', 'month')
+    ]
+
+
+def validate_stage(run_id):
+    """Проверяет загруженные предложения; возвращает список найденных проблем"""
+    problems = []
+    offers = ProductInfoStage.objects.filter(run=run_id)
+    zero_priced = offers.filter(price=0).count()
+    if zero_priced:
+        problems.append(f'предложений с нулевой ценой: {zero_priced}')
+    # Продукты новых предложений создаются при публикации, поэтому повторяться могут только существующие
+    duplicated = offers.exclude(product=None).values('product').annotate(offers=Count('id'))
+    duplicated = duplicated.filter(offers__gt=1).count()
+    if duplicated:
+        problems.append(f'продуктов с несколькими предложениями: {duplicated}')
+    return problems
+
+
+def discard_stage(run_id):
+    """Удаляет данные одного запуска из промежуточных таблиц"""
+    ProductParameterStage.objects.filter(run=run_id).delete()
+    ProductInfoStage.objects.filter(run=run_id).delete()
+
+
+def discard_stale_stage(shop):
+    """Удаляет данные прерванных запусков магазина (вызывается под блокировкой магазина)"""
+    runs = ProductInfoStage.objects.filter(shop=shop).values('run')
+    ProductParameterStage.objects.filter(run__in=runs).delete()
+    ProductInfoStage.objects.filter(shop=shop).delete()
+
+
+def publish_stage(shop, run_id):
+    """
+    Переносит предложения и параметры запуска в живые таблицы одной транзакцией.
+    Продукты предложений к этому моменту должны быть записаны (ProductInfoStage.product заполнен).
+    Параметры опубликованных предложений заменяются набором из прайса.
+    Изменения цены и количества, а также новые предложения записываются в историю цен.
+    Возвращает количество добавленных и обновлённых предложений и параметров.
+    """
+    tables = _tables()
+    run = _run_param(run_id)
+    history_params = price_history_params()
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT COUNT(*) FROM {info_stage} s WHERE s.run = %s AND EXISTS ('
+            'SELECT 1 FROM {info} i WHERE i.shop_id = s.shop_id AND i.external_id = s.external_id)'.format(**tables),
+            [run]
+        )
+        offers_existing = cursor.fetchone()[0]
+        # История пишется до публикации, пока в живой таблице прежние цены
+        cursor.execute(
+            'INSERT INTO {history} (product_info_id, price, price_rrc, quantity, changed_at, month) '
+            'SELECT i.id, s.price, s.price_rrc, s.quantity, %s, %s FROM {info_stage} s '
+            'JOIN {info} i ON i.shop_id = s.shop_id AND i.external_id = s.external_id '
+            'WHERE s.run = %s AND (i.price <> s.price OR i.price_rrc <> s.price_rrc OR i.quantity <> s.quantity)'
+            .format(**tables),
+            [*history_params, run]
+        )
+        cursor.execute(
+            'INSERT INTO {info} '
+            '(product_id, shop_id, model, external_id, quantity, price, price_rrc, discount, feed_hash, is_active) '
+            'SELECT product_id, shop_id, model, external_id, quantity, price, price_rrc, 0, feed_hash, %s '
+            'FROM {info_stage} WHERE run = %s '
+            'ON CONFLICT (shop_id, external_id) DO UPDATE SET '
+            'product_id = EXCLUDED.product_id, model = EXCLUDED.model, quantity = EXCLUDED.quantity, '
+            'price = EXCLUDED.price, price_rrc = EXCLUDED.price_rrc, feed_hash = EXCLUDED.feed_hash, '
+            'is_active = EXCLUDED.is_active'.format(**tables),
+            [True, run]
+        )
+        offers_written = cursor.rowcount
+        # Новые предложения попадают в историю с начальными значениями
+        cursor.execute(
+            'INSERT INTO {history} (product_info_id, price, price_rrc, quantity, changed_at, month) '
+            'SELECT i.id, i.price, i.price_rrc, i.quantity, %s, %s FROM {info_stage} s '
+            'JOIN {info} i ON i.product_id = s.product_id AND i.shop_id = s.shop_id '
+            'WHERE s.run = %s AND NOT EXISTS (SELECT 1 FROM {history} h WHERE h.product_info_id = i.id)'
+            .format(**tables),
+            [*history_params, run]
+        )
+
+        # Параметры, которых больше нет в прайсе, удаляются у опубликованных предложений
+        cursor.execute(
+            'DELETE FROM {param} WHERE product_info_id IN ('
+            'SELECT i.id FROM {info} i JOIN {info_stage} s '
+            'ON i.product_id = s.product_id AND i.shop_id = s.shop_id WHERE s.run = %s'
+            ') AND NOT EXISTS ('
+            'SELECT 1 FROM {param_stage} ps JOIN {info} i ON i.external_id = ps.external_id AND i.shop_id = %s '
+            'WHERE ps.run = %s AND i.id = {param}.product_info_id AND ps.parameter_id = {param}.parameter_id'
+            ')'.format(**tables),
+            [run, shop.pk, run]
+        )
+        params_deleted = cursor.rowcount
+        cursor.execute(
+            'SELECT COUNT(*) FROM {param_stage} ps '
+            'JOIN {info} i ON i.external_id = ps.external_id AND i.shop_id = %s '
+            'WHERE ps.run = %s AND EXISTS ('
+            'SELECT 1 FROM {param} p WHERE p.product_info_id = i.id AND p.parameter_id = ps.parameter_id'
+            ')'.format(**tables),
+            [shop.pk, run]
+        )
+        params_existing = cursor.fetchone()[0]
+        cursor.execute(
+            'INSERT INTO {param} (product_info_id, parameter_id, value) '
+            'SELECT i.id, ps.parameter_id, ps.value FROM {param_stage} ps '
+            'JOIN {info} i ON i.external_id = ps.external_id AND i.shop_id = %s '
+            'WHERE ps.run = %s '
+            'ON CONFLICT (product_info_id, parameter_id) DO UPDATE SET value = EXCLUDED.value'.format(**tables),
+            [shop.pk, run]
+        )
+        params_written = cursor.rowcount
+
+        discard_stage(run_id)
+
+    return {
+        'offers_inserted': offers_written - offers_existing,
+        'offers_updated': offers_existing,
+        'params_inserted': params_written - params_existing,
+        'params_updated': params_existing,
+        'params_deleted': params_deleted,
+    }
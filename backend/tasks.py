@@ -1,12 +1,22 @@
+import json
 from django.core.mail import EmailMultiAlternatives
 from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
 import logging
-from celery import shared_task
+from celery import chord, shared_task
 from versatileimagefield.image_warmer import VersatileImageFieldWarmer
 
 
 logger = logging.getLogger(__name__)
 
+# Количество товаров в одной части фонового импорта прайса
+IMPORT_CHUNK_SIZE = 500
+# Сколько последних ошибок импорта хранится в задаче импорта
+IMPORT_ERRORS_LIMIT = 100
+
 @shared_task
 def send_confirmation_email(user_id):
     """
@@ -82,6 +92,169 @@ def warm_image_versions(instance_id, model_name):
     )
     warmer.warm()
 
+
+@shared_task(time_limit=60 * 60)
+def start_import(job_id):
+    """
+    Разбивает загруженный прайс на части и запускает их параллельный импорт.
+    Когда все части обработаны, chord вызывает finish_import.
+    Задача импорта магазина владельца привязана к его магазину при загрузке; задача
+    администратора — к магазину из прайса. Пока задача выполняется (running), другие
+    задачи и пакетный импорт из командной строки для этого магазина не запускаются.
+    """
+    from .feeds import detect_feed_format, open_feed
+    from .importer import GoodsImporter, shop_lock
+    from .models import ImportJob
+    job = ImportJob.objects.select_related('user', 'shop').get(pk=job_id)
+    try:
+        with job.file.open('rb') as file:
+            feed = open_feed(file, detect_feed_format(job.file.name))
+            if job.shop is not None and feed.shop != job.shop.name:
+                raise ValueError(f'Прайс относится к магазину {feed.shop}, а не к магазину {job.shop.name}')
+
+            # Под блокировкой магазина задача проверяет, что других импортов нет, и занимает магазин
+            with shop_lock(feed.shop):
+                importer = GoodsImporter(job.shop or feed.shop)
+                if ImportJob.objects.filter(shop=importer.shop, state='running').exclude(pk=job.pk).exists():
+                    raise ValueError(f'Прайс магазина {importer.shop.name} уже импортируется другой задачей')
+                job.shop = importer.shop
+                job.state = 'running'
+                job.started_at = timezone.now()
+                job.save(update_fields=['shop', 'state', 'started_at'])
+            importer.import_categories(feed.categories)
+
+            chunk_paths, chunk, seen_ids = [], [], set()
+            for data in feed:
+                external_id = data.get('id') if isinstance(data, dict) else None
+                if external_id is not None:
+                    if external_id in seen_ids:
+                        importer.stats.skipped += 1
+                        importer.stats.error(f'Дубликат external_id {external_id} найден в файле. Пропускаем этот товар.')
+                        continue
+                    seen_ids.add(external_id)
+                chunk.append(data)
+                if len(chunk) == IMPORT_CHUNK_SIZE:
+                    chunk_paths.append(_save_import_chunk(job, len(chunk_paths), chunk))
+                    chunk = []
+            if chunk:
+                chunk_paths.append(_save_import_chunk(job, len(chunk_paths), chunk))
+    except Exception as e:
+        # Любая ошибка чтения прайса завершает задачу, иначе она осталась бы в статусе pending
+        logger.error(f"Ошибка импорта {job_id}: {e}")
+        _fail_import_job(job_id, e)
+        return
+
+    stats = importer.stats.as_dict()
+    job.total_chunks = len(chunk_paths)
+    job.errors = stats.pop('errors')[-IMPORT_ERRORS_LIMIT:]
+    job.stats = stats
+    job.save(update_fields=['total_chunks', 'errors', 'stats'])
+
+    category_ids = sorted(importer.category_ids)
+    if chunk_paths:
+        # Если часть завершилась аварийно (например, по time_limit), chord не вызовет finish_import —
+        # тогда fail_import переводит задачу импорта в статус failed
+        chord(import_chunk.s(job_id, path, category_ids) for path in chunk_paths)(
+            finish_import.s(job_id).on_error(fail_import.s(job_id))
+        )
+    else:
+        finish_import.delay([], job_id)
+
+
+def _fail_import_job(job_id, error):
+    from .models import ImportJob
+    job = ImportJob.objects.select_related('shop').get(pk=job_id)
+    job.state = 'failed'
+    job.errors = (job.errors + [str(error)])[-IMPORT_ERRORS_LIMIT:]
+    job.finished_at = timezone.now()
+    job.save(update_fields=['state', 'errors', 'finished_at'])
+    _save_import_run(job, success=False)
+
+
+def _save_import_run(job, success):
+    """Сохраняет завершённую задачу импорта в истории импортов, как и импорт из командной строки"""
+    from .importer import ImportStats, save_import_run
+    stats = ImportStats.from_dict(dict(job.stats, errors=job.errors))
+    save_import_run(
+        job.shop, stats, job.started_at or job.created_at, source=job.file.name, success=success,
+        options={'job': str(job.pk), 'total_chunks': job.total_chunks}
+    )
+
+
+def _save_import_chunk(job, number, goods):
+    content = json.dumps(goods, ensure_ascii=False, default=str).encode('utf-8')
+    return default_storage.save(f'imports/{job.pk}/chunk-{number:05d}.json', ContentFile(content))
+
+
+@shared_task(time_limit=60 * 60)
+def import_chunk(job_id, chunk_path, category_ids):
+    """
+    Импортирует одну часть прайса и обновляет прогресс задачи импорта
+    """
+    from .importer import GoodsImporter, ImportStats
+    from .models import ImportJob
+    job = ImportJob.objects.select_related('shop').get(pk=job_id)
+    with default_storage.open(chunk_path, 'rb') as file:
+        goods = json.load(file)
+
+    importer = GoodsImporter(job.shop, batch_size=IMPORT_CHUNK_SIZE)
+    importer.category_ids.update(category_ids)
+    try:
+        importer.import_goods(goods)
+    except Exception as e:
+        # Ошибка части не должна прерывать chord: остальные части и finish_import выполняются
+        logger.error(f"Ошибка импорта части {chunk_path}: {e}")
+        importer.stats.error(f'Часть {chunk_path} не импортирована: {e}')
+
+    with transaction.atomic():
+        job = ImportJob.objects.select_for_update().get(pk=job_id)
+        stats = ImportStats.from_dict(job.stats)
+        stats.merge(importer.stats)
+        stats = stats.as_dict()
+        job.errors = (job.errors + stats.pop('errors'))[-IMPORT_ERRORS_LIMIT:]
+        job.stats = stats
+        job.chunks_done += 1
+        job.rows_done += len(goods)
+        job.save(update_fields=['errors', 'stats', 'chunks_done', 'rows_done'])
+    return importer.stats.changed
+
+
+@shared_task
+def finish_import(results, job_id):
+    """
+    Завершает импорт: однократно сбрасывает кэш каталога и удаляет части прайса
+    """
+    from .importer import invalidate_catalog
+    from .models import ImportJob
+    if any(results):
+        invalidate_catalog()
+    _delete_import_chunks(job_id)
+    job = ImportJob.objects.select_related('shop').get(pk=job_id)
+    job.state = 'done'
+    job.finished_at = timezone.now()
+    job.save(update_fields=['state', 'finished_at'])
+    _save_import_run(job, success=True)
+
+
+@shared_task
+def fail_import(request, exc, traceback, job_id):
+    """
+    Обработчик ошибки chord импорта: часть прайса или finish_import завершились аварийно.
+    Записанные части уже в базе, поэтому кэш каталога сбрасывается, а задача импорта получает статус failed.
+    """
+    from .importer import invalidate_catalog
+    logger.error(f"Ошибка импорта {job_id}: {exc}")
+    invalidate_catalog()
+    _delete_import_chunks(job_id)
+    _fail_import_job(job_id, exc)
+
+
+def _delete_import_chunks(job_id):
+    chunk_dir = f'imports/{job_id}'
+    if default_storage.exists(chunk_dir):
+        for name in default_storage.listdir(chunk_dir)[1]:
+            default_storage.delete(f'{chunk_dir}/{name}')
+
 from celery import shared_task
 
 @shared_task
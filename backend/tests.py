@@ -4,6 +4,7 @@ from rest_framework.test import APITestCase
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 from django.contrib.auth import get_user_model
+from django.db import connection
 
 User = get_user_model()
 
@@ -97,3 +98,1054 @@ def test_social_login_vk():
 
     assert response.status_code == status.HTTP_200_OK
     assert "token" in response.data  # Проверка наличия токена в ответе
+
+
+FEED_CATEGORIES = [{'id': 224, 'name': 'Смартфоны'}]
+FEED_GOODS = [
+    {
+        'id': 4216292, 'category': 224, 'model': 'apple/iphone/xs-max',
+        'name': 'Смартфон Apple iPhone XS Max 512GB (золотистый)',
+        'price': 110000, 'price_rrc': 116990, 'quantity': 14,
+        'parameters': {'Диагональ (дюйм)': 6.5, 'Color': 'золотистый'},
+    },
+    {
+        'id': 4216313, 'category': 224, 'model': 'apple/iphone/xr',
+        'name': 'Смартфон Apple iPhone XR 256GB (красный)',
+        'price': 65000, 'price_rrc': 69990, 'quantity': 9,
+        'parameters': {'Диагональ (дюйм)': 6.1, 'Color': 'красный'},
+    },
+]
+
+
+@pytest.mark.django_db
+def test_bulk_import_counts_inserted_updated_unchanged():
+    from copy import deepcopy
+    from backend.importer import GoodsImporter
+    from backend.models import ProductInfo, ProductParameter
+
+    stats = GoodsImporter('Связной', batch_size=1).run(FEED_CATEGORIES, FEED_GOODS)
+    assert stats.models['Product']['inserted'] == 2
+    assert stats.models['ProductParameter']['inserted'] == 4
+    assert ProductParameter.objects.filter(parameter__name='Цвет').count() == 2
+
+    goods = deepcopy(FEED_GOODS)
+    goods[0]['price'] = 100000
+    stats = GoodsImporter('Связной').run(FEED_CATEGORIES, goods)
+    assert stats.models['ProductInfo'] == {'inserted': 0, 'updated': 1, 'unchanged': 1, 'deleted': 0}
+    assert stats.models['ProductParameter']['unchanged'] == 4
+    assert ProductInfo.objects.get(external_id='4216292').price == 100000
+
+    # Параметр, исключённый из прайса, удаляется и из каталога
+    del goods[0]['parameters']['Color']
+    stats = GoodsImporter('Связной').run(FEED_CATEGORIES, goods)
+    assert stats.models['ProductParameter'] == {'inserted': 0, 'updated': 0, 'unchanged': 3, 'deleted': 1}
+    assert not ProductParameter.objects.filter(product_info__external_id='4216292', parameter__name='Цвет').exists()
+    assert ProductParameter.objects.filter(product_info__external_id='4216313').count() == 2
+
+
+@pytest.mark.django_db(transaction=True)
+def test_failed_batch_does_not_cache_rolled_back_parameters(monkeypatch):
+    from django.db import DatabaseError
+    from backend.importer import GoodsImporter
+    from backend.models import Parameter, ProductParameter
+
+    record_price_history = GoodsImporter._record_price_history
+    calls = []
+
+    def failing_once(self, info_ids, changes):
+        calls.append(info_ids)
+        if len(calls) == 1:
+            raise DatabaseError('сбой записи')
+        record_price_history(self, info_ids, changes)
+
+    monkeypatch.setattr(GoodsImporter, '_record_price_history', failing_once)
+    stats = GoodsImporter('Связной', batch_size=1).run(FEED_CATEGORIES, FEED_GOODS)
+    assert stats.skipped == 1
+    assert set(Parameter.objects.values_list('name', flat=True)) == {'Диагональ (дюйм)', 'Цвет'}
+    assert ProductParameter.objects.filter(product_info__external_id='4216313').count() == 2
+
+
+@pytest.mark.django_db
+def test_goods_with_too_long_parameters_are_skipped():
+    from copy import deepcopy
+    from backend.importer import GoodsImporter
+    from backend.models import ProductInfo
+
+    goods = deepcopy(FEED_GOODS) + [dict(FEED_GOODS[0], id=1, parameters={'П' * 41: 'да'})]
+    goods.append(dict(FEED_GOODS[0], id=2, parameters={'Цвет': 'з' * 101}))
+    stats = GoodsImporter('Связной').run(FEED_CATEGORIES, goods)
+    assert stats.skipped == 2
+    assert [error['kind'] for error in stats.report()['top_errors']] == ['invalid']
+    assert set(ProductInfo.objects.values_list('external_id', flat=True)) == {'4216292', '4216313'}
+
+
+@pytest.mark.django_db
+def test_shops_may_reuse_external_ids():
+    from copy import deepcopy
+    from backend.importer import GoodsImporter
+    from backend.models import Product, ProductInfo
+
+    GoodsImporter('Связной').run(FEED_CATEGORIES, FEED_GOODS)
+    goods = deepcopy(FEED_GOODS)
+    goods[0]['name'] = 'Чехол для смартфона'
+    stats = GoodsImporter('Евросеть').run(FEED_CATEGORIES, goods)
+    assert stats.models['Product']['inserted'] == 2
+    assert Product.objects.filter(external_id='4216292').count() == 2
+
+    offers = ProductInfo.objects.filter(external_id='4216292').select_related('product', 'shop')
+    assert {(offer.shop.name, offer.product.name) for offer in offers} == {
+        ('Связной', FEED_GOODS[0]['name']), ('Евросеть', 'Чехол для смартфона')
+    }
+    stats = GoodsImporter('Связной', full=True).run(FEED_CATEGORIES, FEED_GOODS)
+    assert stats.models['Product'] == {'inserted': 0, 'updated': 0, 'unchanged': 2, 'deleted': 0}
+
+
+@pytest.mark.django_db
+def test_import_run_report_saved_to_history():
+    from copy import deepcopy
+    from backend.importer import GoodsImporter
+    from backend.models import ImportRun
+
+    goods = deepcopy(FEED_GOODS) + deepcopy(FEED_GOODS[:1]) + [dict(FEED_GOODS[1], id=1, category=999)]
+    GoodsImporter('Связной', source='feed.yaml').run(FEED_CATEGORIES, goods)
+
+    run = ImportRun.objects.get()
+    assert run.source == 'feed.yaml' and run.success and run.rows == 4
+    assert run.report['skipped'] == 2
+    assert {'parse', 'categories', 'products', 'offers', 'parameters', 'invalidation'} <= set(run.report['timings'])
+    errors = {group['kind']: group for group in run.report['top_errors']}
+    assert errors['duplicate']['count'] == 1
+    assert errors['category']['samples'][0]['category'] == 999
+
+
+@pytest.mark.django_db
+def test_import_resumes_from_checkpoint_after_crash():
+    from backend.importer import GoodsImporter
+    from backend.models import ImportCheckpoint
+
+    def crashing_feed():
+        yield FEED_GOODS[0]
+        raise OSError('соединение прервано')
+
+    with pytest.raises(OSError):
+        GoodsImporter('Связной', batch_size=1, feed_hash='a' * 64).run(FEED_CATEGORIES, crashing_feed())
+    assert ImportCheckpoint.objects.get().offset == 1
+
+    stats = GoodsImporter(
+        'Связной', batch_size=1, feed_hash='a' * 64, resume=True, missing='archive'
+    ).run(FEED_CATEGORIES, FEED_GOODS)
+    assert stats.resumed == 1
+    assert stats.models['ProductInfo']['inserted'] == 1
+    assert stats.deactivated == 0
+    assert not ImportCheckpoint.objects.exists()
+
+
+@pytest.mark.django_db
+def test_price_history_records_only_changes():
+    from copy import deepcopy
+    from django.core.cache import cache
+    from backend.importer import GoodsImporter
+    from backend.models import PriceHistory, ProductInfo
+
+    GoodsImporter('Связной').run(FEED_CATEGORIES, FEED_GOODS)
+    goods = deepcopy(FEED_GOODS)
+    goods[0]['price'] = 100000
+    goods[1]['parameters']['Color'] = 'white'
+    GoodsImporter('Связной').run(FEED_CATEGORIES, goods)
+    goods[0]['quantity'] = 1
+    GoodsImporter('Связной', staged=True).run(FEED_CATEGORIES, goods)
+
+    offer = ProductInfo.objects.get(external_id='4216292')
+    offer.price = 90000
+    offer.save()
+    offer.save()
+    assert PriceHistory.objects.count() == 5
+
+    cache.clear()
+    response = APIClient().get(f'/api/product-infos/{offer.pk}/price-history/')
+    assert response.status_code == 200
+    assert [(row['price'], row['quantity']) for row in response.json()] == [
+        (110000, 14), (100000, 14), (100000, 1), (90000, 1)
+    ]
+
+
+@pytest.mark.django_db
+def test_product_list_cursor_pagination(django_capture_on_commit_callbacks):
+    from base64 import b64decode
+    from urllib.parse import parse_qs, urlparse
+    from django.core.cache import cache
+    from backend.models import Category, Product, ProductInfo, Shop
+
+    category = Category.objects.create(name='Смартфоны')
+    shop = Shop.objects.create(name='Связной')
+    quantities = [3, 1, 3, 2, 5]
+    # Карточки каталога пересобираются после фиксации транзакции
+    with django_capture_on_commit_callbacks(execute=True):
+        for number, quantity in enumerate(quantities):
+            product = Product.objects.create(
+                name=f'Товар {number}', external_id=str(number), category=category, description=''
+            )
+            ProductInfo.objects.create(product=product, shop=shop, external_id=str(number), quantity=quantity)
+    expected = list(Product.objects.order_by('id').values_list('id', flat=True))
+
+    cache.clear()
+    client = APIClient()
+    response = client.get('/api/products/', {'page_size': 2})
+    assert response.status_code == 200
+    page = response.json()
+    assert page['previous'] is None
+    seen = [row['id'] for row in page['results']]
+    # Товар, добавленный во время обхода, не сдвигает уже выданные страницы
+    with django_capture_on_commit_callbacks(execute=True):
+        Product.objects.create(name='Новый', external_id='new', category=category, description='')
+    while page['next']:
+        page = client.get(page['next']).json()
+        seen += [row['id'] for row in page['results']]
+    assert seen == expected + [expected[-1] + 1]
+    assert page['previous']
+
+    # Одинаковые количества на границе страниц разделяются по id в позиции курсора, без OFFSET
+    cache.clear()
+    response = client.get('/api/products/', {'ordering': '-quantity', 'page_size': 2, 'category': category.pk})
+    page = response.json()
+    seen = [row['id'] for row in page['results']]
+    with django_capture_on_commit_callbacks(execute=True):
+        tied = Product.objects.create(name='Товар 5', external_id='5', category=category, description='')
+        ProductInfo.objects.create(product=tied, shop=shop, external_id='5', quantity=3)
+    pages = [page]
+    while page['next']:
+        assert 'o=' not in b64decode(parse_qs(urlparse(page['next']).query)['cursor'][0]).decode()
+        page = client.get(page['next']).json()
+        pages.append(page)
+        seen += [row['id'] for row in page['results']]
+    expected = list(Product.objects.order_by('-infos__quantity', '-id').values_list('id', flat=True))
+    assert seen == [pk for pk in expected if pk != tied.pk]
+    # Страница, выданная до добавления товара, не содержит его и при возврате назад не смещается
+    previous = client.get(pages[-1]['previous']).json()
+    assert [row['id'] for row in previous['results']] == [row['id'] for row in pages[-2]['results']]
+
+
+@pytest.mark.django_db
+def test_product_list_full_text_search():
+    from django.core.cache import cache
+    from backend.importer import GoodsImporter
+
+    GoodsImporter('Связной').run(FEED_CATEGORIES, FEED_GOODS)
+    cache.clear()
+    client = APIClient()
+    response = client.get('/api/products/', {'q': 'iphone XR'})
+    assert response.status_code == 200
+    assert [row['model'] for row in response.json()['results']] == ['apple/iphone/xr']
+
+    response = client.get('/api/products/', {'q': 'Смартфон apple', 'ordering': '-id'})
+    assert [row['model'] for row in response.json()['results']] == ['apple/iphone/xr', 'apple/iphone/xs-max']
+
+
+@pytest.mark.django_db
+def test_product_list_price_ordering_filters_and_offers(django_capture_on_commit_callbacks):
+    from copy import deepcopy
+    from django.core.cache import cache
+    from backend.catalog import refresh_product_cards
+    from backend.importer import GoodsImporter
+    from backend.models import Product, ProductCard, ProductInfo
+
+    GoodsImporter('Связной').run(FEED_CATEGORIES, FEED_GOODS)
+    goods = deepcopy(FEED_GOODS)
+    goods[0].update(price=100000, quantity=2)
+    goods[1].update(price=60000, quantity=0)
+    GoodsImporter('Евросеть').run(FEED_CATEGORIES, goods)
+    # Импорт создаёт продукты каждого магазина; для сравнения цен переносим предложения к продуктам «Связного»
+    for external_id in ('4216292', '4216313'):
+        offers = ProductInfo.objects.filter(external_id=external_id)
+        offers.filter(shop__name='Евросеть').update(product=offers.get(shop__name='Связной').product)
+    Product.objects.filter(infos=None).delete()
+    refresh_product_cards(Product.objects.values_list('pk', flat=True))
+    with django_capture_on_commit_callbacks(execute=True):
+        xr = ProductInfo.objects.get(shop__name='Связной', external_id='4216313')
+        xr.discount = 20
+        xr.save()
+
+    cards = {card.payload['model']: card for card in ProductCard.objects.all()}
+    assert (cards['apple/iphone/xs-max'].price, cards['apple/iphone/xs-max'].quantity) == (100000, 16)
+    assert cards['apple/iphone/xs-max'].payload['shop'] == 'Евросеть'
+    # Более дешёвое предложение без остатка уступает предложению в наличии
+    assert (cards['apple/iphone/xr'].price, cards['apple/iphone/xr'].quantity) == (52000, 9)
+
+    cache.clear()
+    client = APIClient()
+    response = client.get('/api/products/', {'ordering': 'price'})
+    assert [row['price'] for row in response.json()['results']] == [52000, 100000]
+    response = client.get('/api/products/', {'ordering': '-price', 'price_min': 60000})
+    assert [row['price'] for row in response.json()['results']] == [100000]
+    response = client.get('/api/products/', {'in_stock': 'true', 'price_max': 60000})
+    assert [row['model'] for row in response.json()['results']] == ['apple/iphone/xr']
+
+    assert response.json()['results'][0]['offers_summary'] == {
+        'offers': 2, 'in_stock': 1, 'min_price': 52000, 'max_price': 60000, 'cheapest_shop': 'Связной'
+    }
+    response = client.get(f"/api/products/{cards['apple/iphone/xr'].pk}/offers/")
+    assert [(row['shop'], row['effective_price'], row['quantity']) for row in response.json()] == [
+        ('Связной', 52000, 9), ('Евросеть', 60000, 0)
+    ]
+
+    # Колонка цены карточки — минимальная цена активных предложений (как offers_summary.min_price),
+    # даже если самое дешёвое предложение без остатка и в ответе показано предложение в наличии
+    with django_capture_on_commit_callbacks(execute=True):
+        offer = ProductInfo.objects.get(shop__name='Евросеть', external_id='4216313')
+        offer.price = 50000
+        offer.save()
+    cache.clear()
+    response = client.get('/api/products/', {'price_max': 51000})
+    [row] = response.json()['results']
+    assert (row['price'], row['offers_summary']['min_price']) == (52000, 50000)
+    response = client.get('/api/products/', {'ordering': 'price'})
+    assert [row['offers_summary']['min_price'] for row in response.json()['results']] == [50000, 100000]
+
+
+@pytest.mark.django_db
+def test_product_list_facet_filters_and_counts(django_capture_on_commit_callbacks):
+    from copy import deepcopy
+    from django.core.cache import cache
+    from backend.catalog import facet_counts, recount_facets
+    from backend.importer import GoodsImporter
+    from backend.models import Product
+
+    goods = deepcopy(FEED_GOODS)
+    goods.append(dict(goods[1], id=4216314, name='Смартфон Apple iPhone XR 128GB (красный)', parameters={
+        'Диагональ (дюйм)': 6.1, 'Color': 'красный'
+    }))
+    GoodsImporter('Связной').run(FEED_CATEGORIES, goods)
+
+    cache.clear()
+    client = APIClient()
+    response = client.get('/api/products/', {'category': 224, 'param[Цвет]': 'красный,синий'})
+    assert [row['model'] for row in response.json()['results']] == ['apple/iphone/xr', 'apple/iphone/xr']
+    assert response.json()['facets'] == {
+        'Диагональ (дюйм)': {'6.1': 2, '6.5': 1},
+        'Цвет': {'золотистый': 1, 'красный': 2},
+    }
+    response = client.get('/api/products/', {'param[Цвет]': 'красный', 'param[Диагональ (дюйм)]': '6.5'})
+    assert response.json()['results'] == []
+
+    # Архивное предложение и удалённый товар уменьшают счётчики без полного пересчёта
+    GoodsImporter('Связной', missing='archive').run(FEED_CATEGORIES, goods[1:])
+    with django_capture_on_commit_callbacks(execute=True):
+        Product.objects.get(infos__external_id='4216314').delete()
+    expected = {'Диагональ (дюйм)': {'6.1': 1}, 'Цвет': {'красный': 1}}
+    assert facet_counts(224) == expected
+    recount_facets()
+    assert facet_counts(224) == expected
+
+
+@pytest.mark.skipif(connection.vendor != 'postgresql', reason='SQLite не выполняет записи параллельно')
+@pytest.mark.django_db(transaction=True)
+def test_concurrent_card_refreshes_count_facets_once():
+    import threading
+    from django.db import connections
+    from backend.catalog import facet_counts, refresh_product_cards
+    from backend.importer import GoodsImporter
+    from backend.models import FacetCount, ProductFacet
+
+    GoodsImporter('Связной').run(FEED_CATEGORIES, FEED_GOODS)
+    product_ids = list(ProductFacet.objects.values_list('product_id', flat=True).distinct())
+    expected = facet_counts(224)
+    ProductFacet.objects.all().delete()
+    FacetCount.objects.all().delete()
+
+    barrier = threading.Barrier(2)
+    errors = []
+
+    def refresh():
+        try:
+            barrier.wait()
+            refresh_product_cards(product_ids)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connections.close_all()
+
+    threads = [threading.Thread(target=refresh) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert facet_counts(224) == expected
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('option', [{'staged': True}, {'missing': 'archive'}, {'copy': True}])
+def test_bulk_only_options_enable_bulk_import(option):
+    from django.core.management import call_command
+    from backend.models import ImportRun
+
+    call_command('import_goods', file='data/shop1.yaml', verbosity=0, **option)
+    # Построчный импорт сохраняет запуск без параметров пакетного импорта
+    assert set(option) <= set(ImportRun.objects.get().options)
+
+
+@pytest.mark.django_db
+def test_copy_import_matches_bulk_import(tmp_path):
+    from backend.importer import import_feed
+    from backend.management.commands.generate_feed import write_feed
+    from backend.models import ProductInfo, ProductParameter
+
+    reports = {}
+    for shop, copy in (('Пакетный', False), ('COPY', True)):
+        path = tmp_path / f'{shop}.yaml'
+        with open(path, 'w', encoding='utf-8') as file:
+            write_feed(file, goods=30, categories=2, parameters=4, duplicates=0.1, seed=7, shop=shop)
+        reports[shop] = import_feed(str(path), copy=copy).models
+
+    def rows(shop):
+        offers = ProductInfo.objects.filter(shop__name=shop)
+        parameters = ProductParameter.objects.filter(product_info__shop__name=shop)
+        return (
+            set(offers.values_list('external_id', 'price', 'price_rrc', 'quantity', 'product__name')),
+            set(parameters.values_list('product_info__external_id', 'parameter__name', 'value')),
+        )
+
+    assert rows('COPY') == rows('Пакетный')
+    # Категории и параметры общие для магазинов, поэтому сравниваются счётчики только строк магазина
+    for model in ('Product', 'ProductInfo', 'ProductParameter'):
+        assert reports['COPY'][model] == reports['Пакетный'][model]
+
+
+@pytest.mark.django_db
+def test_rejected_staged_import_keeps_missing_offers():
+    from copy import deepcopy
+    from backend.importer import GoodsImporter
+    from backend.models import ProductInfo
+
+    GoodsImporter('Связной').run(FEED_CATEGORIES, FEED_GOODS)
+    goods = deepcopy(FEED_GOODS[:1])
+    goods[0]['price'] = 0
+    stats = GoodsImporter('Связной', staged=True, missing='archive').run(FEED_CATEGORIES, goods)
+    assert 'Публикация отменена' in stats.errors[-1]
+    assert stats.deactivated == 0
+    assert list(ProductInfo.objects.order_by('external_id').values_list('is_active', 'price')) == [
+        (True, 110000), (True, 65000)
+    ]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('threshold', [10000, 1])
+def test_product_cards_follow_imports_and_edits(monkeypatch, django_capture_on_commit_callbacks, threshold):
+    from copy import deepcopy
+    from backend import importer
+    from backend.models import ProductCard, ProductParameter, Shop
+
+    def card(external_id):
+        return ProductCard.objects.get(product__infos__external_id=external_id).payload
+
+    monkeypatch.setattr(importer, 'SEEN_IDS_TEMP_TABLE_THRESHOLD', threshold)
+    importer.GoodsImporter('Связной').run(FEED_CATEGORIES, FEED_GOODS)
+    assert ProductCard.objects.count() == 2
+    assert card('4216292')['price'] == 110000
+    assert card('4216292')['characteristics'] == {'Диагональ (дюйм)': '6.5', 'Цвет': 'золотистый'}
+
+    goods = deepcopy(FEED_GOODS)
+    goods[0]['price'] = 99000
+    importer.GoodsImporter('Связной', staged=True).run(FEED_CATEGORIES, goods)
+    assert card('4216292')['price'] == 99000
+
+    importer.GoodsImporter('Связной', missing='archive').run(FEED_CATEGORIES, goods[:1])
+    assert card('4216313')['shop'] is None
+
+    with django_capture_on_commit_callbacks(execute=True):
+        shop = Shop.objects.get(name='Связной')
+        shop.name = 'Связной-Маркет'
+        shop.save()
+        parameter = ProductParameter.objects.get(product_info__external_id='4216292', parameter__name='Цвет')
+        parameter.value = 'серый'
+        parameter.save()
+    assert card('4216292')['shop'] == 'Связной-Маркет'
+    assert card('4216292')['characteristics']['Цвет'] == 'серый'
+
+
+@pytest.mark.django_db
+def test_product_list_query_count_does_not_grow_with_page_size():
+    from cachalot.api import invalidate
+    from django.core.cache import cache
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from backend.importer import GoodsImporter
+
+    goods = [
+        dict(FEED_GOODS[number % len(FEED_GOODS)], id=number, name=f'Товар {number}')
+        for number in range(1, 13)
+    ]
+    GoodsImporter('Связной').run(FEED_CATEGORIES, goods)
+    GoodsImporter('Евросеть').run(FEED_CATEGORIES, goods)
+
+    cache.clear()
+    client = APIClient()
+    queries = []
+    for page_size in (2, 12):
+        # Оба запроса выполняются с пустым кэшем cachalot, иначе второй получит часть данных из кэша
+        invalidate()
+        with CaptureQueriesContext(connection) as context:
+            response = client.get('/api/products/', {'page_size': page_size})
+        assert response.status_code == 200
+        assert len(response.json()['results']) == page_size
+        queries.append(len(context.captured_queries))
+    assert queries[0] == queries[1]
+
+    product = response.json()['results'][0]
+    assert product['shop'] == 'Связной'
+    assert product['characteristics'] == {'Диагональ (дюйм)': '6.1', 'Цвет': 'красный'}
+
+
+@pytest.mark.django_db
+def test_conditional_get_on_catalog_and_basket(django_capture_on_commit_callbacks):
+    from copy import deepcopy
+    from django.core.cache import cache
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from backend.importer import GoodsImporter
+    from backend.models import Order, ProductInfo
+
+    with django_capture_on_commit_callbacks(execute=True):
+        GoodsImporter('Связной').run(FEED_CATEGORIES, FEED_GOODS)
+    cache.clear()
+    client = APIClient()
+    etag = client.get('/api/products/')['ETag']
+    with CaptureQueriesContext(connection) as context:
+        response = client.get('/api/products/', HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+    assert not [query for query in context.captured_queries if 'backend_productcard' in query['sql']]
+
+    goods = deepcopy(FEED_GOODS)
+    goods[0]['price'] = 100000
+    with django_capture_on_commit_callbacks(execute=True):
+        GoodsImporter('Связной').run(FEED_CATEGORIES, goods)
+    response = client.get('/api/products/', HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200 and response['ETag'] != etag
+
+    # Удалённый товар не оставляет карточки, но версия каталога всё равно меняется
+    etag = response['ETag']
+    with django_capture_on_commit_callbacks(execute=True):
+        ProductInfo.objects.get(external_id='4216313').product.delete()
+    response = client.get('/api/products/', HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200 and response['ETag'] != etag
+    assert [product['name'] for product in response.json()['results']] == [FEED_GOODS[0]['name']]
+
+    user = User.objects.create_user(username='buyer', password='password', email='buyer@example.com')
+    user.is_active = True
+    user.save()
+    client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=user).key)
+    # Первый запрос создаёт пустую корзину, и версия заказов пользователя меняется
+    client.get('/api/basket/')
+    etag = client.get('/api/basket/')['ETag']
+    assert client.get('/api/basket/', HTTP_IF_NONE_MATCH=etag).status_code == 304
+    offer = ProductInfo.objects.get(external_id='4216292')
+    assert client.post('/api/basket/', {'product_info': offer.pk, 'quantity': 1}).status_code == 201
+    response = client.get('/api/basket/', HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert [item['product_name'] for item in response.json()['items']] == [offer.product.name]
+
+    # Заказ проверяется до сравнения версий: совпадающий ETag чужого заказа не даёт 304
+    cache.clear()
+    order = Order.objects.get(user=user)
+    etag = client.get(f'/api/orders/{order.pk}/')['ETag']
+    assert client.get(f'/api/orders/{order.pk}/', HTTP_IF_NONE_MATCH=etag).status_code == 304
+    other = User.objects.create_user(username='other', password='password', email='other@example.com')
+    other.is_active = True
+    other.save()
+    client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=other).key)
+    assert client.get(f'/api/orders/{order.pk}/', HTTP_IF_NONE_MATCH=etag).status_code == 404
+    assert client.get(f'/api/orders/{order.pk}/').status_code == 404
+
+
+@pytest.mark.django_db
+def test_sparse_fieldsets_and_expansion(django_capture_on_commit_callbacks):
+    from cachalot.api import invalidate
+    from django.core.cache import cache
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from backend.importer import GoodsImporter
+    from backend.models import ProductInfo
+
+    with django_capture_on_commit_callbacks(execute=True):
+        GoodsImporter('Связной').run(FEED_CATEGORIES, FEED_GOODS)
+    cache.clear()
+    client = APIClient()
+
+    # Лёгкий список каталога — один запрос к карточкам без характеристик.
+    # Перед каждым замером кэш cachalot сбрасывается, чтобы считались запросы к базе
+    invalidate()
+    with CaptureQueriesContext(connection) as context:
+        response = client.get('/api/products/', {'fields': 'id,name,price'})
+    card_queries = [query['sql'] for query in context.captured_queries if 'backend_productcard' in query['sql']]
+    assert len(card_queries) == 1 and 'characteristics' not in card_queries[0]
+    product = response.json()['results'][0]
+    assert set(product) == {'id', 'name', 'price'}
+
+    response = client.get('/api/products/', {'fields': 'id,offers', 'expand': 'offers'})
+    product = next(item for item in response.json()['results'] if item['id'] == product['id'])
+    assert set(product) == {'id', 'offers'}
+    assert [offer['shop'] for offer in product['offers']] == ['Связной']
+
+    user = User.objects.create_user(username='buyer', password='password', email='buyer@example.com')
+    user.is_active = True
+    user.save()
+    client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=user).key)
+    offer = ProductInfo.objects.get(external_id='4216292')
+    assert client.post('/api/basket/', {'product_info': offer.pk, 'quantity': 2}).status_code == 201
+
+    # Без позиций заказа список заказов — один запрос, позиции не предзагружаются
+    invalidate()
+    with CaptureQueriesContext(connection) as context:
+        response = client.get('/api/orders/', {'fields': 'id,state'})
+    assert response.json() == [{'id': offer.items.get().order_id, 'state': 'basket'}]
+    assert len([query for query in context.captured_queries if 'backend_order' in query['sql']]) == 1
+
+    invalidate()
+    with CaptureQueriesContext(connection) as context:
+        response = client.get('/api/orders/', {'fields': 'items.total,items.product.name', 'expand': 'items.product'})
+    assert response.json() == [{'items': [{'total': offer.price * 2, 'product': {'name': offer.product.name}}]}]
+    assert len([query for query in context.captured_queries if 'backend_order' in query['sql']]) == 2
+
+
+@pytest.mark.django_db
+def test_product_export_streams_ndjson_and_csv(django_capture_on_commit_callbacks, monkeypatch):
+    import csv
+    import json
+    from django.core.cache import cache
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from backend import views
+    from backend.importer import GoodsImporter
+    from backend.models import Product
+
+    with django_capture_on_commit_callbacks(execute=True):
+        GoodsImporter('Связной').run(FEED_CATEGORIES, FEED_GOODS)
+    cache.clear()
+    client = APIClient()
+
+    response = client.get('/api/products/export/', {'format': 'ndjson'})
+    assert response.streaming and response['Content-Type'].startswith('application/x-ndjson')
+    # Предложения загружаются одним запросом на пачку карточек, а не на товар
+    with CaptureQueriesContext(connection) as context:
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+    assert len([query for query in context.captured_queries if 'backend_productinfo' in query['sql']]) == 1
+    assert sorted(row['id'] for row in rows) == sorted(Product.objects.values_list('pk', flat=True))
+    row = next(row for row in rows if row['name'] == 'Смартфон Apple iPhone XS Max 512GB (золотистый)')
+    assert row['characteristics']['Цвет'] == 'золотистый'
+    assert [offer['shop'] for offer in row['offers']] == ['Связной']
+
+    monkeypatch.setattr(views, 'EXPORT_CHUNK_SIZE', 1)
+    response = client.get('/api/products/export/', {'format': 'csv', 'fields': 'id,name,characteristics'})
+    assert response['Content-Type'] == 'text/csv; charset=utf-8'
+    with CaptureQueriesContext(connection) as context:
+        reader = csv.DictReader(b''.join(response.streaming_content).decode().splitlines())
+    assert len([query for query in context.captured_queries if 'backend_productinfo' in query['sql']]) == len(rows)
+    assert reader.fieldnames == ['id', 'name', 'characteristics', 'offers']
+    exported = {int(line['id']): line for line in reader}
+    assert json.loads(exported[row['id']]['characteristics']) == row['characteristics']
+    assert len(exported) == len(rows)
+
+
+def test_ujson_renderer_and_parser_match_stdlib(monkeypatch):
+    import datetime
+    import decimal
+    import io
+    import uuid
+    from django.utils.translation import gettext_lazy
+    from rest_framework.exceptions import ParseError
+    from rest_framework.parsers import JSONParser
+    from rest_framework.renderers import JSONRenderer
+    from backend import renderers
+    from backend.parsers import UJSONParser
+    from backend.renderers import UJSONRenderer
+
+    data = {
+        'price': decimal.Decimal('12.50'),
+        'created_at': datetime.datetime(2024, 5, 1, 12, 30, tzinfo=datetime.timezone.utc),
+        'job': uuid.UUID(int=1),
+        'state': gettext_lazy('Новый'),
+        'name': 'Смартфон Apple/iPhone\u2028XR',
+        'items': [{'quantity': 2, 'total': None}],
+    }
+    assert UJSONRenderer().render(data) == JSONRenderer().render(data)
+    indented = 'application/json; indent=4'
+    assert UJSONRenderer().render(data, indented) == JSONRenderer().render(data, indented)
+    with pytest.raises(ValueError):
+        UJSONRenderer().render({'price': float('nan')})
+    monkeypatch.setattr(renderers, 'ujson', None)
+    assert UJSONRenderer().render(data) == JSONRenderer().render(data)
+
+    assert UJSONParser().parse(io.BytesIO('{"name": "Заказ", "items": [1, 2.5]}'.encode())) == {
+        'name': 'Заказ', 'items': [1, 2.5]
+    }
+    for body in (b'{"price": NaN}', b'{"price": 1,}'):
+        with pytest.raises(ParseError):
+            UJSONParser().parse(io.BytesIO(body))
+        with pytest.raises(ParseError):
+            JSONParser().parse(io.BytesIO(body))
+
+
+@pytest.mark.django_db
+def test_bulk_import_skips_goods_with_unchanged_hash():
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from backend.importer import GoodsImporter
+
+    GoodsImporter('Связной').run(FEED_CATEGORIES, FEED_GOODS)
+    importer = GoodsImporter('Связной')
+    importer.import_categories(FEED_CATEGORIES)
+    with CaptureQueriesContext(connection) as queries:
+        importer.import_goods(FEED_GOODS)
+    assert len(queries) == 1  # только выборка сохранённых хэшей
+    assert not importer.stats.changed
+    assert importer.stats.models['ProductInfo']['unchanged'] == 2
+
+    stats = GoodsImporter('Связной', full=True).run(FEED_CATEGORIES, FEED_GOODS)
+    assert stats.models['ProductParameter']['unchanged'] == 4
+
+
+def test_yaml_feed_reader_streams_goods():
+    import yaml
+    from backend.feeds import YamlFeedReader
+
+    with open('data/shop1.yaml', encoding='utf-8') as file:
+        expected = yaml.safe_load(file)
+    with open('data/shop1.yaml', encoding='utf-8') as file:
+        feed = YamlFeedReader(file)
+        assert feed.shop == expected['shop']
+        assert feed.categories == expected['categories']
+        assert list(feed) == expected['goods']
+
+
+def test_yaml_feed_reader_requires_header_before_goods():
+    import io
+    from backend.feeds import YamlFeedReader
+
+    feed = YamlFeedReader(io.StringIO('shop: Связной\ngoods:\n  - id: 1\ncategories:\n  - id: 224\n'))
+    with pytest.raises(ValueError, match='categories'):
+        list(feed)
+    with pytest.raises(ValueError, match='shop'):
+        YamlFeedReader(io.StringIO('goods:\n  - id: 1\nshop: Связной\n'))
+
+
+def test_generated_feed_matches_requested_size():
+    import io
+    from backend.feeds import YamlFeedReader
+    from backend.management.commands.generate_feed import write_feed
+
+    stream = io.StringIO()
+    write_feed(stream, goods=200, categories=3, parameters=5, duplicates=0.1, seed=1)
+    stream.seek(0)
+    feed = YamlFeedReader(stream)
+    goods = list(feed)
+    assert len(feed.categories) == 3
+    assert len(goods) == 200
+    assert all(len(good['parameters']) == 5 for good in goods)
+    assert 150 < len({good['id'] for good in goods}) < 200
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('feed_format', ['csv', 'jsonl'])
+def test_csv_and_jsonl_feeds_import_like_yaml(tmp_path, feed_format):
+    from backend.importer import import_feed
+    from backend.management.commands.generate_feed import write_feed
+    from backend.models import Category, ProductInfo
+
+    for extension in (feed_format, 'yaml'):
+        with open(tmp_path / f'feed.{extension}', 'w', encoding='utf-8', newline='') as file:
+            write_feed(file, goods=50, categories=3, parameters=3, shop='Формат', feed_format=extension)
+
+    stats = import_feed(str(tmp_path / f'feed.{feed_format}'))
+    assert not stats.errors
+    assert stats.models['ProductInfo']['inserted'] == 50
+    assert Category.objects.filter(shops__name='Формат').count() == 3
+    assert ProductInfo.objects.filter(shop__name='Формат').count() == 50
+
+    # Записи всех форматов приводятся к одной структуре, поэтому хэши совпадают с YAML-прайсом
+    stats = import_feed(str(tmp_path / 'feed.yaml'))
+    assert stats.models['ProductInfo']['unchanged'] == 50
+    assert not stats.changed
+
+
+@pytest.mark.django_db
+def test_rebuild_product_cards_streams_ids():
+    from django.core.management import call_command
+    from backend.catalog import refresh_product_cards
+    from backend.importer import GoodsImporter
+    from backend.models import FacetCount, Product, ProductCard
+
+    GoodsImporter('Связной').run(FEED_CATEGORIES, FEED_GOODS)
+    counts = set(FacetCount.objects.values_list('value', 'products'))
+    ProductCard.objects.all().delete()
+    FacetCount.objects.all().delete()
+    call_command('rebuild_product_cards', batch_size=1)
+    assert ProductCard.objects.count() == 2
+    assert set(FacetCount.objects.values_list('value', 'products')) == counts
+
+    # Поток id читается по пачкам; повторы и порядок внутри пачки не важны
+    ids = sorted(Product.objects.values_list('pk', flat=True))
+    assert refresh_product_cards((pk for pk in [ids[1], ids[0], ids[1]]), batch_size=3) == 2
+    assert set(FacetCount.objects.values_list('value', 'products')) == counts
+
+
+@pytest.mark.django_db
+def test_benchmark_cleanup_skips_card_signals(django_capture_on_commit_callbacks):
+    from backend.importer import GoodsImporter
+    from backend.management.commands.benchmark_import import BENCHMARK_SHOP, Command
+    from backend.models import FacetCount, Product, ProductCard, Shop
+
+    GoodsImporter(BENCHMARK_SHOP).run(FEED_CATEGORIES, FEED_GOODS)
+    GoodsImporter('Связной').run(FEED_CATEGORIES, FEED_GOODS[:1])
+    with django_capture_on_commit_callbacks() as callbacks:
+        Command().cleanup()
+    # Только увеличение версии каталога после пересборки, без пересборки на каждую удалённую строку
+    assert len(callbacks) == 1
+    assert not Shop.objects.filter(name=BENCHMARK_SHOP).exists()
+    assert Product.objects.count() == ProductCard.objects.count() == 1
+    assert set(FacetCount.objects.values_list('value', 'products')) == {('6.5', 1), ('золотистый', 1)}
+
+    # После очистки сигналы снова пересобирают карточки
+    with django_capture_on_commit_callbacks() as callbacks:
+        Product.objects.get().save()
+    assert len(callbacks) == 1
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize('workers', [1, 2])
+def test_import_feeds_reports_each_file(monkeypatch, tmp_path, workers):
+    from backend import importer
+    from backend.management.commands.generate_feed import write_feed
+
+    paths = []
+    for shop in ('Связной', 'Евросеть', 'Сломанный'):
+        path = str(tmp_path / f'{shop}.yaml')
+        with open(path, 'w', encoding='utf-8') as file:
+            write_feed(file, goods=20, categories=2, parameters=2, shop=shop)
+        paths.append(path)
+    file_sha256 = importer.file_sha256
+
+    def broken_sha256(file_path):
+        if 'Сломанный' in file_path:
+            raise RuntimeError('неожиданный сбой')
+        return file_sha256(file_path)
+
+    # Пул создаётся через fork, поэтому подмена действует и в дочерних процессах
+    monkeypatch.setattr(importer, 'file_sha256', broken_sha256)
+    results = dict(importer.import_feeds(paths, workers=workers))
+    assert set(results) == set(paths)
+    for path in paths[:2]:
+        assert not results[path].errors
+        assert results[path].models['ProductInfo']['inserted'] == 20
+    assert results[paths[2]].error_groups['aborted']['count'] == 1
+    assert 'неожиданный сбой' in results[paths[2]].errors[0]
+
+
+def test_shop_lock_is_noop_without_postgresql(monkeypatch):
+    from backend.importer import shop_lock
+
+    # Тесту не выдан доступ к базе, поэтому любой запрос блокировки завершился бы ошибкой
+    monkeypatch.setattr(connection, 'vendor', 'sqlite')
+    with shop_lock('Связной'), shop_lock('Связной'):
+        pass
+    with pytest.raises(OSError):
+        with shop_lock('Связной'):
+            raise OSError('сбой импорта')
+
+
+@pytest.mark.skipif(connection.vendor != 'postgresql', reason='advisory-блокировки есть только в PostgreSQL')
+@pytest.mark.django_db(transaction=True)
+def test_shop_lock_serializes_imports_of_one_shop():
+    import threading
+    import time
+    from django.db import connections
+    from backend.importer import shop_lock
+
+    events = []
+    locked = threading.Event()
+
+    def hold_lock():
+        try:
+            with shop_lock('Связной'):
+                events.append('first locked')
+                locked.set()
+                time.sleep(0.5)
+                events.append('first released')
+        finally:
+            connections.close_all()
+
+    def wait_for_lock():
+        try:
+            with shop_lock('Связной'):
+                events.append('second locked')
+        finally:
+            connections.close_all()
+
+    # У каждого потока своё подключение к базе, как у параллельных импортов
+    first = threading.Thread(target=hold_lock)
+    first.start()
+    assert locked.wait(5)
+    second = threading.Thread(target=wait_for_lock)
+    second.start()
+    first.join()
+    second.join()
+    assert events == ['first locked', 'first released', 'second locked']
+
+
+@pytest.mark.django_db
+def test_import_job_upload_and_progress(settings, tmp_path, django_capture_on_commit_callbacks):
+    from django.core.cache import cache
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from backend.models import ImportRun, Shop, ProductInfo
+
+    settings.MEDIA_ROOT = tmp_path
+    settings.CELERY_TASK_ALWAYS_EAGER = True
+    cache.clear()
+    user = User.objects.create_user(email='shop@example.com', password='pass', type='shop')
+    Shop.objects.create(name='Связной', user=user)
+    client = APIClient()
+    client.force_authenticate(user)
+
+    with open('data/shop1.yaml', 'rb') as file:
+        upload = SimpleUploadedFile('shop1.yaml', file.read())
+    with django_capture_on_commit_callbacks(execute=True):
+        response = client.post('/api/imports/', {'file': upload}, format='multipart')
+    assert response.status_code == status.HTTP_201_CREATED
+
+    response = client.get(f"/api/imports/{response.data['id']}/")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.data['state'] == 'done'
+    assert response.data['chunks_done'] == response.data['total_chunks'] == 1
+    assert response.data['rows_done'] == 14
+    assert ProductInfo.objects.filter(shop__name='Связной').count() == 14
+    run = ImportRun.objects.get()
+    assert run.success and run.shop.name == 'Связной' and run.options['job'] == response.data['id']
+
+
+@pytest.mark.django_db
+def test_import_jobs_are_bound_to_owner_shop_and_exclusive(settings, tmp_path, django_capture_on_commit_callbacks):
+    from django.core.cache import cache
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from backend.importer import GoodsImporter
+    from backend.models import ImportJob, ImportRun, ProductInfo, Shop
+
+    settings.MEDIA_ROOT = tmp_path
+    settings.CELERY_TASK_ALWAYS_EAGER = True
+    cache.clear()
+    with open('data/shop1.yaml', 'rb') as file:
+        content = file.read()
+    user = User.objects.create_user(email='shop@example.com', password='pass', type='shop')
+    client = APIClient()
+    client.force_authenticate(user)
+    response = client.post('/api/imports/', {'file': SimpleUploadedFile('shop1.yaml', content)}, format='multipart')
+    assert response.status_code == status.HTTP_403_FORBIDDEN
+
+    # Прайс чужого магазина не импортируется, даже если магазин с таким именем существует
+    Shop.objects.create(name='Связной')
+    Shop.objects.create(name='Другой', user=user)
+    with django_capture_on_commit_callbacks(execute=True):
+        response = client.post('/api/imports/', {'file': SimpleUploadedFile('shop1.yaml', content)}, format='multipart')
+    job = ImportJob.objects.get(pk=response.data['id'])
+    assert job.state == 'failed' and 'Другой' in job.errors[0]
+    assert not ProductInfo.objects.exists()
+    assert not ImportRun.objects.get().success
+
+    # Пока задача магазина не завершена, вторая загрузка и импорт из командной строки отклоняются
+    ImportJob.objects.filter(pk=job.pk).update(state='running')
+    response = client.post('/api/imports/', {'file': SimpleUploadedFile('shop1.yaml', content)}, format='multipart')
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    with pytest.raises(ValueError, match='фоновой задачей'):
+        GoodsImporter(Shop.objects.get(name='Другой')).run(FEED_CATEGORIES, FEED_GOODS)
+
+
+@pytest.mark.django_db
+def test_import_job_fails_instead_of_hanging(settings, tmp_path, monkeypatch):
+    from celery import signature
+    from django.core.files.base import ContentFile
+    from backend import tasks
+    from backend.importer import GoodsImporter
+    from backend.models import ImportJob
+
+    settings.MEDIA_ROOT = tmp_path
+    settings.CELERY_TASK_ALWAYS_EAGER = True
+    with open('data/shop1.yaml', 'rb') as file:
+        content = file.read()
+
+    def broken_categories(self, categories):
+        raise RuntimeError('неожиданный сбой')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(GoodsImporter, 'import_categories', broken_categories)
+        job = ImportJob.objects.create(file=ContentFile(content, name='shop1.yaml'))
+        tasks.start_import(str(job.pk))
+    job.refresh_from_db()
+    assert job.state == 'failed' and job.errors == ['неожиданный сбой']
+
+    # Части импортируются chord; его обработчик ошибки вызывается, если часть завершилась аварийно
+    callbacks = []
+    monkeypatch.setattr(tasks, 'chord', lambda header: callbacks.append)
+    job = ImportJob.objects.create(file=ContentFile(content, name='shop1.yaml'))
+    tasks.start_import(str(job.pk))
+    assert tasks.default_storage.exists(f'imports/{job.pk}/chunk-00000.json')
+    errback = signature(callbacks[0].options['link_error'][0])
+    errback(None, RuntimeError('превышен time_limit'), None)
+    job.refresh_from_db()
+    assert job.state == 'failed' and job.errors == ['превышен time_limit']
+    assert job.finished_at is not None
+    assert not tasks.default_storage.exists(f'imports/{job.pk}/chunk-00000.json')
+
+
+@pytest.mark.django_db
+def test_staged_import_publishes_only_valid_feed():
+    from copy import deepcopy
+    from backend.importer import GoodsImporter
+    from backend.models import Product, ProductInfo, ProductInfoStage, ProductParameter
+
+    stats = GoodsImporter('Связной', staged=True).run(FEED_CATEGORIES, FEED_GOODS)
+    assert stats.models['Product']['inserted'] == 2
+    assert stats.models['ProductInfo']['inserted'] == 2
+    assert ProductParameter.objects.count() == 4
+    assert not ProductInfoStage.objects.exists()
+    products = list(Product.objects.order_by('pk').values())
+
+    goods = deepcopy(FEED_GOODS)
+    goods[0]['price'] = 0
+    goods[1]['price'] = 1
+    goods[1]['name'] = 'Смартфон Apple iPhone XR 256GB (уценка)'
+    goods.append(dict(FEED_GOODS[0], id=1))
+    stats = GoodsImporter('Связной', staged=True).run(FEED_CATEGORIES, goods)
+    assert 'Публикация отменена' in stats.errors[-1]
+    assert ProductInfo.objects.get(external_id='4216313').price == 65000
+    # Отменённая публикация не меняет продукты и не создаёт новых
+    assert list(Product.objects.order_by('pk').values()) == products
+    assert 'Product' not in stats.models
+
+    goods = deepcopy(FEED_GOODS)
+    del goods[1]['parameters']['Color']
+    stats = GoodsImporter('Связной', staged=True).run(FEED_CATEGORIES, goods)
+    assert stats.models['ProductParameter']['deleted'] == 1
+    assert ProductParameter.objects.count() == 3
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('threshold', [10000, 1])
+def test_import_deactivates_offers_missing_from_feed(monkeypatch, threshold):
+    from backend import importer
+    from backend.models import PriceHistory, ProductInfo
+
+    monkeypatch.setattr(importer, 'SEEN_IDS_TEMP_TABLE_THRESHOLD', threshold)
+    importer.GoodsImporter('Связной').run(FEED_CATEGORIES, FEED_GOODS)
+
+    stats = importer.GoodsImporter('Связной', missing='out-of-stock').run(FEED_CATEGORIES, FEED_GOODS[:1])
+    assert stats.deactivated == 1
+    assert ProductInfo.objects.get(external_id='4216313').quantity == 0
+    assert list(
+        PriceHistory.objects.filter(product_info__external_id='4216313').values_list('quantity', flat=True)
+    ) == [9, 0]
+
+    stats = importer.GoodsImporter('Связной', missing='archive').run(FEED_CATEGORIES, FEED_GOODS[:1])
+    assert stats.deactivated == 1
+    assert not ProductInfo.objects.get(external_id='4216313').is_active
+
+    importer.GoodsImporter('Связной').run(FEED_CATEGORIES, FEED_GOODS)
+    offer = ProductInfo.objects.get(external_id='4216313')
+    assert offer.is_active and offer.quantity == 9
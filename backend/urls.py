@@ -16,6 +16,10 @@ from .views import (
     OrderListView,
     OrderDetailView,
     OrderStatusUpdateView,
+    ImportJobCreateView,
+    ImportJobDetailView,
+    PriceHistoryView,
+    ProductOffersView,
 )
 
 
@@ -36,6 +40,10 @@ urlpatterns = [
     path('orders/', OrderListView.as_view(), name='order_list'),
     path('orders/<int:pk>/', OrderDetailView.as_view(), name='order_detail'),
     path('orders/<int:pk>/status/', OrderStatusUpdateView.as_view(), name='order_status_update'),
+    path('imports/', ImportJobCreateView.as_view(), name='import_create'),
+    path('imports/<uuid:pk>/', ImportJobDetailView.as_view(), name='import_detail'),
+    path('products/<int:pk>/offers/', ProductOffersView.as_view(), name='product_offers'),
+    path('product-infos/<int:pk>/price-history/', PriceHistoryView.as_view(), name='price_history'),
     path('protected-view/', ProtectedView.as_view(), name='protected-view'),
     path('schema/', SpectacularAPIView.as_view(), name='schema'),
     path('schema/swagger-ui/', SpectacularSwaggerView.as_view(url_name='schema'), name='swagger-ui'),
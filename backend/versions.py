@@ -0,0 +1,86 @@
+"""
+Версии ресурсов API для условных GET (ETag / Last-Modified).
+
+Каждый ресурс — каталог, заказы пользователя (список и корзина), отдельный
+заказ — имеет счётчик в ResourceVersion, который увеличивается при записи.
+ETag ответа составляется из версий ресурсов, от которых он зависит, поэтому
+на запрос с совпадающим If-None-Match представление отвечает 304, не выполняя
+запрос к данным и сериализатор.
+
+Позиции заказа показывают текущую цену предложения, поэтому ответы с заказами
+зависят и от версии каталога. Версия каталога увеличивается после фиксации
+транзакции, в которой пересобраны карточки: так параллельные импорты не
+ждут друг друга на одной строке счётчика.
+"""
+from cachalot.api import cachalot_disabled
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+
+from .models import ResourceVersion
+
+CATALOG = 'catalog'
+
+
+def orders_key(user_id):
+    return f'orders:{user_id}'
+
+
+def order_key(order_id):
+    return f'order:{order_id}'
+
+
+def bump_versions(*keys):
+    """Увеличивает версии ресурсов одним INSERT ... ON CONFLICT DO UPDATE"""
+    quote_name = connection.ops.quote_name
+    table = quote_name(ResourceVersion._meta.db_table)
+    key_column = quote_name('key')
+    now = timezone.now()
+    # Ключи сортируются, чтобы параллельные транзакции блокировали строки в одном порядке
+    keys = sorted(set(keys))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {table} ({key_column}, version, updated_at) '
+            f"VALUES {', '.join(['(%s, 1, %s)'] * len(keys))} "
+            f'ON CONFLICT ({key_column}) DO UPDATE SET '
+            f'version = {table}.version + 1, updated_at = EXCLUDED.updated_at',
+            [param for key in keys for param in (key, now)]
+        )
+
+
+def bump_catalog_version():
+    transaction.on_commit(lambda: bump_versions(CATALOG))
+
+
+def _versions(request, keys):
+    """[(ключ, версия, время изменения)]; одно чтение на запрос для ETag и Last-Modified"""
+    cache = request.__dict__.setdefault('_resource_versions', {})
+    if tuple(keys) not in cache:
+        # Версии читаются мимо кэша cachalot: проверка ETag стоит одного запроса на каждом запросе к API
+        with cachalot_disabled(all_queries=True):
+            found = {
+                key: (version, updated_at)
+                for key, version, updated_at in ResourceVersion.objects.filter(key__in=keys).values_list(
+                    'key', 'version', 'updated_at'
+                )
+            }
+        cache[tuple(keys)] = [(key, *found.get(key, (0, None))) for key in keys]
+    return cache[tuple(keys)]
+
+
+def conditional(resource_keys):
+    """
+    Декоратор метода представления: ETag и Last-Modified по версиям ресурсов
+    resource_keys(request, *args, **kwargs) и ответ 304 на совпадающий If-None-Match
+    или If-Modified-Since.
+    """
+    def etag(request, *args, **kwargs):
+        versions = _versions(request, resource_keys(request, *args, **kwargs))
+        return ';'.join(f'{key}:{version}' for key, version, _ in versions)
+
+    def last_modified(request, *args, **kwargs):
+        versions = _versions(request, resource_keys(request, *args, **kwargs))
+        return max((updated_at for _, _, updated_at in versions if updated_at), default=None)
+
+    return method_decorator(condition(etag_func=etag, last_modified_func=last_modified))
@@ -4,33 +4,49 @@ from rest_framework.generics import (
 )
 import time
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.parsers import MultiPartParser
+from django.db import transaction
 from rest_framework.exceptions import ValidationError, PermissionDenied
 from .serializers import ConfirmEmailTokenSerializer
 from .serializers import UserSerializer
 from django.contrib.auth import authenticate
 from rest_framework import status, permissions, viewsets, filters
-from django.http import JsonResponse
-from django.db.models import Count
+from django.http import JsonResponse, StreamingHttpResponse
+from django.db.models import Count, F
+from django.db.models.functions import Coalesce
+from django.shortcuts import get_object_or_404
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.authtoken.models import Token
 from rest_framework.throttling import AnonRateThrottle, UserRateThrottle
 from .models import (
     User as CustomUser, Product, ProductInfo, ConfirmEmailToken,
-    Order, OrderItem, Contact, STATE_CHOICES, Parameter
+    Order, OrderItem, Contact, STATE_CHOICES, Parameter, ImportJob, PriceHistory, ProductCard, Shop
 )
 from .serializers import (
-    LoginSerializer, ParameterSerializer, RegistrationSerializer, ProductSerializer,
+    LoginSerializer, ParameterSerializer, RegistrationSerializer, ProductSerializer, ProductCardSerializer,
     ProductInfoSerializer, ContactSerializer, OrderSerializer,
-    OrderItemSerializer
+    OrderItemSerializer, ImportJobSerializer, PriceHistorySerializer, ProductOfferSerializer
 )
 import logging
+from itertools import islice
+from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.utils import OpenApiParameter, extend_schema
+from rest_framework.decorators import action
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from cacheops import cached_view
 from cacheops import cached
+from .catalog import facet_counts
+from .filters import ProductCardFilter, ProductFacetFilter, ProductFullTextSearchFilter, ProductOrderingFilter
+from .pagination import ProductCursorPagination
+from .renderers import CSVRenderer, NDJSONRenderer
+from .versions import CATALOG, conditional, order_key, orders_key
 
 logger = logging.getLogger(__name__)
 
+# Карточек в одной пачке выгрузки каталога: столько строк читается из курсора и предзагружается за раз
+EXPORT_CHUNK_SIZE = 1000
+
 
 # Регистрация нового пользователя
 class RegistrationView(CreateAPIView):
@@ -115,7 +131,7 @@ class ProductListView(ListAPIView):
     """
     Представление для получения списка товаров.
     """
-    queryset = Product.objects.all()
+    queryset = ProductSerializer.setup_eager_loading(Product.objects.all())
     serializer_class = ProductSerializer
     permission_classes = [permissions.AllowAny]
 
@@ -126,23 +142,74 @@ class ProductViewSet(viewsets.ReadOnlyModelViewSet):
     Представление для работы с товарами.
     Предоставляет методы для получения списка товаров и их фильтрации.
     """
-    queryset = Product.objects.all().select_related('category').prefetch_related('infos')
-    serializer_class = ProductSerializer
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
-    filterset_fields = ['category', 'quantity']
-    search_fields = ['name', 'description']
-    ordering_fields = ['price', 'quantity']
+    # Ответ читается из готовых карточек товаров; ключ карточки — id продукта, он же ключ сортировки id
+    queryset = ProductCard.objects.defer('search_vector').annotate(id=F('product_id'))
+    serializer_class = ProductCardSerializer
+    pagination_class = ProductCursorPagination
+    filter_backends = [
+        DjangoFilterBackend, filters.SearchFilter, ProductFullTextSearchFilter, ProductFacetFilter,
+        ProductOrderingFilter
+    ]
+    filterset_class = ProductCardFilter
+    search_fields = ['name', 'product__description']
+    # Курсорная пагинация требует стабильной сортировки: по умолчанию — по первичному ключу
+    ordering_fields = ['id', 'price', 'quantity']
+    ordering = ['id']
 
-    @cached(timeout=60 * 15,
-            extra=lambda self: self.request.user.id if self.request.user.is_authenticated else 'anonymous')
     def get_queryset(self):
-        queryset = super().get_queryset()
-        return queryset
-
+        # Из карточки читаются только поля, выбранные параметрами ?fields= и ?expand=
+        return self.get_serializer_class().setup_eager_loading(super().get_queryset(), self.get_serializer().fields)
+
+    def get_serializer(self, *args, **kwargs):
+        if self.action == 'export':
+            # Выгрузка всегда содержит предложения магазинов
+            params = self.request.query_params
+            kwargs.setdefault('fields', params.get('fields', ''))
+            kwargs.setdefault('expand', ','.join(filter(None, [params.get('expand'), 'offers'])))
+        return super().get_serializer(*args, **kwargs)
+
+    @conditional(lambda request, *args, **kwargs: [CATALOG])
     def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        response = super().list(request, *args, **kwargs)
+        # При выборе категории в ответ добавляются готовые счётчики значений её параметров
+        category = request.query_params.get('category', '')
+        if category.isdigit():
+            response.data['facets'] = facet_counts(int(category))
+        return response
+
+    @conditional(lambda request, *args, **kwargs: [CATALOG])
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+    @extend_schema(
+        parameters=[OpenApiParameter('format', OpenApiTypes.STR, enum=['ndjson', 'csv'], description='Формат выгрузки')],
+        responses={(200, NDJSONRenderer.media_type): ProductCardSerializer, (200, CSVRenderer.media_type): OpenApiTypes.STR},
+    )
+    @action(detail=False, renderer_classes=[NDJSONRenderer, CSVRenderer], pagination_class=None)
+    @conditional(lambda request, *args, **kwargs: [CATALOG])
+    def export(self, request, *args, **kwargs):
+        """
+        Потоковая выгрузка всего каталога (с учётом фильтров) в NDJSON или CSV: ?format=ndjson|csv.
+        Карточки читаются курсором пачками по EXPORT_CHUNK_SIZE, предложения магазинов
+        предзагружаются на пачку, поэтому память процесса не зависит от размера каталога.
+        """
+        serializer = self.get_serializer()
+        queryset = self.filter_queryset(self.get_queryset())
+        renderer = request.accepted_renderer
+        response = StreamingHttpResponse(
+            renderer.stream(self.export_batches(queryset, serializer), list(serializer.fields)),
+            content_type=f'{renderer.media_type}; charset=utf-8',
+        )
+        response['Content-Disposition'] = f'attachment; filename="products.{renderer.format}"'
+        return response
+
+    @staticmethod
+    def export_batches(queryset, serializer):
+        # iterator с chunk_size читает строки курсором на стороне сервера (PostgreSQL)
+        # и выполняет prefetch_related для каждой пачки
+        cards = queryset.iterator(chunk_size=EXPORT_CHUNK_SIZE)
+        while batch := list(islice(cards, EXPORT_CHUNK_SIZE)):
+            yield [serializer.to_representation(card) for card in batch]
 
 
 # Детальная информация о товаре
@@ -159,6 +226,43 @@ class ProductInfoDetailView(RetrieveAPIView):
         return super().retrieve(request, *args, **kwargs)
 
 
+# Предложения магазинов по товару
+class ProductOffersView(ListAPIView):
+    """
+    Представление для сравнения предложений магазинов по товару.
+    Возвращает активные предложения от самого дешёвого с учётом скидки.
+    """
+    serializer_class = ProductOfferSerializer
+    permission_classes = [permissions.AllowAny]
+
+    def get_queryset(self):
+        if getattr(self, 'swagger_fake_view', False):  # Генерация схемы drf-spectacular
+            return ProductInfo.objects.none()
+        product = get_object_or_404(Product, pk=self.kwargs['pk'])
+        # price * (100 - discount) упорядочивает предложения так же, как цена со скидкой
+        return ProductInfo.objects.filter(product=product, is_active=True).select_related('shop').order_by(
+            F('price') * (100 - Coalesce('discount', 0)), 'id'
+        )
+
+
+# История цен и остатков предложения
+class PriceHistoryView(ListAPIView):
+    """
+    Представление для получения истории цены и количества предложения магазина.
+    Период задаётся параметрами changed_at__gte и changed_at__lte.
+    """
+    serializer_class = PriceHistorySerializer
+    permission_classes = [permissions.AllowAny]
+    filter_backends = [DjangoFilterBackend]
+    filterset_fields = {'changed_at': ['gte', 'lte']}
+
+    def get_queryset(self):
+        if getattr(self, 'swagger_fake_view', False):  # Генерация схемы drf-spectacular
+            return PriceHistory.objects.none()
+        product_info = get_object_or_404(ProductInfo, pk=self.kwargs['pk'])
+        return PriceHistory.objects.filter(product_info=product_info).order_by('changed_at')
+
+
 # Список всех параметров
 class ParameterListView(ListAPIView):
     """
@@ -179,13 +283,17 @@ class BasketView(APIView):
     permission_classes = [permissions.IsAuthenticated]
     throttle_classes = [UserRateThrottle]
 
-    @cached(timeout=60*5, extra=lambda self, req: req.user.id)   # Кэшируем на 5 минут
+    # Условный GET по версии заказов пользователя вместо кэша ответа на 5 минут
+    @conditional(lambda request, *args, **kwargs: [orders_key(request.user.pk), CATALOG])
     def get(self, request):
         """
         Получает корзину текущего пользователя.
         """
-        basket, created = Order.objects.get_or_create(user=request.user, state='basket')
-        serializer = OrderSerializer(basket)
+        fields = OrderSerializer(context={'request': request}).fields
+        basket, created = OrderSerializer.setup_eager_loading(Order.objects.all(), fields).get_or_create(
+            user=request.user, state='basket'
+        )
+        serializer = OrderSerializer(basket, context={'request': request})
         return Response(serializer.data)
 
     def post(self, request):
@@ -204,7 +312,7 @@ class BasketView(APIView):
             return Response({'detail': 'Некорректное количество.'}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            product_info = ProductInfo.objects.get(id=product_info_id)
+            product_info = ProductInfo.objects.get(id=product_info_id, is_active=True)
             if product_info.quantity < quantity:
                 return Response({'detail': 'Недостаточно товара на складе.'}, status=status.HTTP_400_BAD_REQUEST)
         except ProductInfo.DoesNotExist:
@@ -305,14 +413,19 @@ class OrderListView(ListAPIView):
     serializer_class = OrderSerializer
     permission_classes = [permissions.IsAuthenticated]
 
-    @cached(timeout=60*5, extra=lambda self, req: req.user.id)   # Кэшируем на 10 минут
+    @conditional(lambda request, *args, **kwargs: [orders_key(request.user.pk), CATALOG])
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
     def get_queryset(self):
         """
         Получает список заказов для текущего пользователя.
         """
         if getattr(self, "swagger_fake_view", False):
             return Order.objects.none()  # Заглушка для OpenAPI
-        return Order.objects.filter(user=self.request.user)
+        return OrderSerializer.setup_eager_loading(
+            Order.objects.filter(user=self.request.user), self.get_serializer().fields
+        )
 
 
 # Детали заказа
@@ -324,6 +437,22 @@ class OrderDetailView(RetrieveAPIView):
     serializer_class = OrderSerializer
     permission_classes = [permissions.IsAuthenticated]
 
+    def get(self, request, *args, **kwargs):
+        # Заказ выбирается и проверяется до сравнения версий: иначе совпадающий ETag
+        # отвечал бы 304 и на чужой заказ
+        self.object = self.get_object()
+        return self.retrieve_order(request, *args, **kwargs)
+
+    @conditional(lambda request, *args, **kwargs: [order_key(kwargs['pk']), CATALOG])
+    def retrieve_order(self, request, *args, **kwargs):
+        return Response(self.get_serializer(self.object).data)
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if not self.request.user.is_staff:
+            queryset = queryset.filter(user=self.request.user)
+        return OrderSerializer.setup_eager_loading(queryset, self.get_serializer().fields)
+
 
 class OrderStatusUpdateView(UpdateAPIView):
     serializer_class = OrderSerializer
@@ -340,6 +469,56 @@ class OrderStatusUpdateView(UpdateAPIView):
         serializer.save(state=new_status)
 
 
+
+# Загрузка прайса для фонового импорта
+class ImportJobCreateView(CreateAPIView):
+    """
+    Представление для загрузки прайса магазина.
+    Сохраняет файл и ставит импорт в очередь Celery, сразу возвращая id задачи импорта.
+    """
+    serializer_class = ImportJobSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    parser_classes = [MultiPartParser]
+
+    def perform_create(self, serializer):
+        """
+        Создаёт задачу импорта и запускает её после фиксации транзакции.
+        """
+        user = self.request.user
+        if user.type != 'shop' and not user.is_staff:
+            raise PermissionDenied('Импорт прайса доступен только магазинам.')
+        # Прайс магазина импортируется в магазин владельца; магазин администратора определяется по прайсу
+        shop = None if user.is_staff else getattr(user, 'shop', None)
+        if shop is None and not user.is_staff:
+            raise PermissionDenied('Сначала создайте магазин.')
+        with transaction.atomic():
+            if shop is not None:
+                # Блокировка строки магазина не даёт двум одновременным загрузкам пройти проверку
+                list(Shop.objects.select_for_update().filter(pk=shop.pk).values_list('pk'))
+                if ImportJob.objects.filter(shop=shop, state__in=['pending', 'running']).exists():
+                    raise ValidationError({'detail': 'Прайс магазина уже импортируется.'})
+            job = serializer.save(user=user, shop=shop)
+        from backend.tasks import start_import
+        transaction.on_commit(lambda: start_import.delay(str(job.pk)))
+
+
+# Прогресс фонового импорта
+class ImportJobDetailView(RetrieveAPIView):
+    """
+    Представление для получения прогресса импорта: обработанные части, скорость и ошибки.
+    """
+    serializer_class = ImportJobSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        """
+        Пользователь видит только свои импорты, администратор — все.
+        """
+        queryset = ImportJob.objects.select_related('shop')
+        if self.request.user.is_staff:
+            return queryset
+        return queryset.filter(user=self.request.user)
+
 class ProtectedView(APIView):
     serializer_class = UserSerializer
     permission_classes = [IsAuthenticated]